@@ -3,6 +3,7 @@ import os
 from flask import Flask, render_template, send_from_directory
 from flask_cors import CORS
 
+from dyno.app.cache import cache
 from dyno.app.cfg import Config as Cfg
 
 
@@ -10,6 +11,7 @@ def create_app(config_class=Cfg):
     app = Flask(__name__)
     app.config.from_object(config_class)
     CORS(app)
+    cache.init_app(app)
     from dyno.app.api import bp as api_bp  # noqa E402
     from dyno.app.api.docker import bp as api_docker  # noqa E402
     app.register_blueprint(api_bp, url_prefix='/api')
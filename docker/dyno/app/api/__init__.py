@@ -4,3 +4,4 @@ from flask import Blueprint
 bp = Blueprint('api', __name__)
 
 from dyno.app.api import control  # noqa E402
+from dyno.app.api import metrics  # noqa E402
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Last-write-wins coalescing of updates
+
+Dragging a slider in the UI produces a stream of updates of which
+only the most recent one matters. A Coalescer keeps the latest pending
+value for each key and hands them to a flush function in a background
+thread, at most once per flush interval.
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer(object):
+    """
+    Collect updates by key and flush them at a bounded rate
+
+    Parameters
+    ----------
+    callable : flush
+        Called with a dict of {key: value} holding the latest value
+        submitted for each key since the previous flush
+
+    float : interval
+        Minimum number of seconds between two flushes
+    """
+    def __init__(self, flush, interval):
+        self.flush = flush
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}
+        self._pid = None
+
+    def submit(self, key, value):
+        """
+        Queue a value for a key, replacing any value which
+        is still pending for the same key
+
+        Parameters
+        ----------
+        hashable : key
+            The key to update
+
+        object : value
+            The value to flush for the key
+        """
+        with self._lock:
+            self._pending[key] = value
+            self._ensure_thread()
+        self._wakeup.set()
+
+    def drain(self):
+        """
+        Flush all pending values immediately
+
+        Returns
+        -------
+        dict
+            The values which were flushed
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self.flush(pending)
+        return pending
+
+    def _ensure_thread(self):
+        """
+        Start the flush thread if this process does not have one yet.
+        Threads do not survive a fork, so this is tracked per process.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        thread = threading.Thread(target=self._run, name='dyno-coalescer', daemon=True)
+        thread.start()
+        self._pid = pid
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('Failed to flush coalesced updates')
+            time.sleep(self.interval)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+In-memory snapshot of running containers
+
+Container names produced by compose.py look like
+localtesting_7.9.0_elasticsearch, while the UI refers to containers
+by their short name, `elasticsearch`. The snapshot maps short names to
+full container names and holds the state and HostConfig of each running
+container. It is built once and then kept current by the Docker events
+stream, so the API can answer without a round trip to the Docker daemon.
+"""
+import copy
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Events after which a container is inspected again
+INSPECT_ACTIONS = ('start', 'update', 'rename', 'pause', 'unpause')
+
+# Events after which a container is no longer running
+REMOVE_ACTIONS = ('die', 'destroy')
+
+
+def short_name(name):
+    """
+    Return the short name for a container
+
+    Parameters
+    ----------
+    str : name
+        A full container name, such as localtesting_7.9.0_elasticsearch
+
+    Returns
+    -------
+    str
+        The short name, such as elasticsearch
+    """
+    return name.split('_').pop().strip()
+
+
+def _entry(attrs):
+    """
+    Build a snapshot entry from the output of `docker inspect`
+    """
+    state = attrs.get('State', {})
+    return {
+        'id': attrs.get('Id'),
+        'name': attrs['Name'].lstrip('/'),
+        'status': state.get('Status'),
+        'health': state.get('Health', {}).get('Status'),
+        'HostConfig': attrs.get('HostConfig', {}),
+    }
+
+
+class ContainerSnapshot(object):
+    """
+    Hold the state of all running containers
+
+    Parameters
+    ----------
+    callable : list_containers
+        Returns the `docker inspect` output for all running containers
+
+    callable : inspect
+        Returns the `docker inspect` output for a single container,
+        given its name or id
+
+    callable : events
+        Returns a stream of decoded Docker container events. If this is
+        not given, the snapshot cannot be kept current. It is then rebuilt
+        on every lookup and container configuration is always inspected.
+    """
+    def __init__(self, list_containers, inspect, events=None):
+        self.list_containers = list_containers
+        self.inspect = inspect
+        self.events = events
+        self._lock = threading.Lock()
+        self._containers = {}
+        self._by_short = {}
+        self._stream = None
+        # The process which holds a live snapshot, or None if the snapshot is stale
+        self._pid = None
+
+    @property
+    def live(self):
+        """
+        Whether the snapshot is currently kept up to date by Docker events
+        """
+        return self._pid == os.getpid()
+
+    def invalidate(self):
+        """
+        Mark the snapshot as stale so that it is rebuilt on the next lookup
+        """
+        self._pid = None
+
+    def names(self):
+        """
+        Return the names of all running containers
+
+        Returns
+        -------
+        list
+            Full container names
+        """
+        self._ensure()
+        with self._lock:
+            return list(self._containers)
+
+    def lookup(self, name):
+        """
+        Find the full container name for a short name
+
+        Parameters
+        ----------
+        str : name
+            The short name of the container
+
+        Returns
+        -------
+        str
+            The full container name
+
+        Raises
+        ------
+        Exception
+            If no container or more than one container matches the name
+        """
+        self._ensure()
+        with self._lock:
+            found = sorted(self._by_short.get(name, ()))
+        if len(found) > 1:
+            raise Exception('Found more than one instance matching [{}]'.format(name))
+        if not found:
+            raise Exception('Could not normalize [{}] because it was not found in the container list'.format(name))
+        return found[0]
+
+    def host_config(self, name):
+        """
+        Return the HostConfig for a container
+
+        Parameters
+        ----------
+        str : name
+            The full container name
+
+        Returns
+        -------
+        dict
+            The HostConfig section of `docker inspect` for the container
+        """
+        if self.live:
+            with self._lock:
+                entry = self._containers.get(name)
+            if entry:
+                return copy.deepcopy(entry['HostConfig'])
+        return self.inspect(name)['HostConfig']
+
+    def refresh(self, name):
+        """
+        Inspect a container again and update its entry, for use after
+        changing a container without waiting for the matching event
+
+        Parameters
+        ----------
+        str : name
+            The full container name or id
+        """
+        if self.live:
+            self._store(self.inspect(name))
+
+    def _ensure(self):
+        """
+        Rebuild the snapshot if it is stale. The events stream is opened
+        before containers are listed so that no change is missed in between.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            stream = self.events() if self.events else None
+            self._containers = {}
+            self._by_short = {}
+            try:
+                for attrs in self.list_containers():
+                    self._add(_entry(attrs))
+            except Exception:
+                if stream is not None:
+                    stream.close()
+                raise
+            self._stream = stream
+            if stream is None:
+                return
+            thread = threading.Thread(target=self._watch, args=(stream,), name='dyno-containers', daemon=True)
+            thread.start()
+            self._pid = pid
+
+    def _add(self, entry):
+        self._containers[entry['name']] = entry
+        self._by_short.setdefault(short_name(entry['name']), set()).add(entry['name'])
+
+    def _remove(self, name):
+        self._containers.pop(name, None)
+        names = self._by_short.get(short_name(name))
+        if names:
+            names.discard(name)
+            if not names:
+                del self._by_short[short_name(name)]
+
+    def _store(self, attrs):
+        entry = _entry(attrs)
+        with self._lock:
+            self._remove(entry['name'])
+            self._add(entry)
+
+    def handle_event(self, event):
+        """
+        Apply a single Docker container event to the snapshot
+
+        Parameters
+        ----------
+        dict : event
+            A decoded event from the Docker events API
+        """
+        if event.get('Type') != 'container':
+            return
+        actor = event.get('Actor', {})
+        attributes = actor.get('Attributes', {})
+        name = attributes.get('name')
+        action = event.get('Action', '')
+        if not name:
+            return
+        if action in REMOVE_ACTIONS:
+            with self._lock:
+                self._remove(name)
+        elif action in INSPECT_ACTIONS:
+            if action == 'rename':
+                with self._lock:
+                    self._remove(attributes.get('oldName', '').lstrip('/'))
+            self._store(self.inspect(actor.get('ID') or name))
+        elif action.startswith('health_status'):
+            with self._lock:
+                entry = self._containers.get(name)
+                if entry:
+                    entry['health'] = action.split(':', 1)[-1].strip()
+
+    def _watch(self, stream):
+        try:
+            for event in stream:
+                try:
+                    self.handle_event(event)
+                except Exception:
+                    logger.exception('Could not apply Docker event %s', event)
+        except Exception:
+            logger.exception('Lost the Docker events stream')
+        if self._stream is stream:
+            self.invalidate()
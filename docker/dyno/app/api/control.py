@@ -16,12 +16,24 @@
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
 
+import logging
 import os
-import yaml
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from dyno import app
 from flask import request
-from dyno.app.api import bp
+from dyno.app.api import bp, ranges
+from dyno.app.api.coalesce import Coalescer
+from dyno.app.cache import cache
+from requests.adapters import HTTPAdapter
+from toxiproxy.api import APIConsumer, validate_response
+from toxiproxy.exceptions import NotFound
+from toxiproxy.proxy import Proxy
 from toxiproxy.server import Toxiproxy
+from toxiproxy.toxic import Toxic
+
+logger = logging.getLogger(__name__)
 
 """
 The `toxic_map` is a dictionary which maps
@@ -46,6 +58,191 @@ toxic_map = {
 }
 
 
+# Maximum number of keep-alive connections each worker holds open to Toxiproxy
+TOXI_POOL_SIZE = int(os.environ.get('TOXI_POOL_SIZE', 10))
+
+# Maximum number of proxies updated concurrently by /api/slide/batch
+TOXI_BATCH_WORKERS = int(os.environ.get('TOXI_BATCH_WORKERS', TOXI_POOL_SIZE))
+
+"""
+State for the Toxiproxy client which is shared by every request
+served by this worker process. See `_fetch_proxy()`.
+"""
+_client = {'pid': None, 'addr': None, 'toxiproxy': None}
+
+
+class PooledAPIConsumer(object):
+    """
+    A Toxiproxy API consumer with its own address and connection pool.
+
+    The toxiproxy library issues every API call through the class-level
+    `APIConsumer`, which opens a new connection for each call through
+    the module-level `requests` functions. This consumer is used in its
+    place by `PooledToxiproxy` and `PooledProxy`, so nothing in the
+    library has to be patched.
+
+    Each thread gets its own `requests.Session`, as sessions are not
+    safe to share between threads, but all of them draw keep-alive
+    connections from the same pool.
+    """
+    def __init__(self, host=APIConsumer.host, port=APIConsumer.port):
+        self.host = host
+        self.port = port
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TOXI_POOL_SIZE)
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """
+        The session for the calling thread
+
+        Returns
+        -------
+        requests.Session
+            A session using the connection pool of this consumer
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            self.local.session = session
+        return session
+
+    def _url(self, url):
+        return 'http://{}:{}{}'.format(self.host, self.port, url)
+
+    def get(self, url, params=None, **kwargs):
+        """ Use the GET method to fetch data from the API """
+        return validate_response(self.session.get(self._url(url), params=params, **kwargs))
+
+    def delete(self, url, **kwargs):
+        """ Use the DELETE method to delete data from the API """
+        return validate_response(self.session.delete(self._url(url), **kwargs))
+
+    def post(self, url, data=None, json=None, **kwargs):
+        """ Use the POST method to post data to the API """
+        return validate_response(self.session.post(self._url(url), data=data, json=json, **kwargs))
+
+
+class PooledProxy(Proxy):
+    """
+    A Toxiproxy proxy which talks to the API through a `PooledAPIConsumer`
+    """
+    def __init__(self, api, **kwargs):
+        super(PooledProxy, self).__init__(**kwargs)
+        self.api = api
+
+    def toxics(self):
+        """
+        Retrieve all toxics of the proxy
+
+        Returns
+        -------
+        dict
+            Instances of toxiproxy.toxic.Toxic() by name
+        """
+        toxics = {}
+        for toxic in self.api.get('/proxies/{}/toxics'.format(self.name)).json():
+            toxic.update({'proxy': self.name})
+            toxics[toxic['name']] = Toxic(**toxic)
+        return toxics
+
+    def add_toxic(self, **kwargs):
+        """
+        Add a toxic to the proxy. Accepts the same arguments as
+        toxiproxy.proxy.Proxy.add_toxic()
+        """
+        toxic_type = kwargs['type']
+        stream = kwargs.get('stream', 'downstream')
+        json = {
+            'name': kwargs.get('name', '{}_{}'.format(toxic_type, stream)),
+            'type': toxic_type,
+            'stream': stream,
+            'toxicity': kwargs.get('toxicity', 1.0),
+            'attributes': kwargs.get('attributes', {})
+            }
+        self.api.post('/proxies/{}/toxics'.format(self.name), json=json).json()
+
+    def edit_toxic(self, **kwargs):
+        """
+        Change the attributes of an existing toxic. Accepts the same
+        arguments as add_toxic()
+        """
+        name = kwargs.get('name', '{}_{}'.format(kwargs['type'], kwargs.get('stream', 'downstream')))
+        json = {'attributes': kwargs.get('attributes', {})}
+        if 'toxicity' in kwargs:
+            json['toxicity'] = kwargs['toxicity']
+        self.api.post('/proxies/{}/toxics/{}'.format(self.name, name), json=json).json()
+
+    def destroy_toxic(self, toxic_name):
+        """ Destroy the given toxic """
+        return bool(self.api.delete('/proxies/{}/toxics/{}'.format(self.name, toxic_name)))
+
+    def enable(self):
+        """ Enable the proxy, so that it starts listening again """
+        self._set_enabled(True)
+
+    def disable(self):
+        """ Disable the proxy, dropping all active connections """
+        self._set_enabled(False)
+
+    def _set_enabled(self, enabled):
+        self.api.post('/proxies/{}'.format(self.name), json={'enabled': enabled}).json()
+        self.enabled = enabled
+
+
+class PooledToxiproxy(Toxiproxy):
+    """
+    A Toxiproxy server interface which talks to the API through its own
+    `PooledAPIConsumer`, and fetches single proxies directly instead of
+    listing every proxy on the server.
+    """
+    def __init__(self):
+        self.api = PooledAPIConsumer()
+
+    def proxies(self):
+        """
+        Retrieve all proxies registered with the server
+
+        Returns
+        -------
+        dict
+            Instances of PooledProxy() by name
+        """
+        return {
+            name: PooledProxy(self.api, **values)
+            for name, values in self.api.get('/proxies').json().items()
+            }
+
+    def get_proxy(self, proxy_name):
+        """
+        Retrieve a proxy by name
+
+        Parameters
+        ----------
+        str : proxy_name
+            The name of the proxy to fetch
+
+        Returns
+        -------
+        Instance of PooledProxy() if the proxy exists,
+        otherwise None is returned.
+        """
+        try:
+            values = self.api.get('/proxies/{}'.format(proxy_name)).json()
+        except NotFound:
+            return None
+        return PooledProxy(self.api, **values)
+
+    def update_api_consumer(self, host, port):
+        """
+        Point this client at another Toxiproxy server. Unlike the library
+        method, this leaves the class-level `APIConsumer` untouched.
+        """
+        self.api.host = host
+        self.api.port = port
+
+
 def _fetch_proxy():
     """
     Return a connection to the Toxiproxy instance which
@@ -60,25 +257,69 @@ def _fetch_proxy():
     environment variables defined: `TOXI_HOST`, `TOXI_PORT`,
     which represent the hostname and port respectively of the
     Toxiproxy server you wish to control.  If these are not
-    defined then this function will return None.
+    defined then the library defaults are used.
 
     Note
     ----
-    The proxy instance which is returned is *not* a singleton
-    and multiple calls will result in multiple proxy instances.
+    The proxy instance which is returned is shared by all callers
+    in the same process. It is created on first use in each worker
+    and talks to Toxiproxy over a pool of keep-alive connections.
 
     Returns
     -------
-    Instance of toxiproxy.server.Toxiproxy() if environment variables
-    are set, otherwise None is returned.
+    Instance of PooledToxiproxy()
     """
-    proxy_server = Toxiproxy()
+    pid = os.getpid()
+    if _client['pid'] != pid:
+        _client.update(pid=pid, addr=None, toxiproxy=PooledToxiproxy())
     if 'TOXI_HOST' in os.environ and 'TOXI_PORT' in os.environ:
-        proxy_server.update_api_consumer(os.environ['TOXI_HOST'], os.environ['TOXI_PORT'])
-    return proxy_server
+        addr = (os.environ['TOXI_HOST'], os.environ['TOXI_PORT'])
+        if addr != _client['addr']:
+            _client['toxiproxy'].update_api_consumer(*addr)
+            _client['addr'] = addr
+    return _client['toxiproxy']
+
+
+def _app_cache_key(name=None, denorm=None):
+    """
+    Build the cache key for a response from fetch_app(). Arguments
+    are taken from the current request if they are not given.
+    """
+    if name is None:
+        name = request.args.get('name')
+        denorm = request.args.get('denorm')
+    return 'dyno/app/{}/{}'.format(name, 1 if denorm else 0)
+
+
+def _apps_cache_key(full=None):
+    """
+    Build the cache key for a response from fetch_all_apps(). Arguments
+    are taken from the current request if they are not given.
+    """
+    if full is None:
+        full = request.args.get('full')
+    return 'dyno/apps/{}'.format(1 if full else 0)
+
+
+def _invalidate_proxy(name):
+    """
+    Remove all cached responses which describe a proxy
+
+    Parameters
+    ----------
+    str : name
+        The proxy which has been changed
+    """
+    cache.delete_many(
+        _app_cache_key(name, False),
+        _app_cache_key(name, True),
+        _apps_cache_key(False),
+        _apps_cache_key(True)
+        )
 
 
 @bp.route('/app', methods=['GET'])
+@cache.cached(key_prefix=_app_cache_key)
 def fetch_app():
     """
     Fetch the configured toxics for single Opbeans app
@@ -120,9 +361,7 @@ def fetch_app():
     """
     name = request.args.get('name')
     denorm = request.args.get('denorm')
-    toxiproxy = _fetch_proxy()
-    proxies = toxiproxy.proxies()
-    proxy = proxies.get(name)
+    proxy = _fetch_proxy().get_proxy(name)
     ret = {}
     if not proxy:
         return {}
@@ -143,6 +382,7 @@ def fetch_app():
 
 
 @bp.route('/apps', methods=['GET'])
+@cache.cached(key_prefix=_apps_cache_key)
 def fetch_all_apps():
     """
     Generate a list of the apps we have configured
@@ -246,6 +486,7 @@ def enable_proxy():
 
     toxiproxy = _fetch_proxy()
     toxiproxy.get_proxy(requested_proxy).enable()
+    _invalidate_proxy(requested_proxy)
 
     return {}
 
@@ -283,6 +524,7 @@ def disable_proxy():
     proxy = request.args.get('proxy')
     toxiproxy = _fetch_proxy()
     toxiproxy.get_proxy(proxy).disable()
+    _invalidate_proxy(proxy)
     return {}
 
 
@@ -299,6 +541,10 @@ def slide():
     In this scheme, `tox_code` is just shorthand for a particular
     toxic as described here: https://github.com/shopify/toxiproxy#toxics
 
+    If TOXI_FLUSH_INTERVAL is set, the adjustment is queued and applied
+    in the background. Only the latest queued value for each proxy and
+    toxic is sent to Toxiproxy.
+
     Note
     ----
     Exposed via HTTP at /api/control/apps
@@ -336,6 +582,9 @@ def slide():
     """
     # TODO fully document tox codes
     slide = request.get_json() or {}
+    if TOXI_FLUSH_INTERVAL > 0:
+        slide_queue.submit((slide.get('proxy'), slide['tox_code']), slide['val'])
+        return {}
     toxic_key = _decode_toxic(slide['tox_code'])
 
     t = _fetch_proxy()
@@ -343,10 +592,231 @@ def slide():
     normalized_val = _normalize_value(slide['tox_code'], slide['val'])
 
     # See if toxic exists
-    if not p.get_toxic('{}_downstream'.format(toxic_key['type'])):
+    exists = p.get_toxic('{}_downstream'.format(toxic_key['type']))
+    _apply_toxic(p, toxic_key['type'], {toxic_key['attr']: normalized_val}, exists)
+    _invalidate_proxy(slide.get('proxy'))
+    return {}
+
+
+@bp.route('/slide/batch', methods=['POST'])
+def slide_batch():
+    """
+    Apply a list of slider adjustments in a single request.
+
+    It should receive a JSON list of documents in the same form
+    as accepted by the /api/slide endpoint:
+    [{'proxy': 'postgres', 'tox_code': 'L', 'val': 10}, ...]
+
+    Adjustments are grouped by proxy. Each proxy has its toxics
+    listed once and adjustments to the same toxic are combined into
+    a single call. Proxies are updated concurrently.
+
+    Note
+    ----
+    Exposed via HTTP at /api/slide/batch
+    Supported HTTP methods: POST
+
+    Returns
+    -------
+    dict
+        A dictionary with a `results` list which holds one entry for each
+        adjustment, in the order received. Each entry has an `ok` field
+        and, if the adjustment failed, an `error` field. If the payload
+        is not a list of adjustments, nothing is applied and a 400 is
+        returned with an `error` field.
+
+    Examples
+    --------
+    > curl -s --header "Content-Type: application/json" \
+    --request POST \
+    --data '[{"tox_code":"L","proxy":"opbeans-python","val":100},
+             {"tox_code":"J","proxy":"opbeans-python","val":20}]' \
+    http://localhost:9000/api/slide/batch
+    {"results": [{"ok": true, "proxy": "opbeans-python", "tox_code": "L", "val": 100},
+                 {"ok": true, "proxy": "opbeans-python", "tox_code": "J", "val": 20}]}
+    """
+    slides = request.get_json() or []
+    if not isinstance(slides, list):
+        return {'error': 'Expected a list of adjustments'}, 400
+    for idx, slide in enumerate(slides):
+        error = _validate_slide(slide)
+        if error:
+            return {'error': 'Adjustment {}: {}'.format(idx, error)}, 400
+    return {'results': _apply_slides(slides)}
+
+
+def _validate_slide(slide):
+    """
+    Check that a slider adjustment has everything needed to apply it
+
+    Parameters
+    ----------
+    dict : slide
+        An adjustment as received by slide_batch()
+
+    Returns
+    -------
+    str
+        A description of the problem, or None if the adjustment is valid
+    """
+    if not isinstance(slide, dict):
+        return 'Expected an object with proxy, tox_code and val fields'
+    missing = [field for field in ('proxy', 'tox_code', 'val') if field not in slide]
+    if missing:
+        return 'Missing {}'.format(', '.join(missing))
+    if not isinstance(slide['proxy'], str) or not isinstance(slide['tox_code'], str):
+        return 'Expected proxy and tox_code to be strings'
+    if isinstance(slide['val'], bool) or not isinstance(slide['val'], (int, float)):
+        return 'Expected val to be a number'
+    return None
+
+
+def _apply_slides(slides):
+    """
+    Apply a list of slider adjustments, grouped by proxy. See slide_batch().
+
+    Parameters
+    ----------
+    list : slides
+        Dictionaries with `proxy`, `tox_code` and `val` keys
+
+    Returns
+    -------
+    list
+        A result entry for each adjustment, in the order received
+    """
+    results = [
+        {'proxy': s.get('proxy'), 'tox_code': s.get('tox_code'), 'val': s.get('val'), 'ok': True}
+        for s in slides
+        ]
+
+    by_proxy = {}
+    for idx, result in enumerate(results):
+        if not _decode_toxic(result['tox_code']):
+            result.update(ok=False, error='Unknown tox_code [{}]'.format(result['tox_code']))
+            continue
+        by_proxy.setdefault(result['proxy'], []).append(idx)
+
+    if by_proxy:
+        t = _fetch_proxy()
+        workers = min(len(by_proxy), TOXI_BATCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_slide_proxy, t, name, [results[idx] for idx in idxs])
+                for name, idxs in by_proxy.items()
+                ]
+            for future in futures:
+                future.result()
+        for name in by_proxy:
+            _invalidate_proxy(name)
+    return results
+
+
+def _flush_slides(pending):
+    """
+    Apply slider adjustments which were queued by slide()
+
+    Parameters
+    ----------
+    dict : pending
+        The latest value for each (proxy, tox_code) pair
+    """
+    slides = [
+        {'proxy': proxy, 'tox_code': tox_code, 'val': val}
+        for (proxy, tox_code), val in pending.items()
+        ]
+    # Flushes run outside of any request, but cached responses still need invalidating
+    with app.app.app_context():
+        results = _apply_slides(slides)
+    for result in results:
+        if not result['ok']:
+            logger.warning('Could not apply %s=%s to %s: %s',
+                           result['tox_code'], result['val'], result['proxy'], result['error'])
+
+
+"""
+When TOXI_FLUSH_INTERVAL is set to a number of seconds, adjustments received by
+slide() are queued and only the latest value for each proxy and toxic is sent
+to Toxiproxy, at most once per interval. Each worker process keeps its own queue,
+so this is best used with a single worker.
+"""
+TOXI_FLUSH_INTERVAL = float(os.environ.get('TOXI_FLUSH_INTERVAL', 0))
+slide_queue = Coalescer(_flush_slides, TOXI_FLUSH_INTERVAL)
+
+
+def _slide_proxy(t, proxy_name, results):
+    """
+    Apply a group of slider adjustments to a single proxy.
+
+    Failures are recorded in the `results` entries rather
+    than being raised.
+
+    Parameters
+    ----------
+    PooledToxiproxy : t
+        The Toxiproxy client
+
+    str : proxy_name
+        The proxy to modify
+
+    list : results
+        Result entries for the adjustments to apply, as built by slide_batch()
+    """
+    try:
+        p = t.get_proxy(proxy_name)
+        if not p:
+            raise Exception('Proxy [{}] not found'.format(proxy_name))
+        existing = p.toxics()
+    except Exception as e:
+        for result in results:
+            result.update(ok=False, error=str(e))
+        return
+
+    # Adjustments to the same toxic, such as latency and jitter, are sent together
+    by_type = {}
+    for result in results:
+        toxic_key = _decode_toxic(result['tox_code'])
+        try:
+            normalized_val = _normalize_value(result['tox_code'], result['val'])
+        except Exception as e:
+            result.update(ok=False, error=str(e))
+            continue
+        toxic = by_type.setdefault(toxic_key['type'], {'attributes': {}, 'results': []})
+        toxic['attributes'][toxic_key['attr']] = normalized_val
+        toxic['results'].append(result)
+
+    for toxic_type, toxic in by_type.items():
+        exists = '{}_downstream'.format(toxic_type) in existing
+        try:
+            _apply_toxic(p, toxic_type, toxic['attributes'], exists)
+        except Exception as e:
+            for result in toxic['results']:
+                result.update(ok=False, error=str(e))
+
+
+def _apply_toxic(p, toxic_type, attributes, exists):
+    """
+    Create a toxic on a proxy, or update it if it already exists
+
+    Parameters
+    ----------
+    toxiproxy.proxy.Proxy : p
+        The proxy to modify
+
+    str : toxic_type
+        A type of toxic. See the dict at the top of this file
+        for examples of toxic types
+
+    dict : attributes
+        The toxic attributes to set
+
+    bool : exists
+        Whether the toxic is already present on the proxy
+    """
+    if not exists:
         p.add_toxic(
-            type=toxic_key['type'],
-            attributes={toxic_key['attr']: normalized_val}
+            type=toxic_type,
+            attributes=attributes
             )
     else:
         """
@@ -355,25 +825,59 @@ def slide():
         https://github.com/cachedout/toxiproxy-python/
         """
         p.edit_toxic(
-           type=toxic_key['type'],
-           attributes={toxic_key['attr']: normalized_val}
+           type=toxic_type,
+           attributes=attributes
         )
-    return {}
 
 
 def _range():
     """
-    Helper function to deserialize the contents of the range.yml file
+    Helper function to fetch the contents of the range.yml file
+
+    The file is parsed once per process and only re-read when it
+    changes on disk. See `dyno.app.api.ranges` for details.
 
     Returns
     -------
     dict
         The contents of range.yml
     """
-    range_path = os.path.join(app.app.root_path, 'range.yml')
-    with open(range_path, 'r') as fh_:
-        slider_range = yaml.load(fh_, Loader=yaml.FullLoader)
-    return slider_range
+    return ranges.cache.range()
+
+
+def _slide_to_raw(lval, uval, val):
+    """
+    Convert a slider position into a raw toxic value given
+    the lower and upper bounds for the toxic.
+
+    Parameters
+    ----------
+    int : lval
+        The lower bound from range.yml
+
+    int : uval
+        The upper bound from range.yml
+
+    int : val
+        A value between 1-100
+
+    Returns
+    -------
+    int
+        A raw value between the bounds
+    """
+    val_range = abs(uval - lval) + 1
+    if lval < uval:
+        ret = abs(uval - int(val_range * (val / 100)))
+        if ret < 1:
+            ret = 1
+        return ret
+
+    ret = int(val_range * (val / 100))
+    if ret < 1:
+        ret = 1
+    return ret
+
 
 # TODO possibly swap names?
 def _denormalize_value(tox_code, val):
@@ -398,8 +902,7 @@ def _denormalize_value(tox_code, val):
         A value between 1-100 which corresponds to how much the input
         deviates from the mean.
     """
-    slider_range = _range()
-    lval, uval = slider_range[tox_code]
+    lval, uval = ranges.cache.bounds(tox_code)
     val_range = abs(uval - lval) + 1
     if lval < uval:
         return int(100 - ((val / val_range) * 100))
@@ -429,19 +932,7 @@ def _normalize_value(tox_code, val):
     int
         A raw value between the range of numbers specified in the range.yml file
     """
-    slider_range = _range()
-    lval, uval = slider_range[tox_code]
-    val_range = abs(uval - lval) + 1
-    if lval < uval:
-        ret = abs(uval - int(val_range * (val / 100)))
-        if ret < 1:
-            ret = 1
-        return ret
-
-    ret = int(val_range * (val / 100))
-    if ret < 1:
-        ret = 1
-    return ret
+    return ranges.cache.slider_to_raw(tox_code, val, _slide_to_raw)
 
 def _encode_toxic(toxic_type, attribute):
     """
@@ -17,10 +17,13 @@
 # specific language governing permissions and limitations
 
 import os
+import time
 import docker
-import yaml
-from dyno import app
+from concurrent.futures import ThreadPoolExecutor
 from flask import request
+from dyno.app.api import ranges
+from dyno.app.api.containers import ContainerSnapshot
+from dyno.app.cache import cache
 
 from flask import Blueprint
 
@@ -30,6 +33,25 @@ bp = Blueprint('docker', __name__)
 client = docker.from_env()
 low_client = docker.APIClient()
 
+# Maximum number of containers updated concurrently by /api/docker/update/batch
+DOCKER_BATCH_WORKERS = int(os.environ.get('DOCKER_BATCH_WORKERS', 4))
+
+snapshot = ContainerSnapshot(
+    lambda: [container.attrs for container in client.containers.list()],
+    lambda name: low_client.inspect_container(name),
+    lambda: client.events(decode=True, filters={'type': 'container'})
+    )
+
+
+def _query_cache_key(c=None):
+    """
+    Build the cache key for a response from query(). The container
+    is taken from the current request if it is not given.
+    """
+    if c is None:
+        c = request.args.get('c')
+    return 'dyno/docker/query/{}'.format(c)
+
 
 def _normalize_name(name):
     """
@@ -39,6 +61,9 @@ def _normalize_name(name):
     find it in a list of container names that are like:
     localtesting_7.9.0_elasticsearch
 
+    Names are resolved from a snapshot of running containers
+    which is kept current by the Docker events stream.
+
     Parameters
     ----------
     str : name
@@ -49,19 +74,11 @@ def _normalize_name(name):
     str
         The normalized name
     """
-    containers = container_list()
-    found = []
-    for container in containers['containers']:
-        if container.split('_').pop().strip() == name:
-            found.append(container)
-    if len(found) > 1:
-        raise Exception('Found more than one instance matching [{}]'.format(name))
-    if not found:
-        raise Exception('Could not normalize [{}] because it was not found in the container list')
-    return found[0]
+    return snapshot.lookup(name)
 
 
 @bp.route('/list', methods=['GET'])
+@cache.cached(key_prefix='dyno/docker/list')
 def container_list():
     """
     Return list of containers
@@ -70,6 +87,10 @@ def container_list():
     ----
     Exposed via HTTP at /api/docker/list
 
+    Note
+    ----
+    Containers are served from the snapshot kept by the Docker events stream.
+
     Note
     ----
     Paramaters are received query arguments in a Flask request object. They
@@ -100,14 +121,11 @@ def container_list():
       ]
     }
     """
-    ret = {'containers': []}
-    containers = client.containers.list()
-    for container in containers:
-        ret['containers'].append(container.name)
-    return ret
+    return {'containers': snapshot.names()}
 
 
 @bp.route('/query', methods=['GET'])
+@cache.cached(key_prefix=_query_cache_key)
 def query():
     """
     Inspect container and return information
@@ -116,6 +134,10 @@ def query():
     ----
     Exposed via HTTP at /api/docker/query
 
+    Note
+    ----
+    Configuration is served from the snapshot kept by the Docker events stream.
+
     Note
     ----
     Paramaters are received query arguments in a Flask request object. They
@@ -133,7 +155,7 @@ def query():
 
     """
     container = request.args.get('c')
-    config = low_client.inspect_container(_normalize_name(container))['HostConfig']
+    config = snapshot.host_config(_normalize_name(container))
     """
     cpu_quota (int) - Limit CPU CFS (Completely Fair Scheduler) quota
         -> HostConfig.CpuShares
@@ -160,40 +182,162 @@ def update():
     c: (str) The container name
 
     """
-    c = _normalize_name(request.args.get('c'))
+    name = request.args.get('c')
+    c = _normalize_name(name)
     component = request.args.get('component')
     val = int(request.args.get('val'))
     config = {
         'container': c,
-        'settings': {}
+        'settings': _settings(component, val)
     }
+    c = client.containers.get(config['container'])
+    c.update(**config['settings'])
+    snapshot.refresh(config['container'])
+    cache.delete(_query_cache_key(name))
+    return {}
+
+
+@bp.route('/update/batch', methods=['POST'])
+def update_batch():
+    """
+    Update the settings of several containers at once
+
+    It should receive a JSON document which maps container names
+    to the components to set, using the same values as /update:
+    {'opbeans-python': {'cpu': 50, 'mem': 20}, 'opbeans-go': {'cpu': 10}}
+
+    Containers are updated in parallel, with each container receiving
+    all of its settings in a single update.
+
+    Note
+    ----
+    Exposed via HTTP at /api/docker/update/batch
+    Supported HTTP methods: POST
+
+    Returns
+    -------
+    dict
+        A dictionary with a `results` key, which maps each container name
+        to a dict with an `ok` field, the time taken in `took_ms` and,
+        if the update failed, an `error` field. If the payload is not
+        a mapping of container names to settings, nothing is updated
+        and a 400 is returned with an `error` field.
+
+    Examples
+    --------
+    > curl -s --header "Content-Type: application/json" \
+    --request POST \
+    --data '{"opbeans-python": {"cpu": 50}, "opbeans-go": {"cpu": 50, "mem": 20}}' \
+    http://localhost:9000/api/docker/update/batch
+    {"results": {"opbeans-go": {"ok": true, "took_ms": 41.2},
+                 "opbeans-python": {"ok": true, "took_ms": 38.9}}}
+    """
+    updates = request.get_json() or {}
+    if not isinstance(updates, dict):
+        return {'error': 'Expected an object which maps container names to settings'}, 400
+    for name, components in updates.items():
+        if not isinstance(components, dict):
+            return {'error': 'Settings for [{}] must be an object'.format(name)}, 400
+    results = {}
+    if updates:
+        workers = min(len(updates), DOCKER_BATCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                name: executor.submit(_update_container, name, components)
+                for name, components in updates.items()
+                }
+            for name, future in futures.items():
+                results[name] = future.result()
+        cache.delete_many(*[_query_cache_key(name) for name in updates])
+    return {'results': results}
+
+
+def _update_container(name, components):
+    """
+    Apply a set of settings to a single container
+
+    Parameters
+    ----------
+    str : name
+        The short name of the container
+
+    dict : components
+        A mapping of components (`cpu`, `io` or `mem`) to values between 1-100
+
+    Returns
+    -------
+    dict
+        The outcome of the update and the time it took
+    """
+    start = time.monotonic()
+    ret = {'ok': True}
+    try:
+        container_name = _normalize_name(name)
+        settings = {}
+        for component, val in components.items():
+            settings.update(_settings(component, int(val)))
+        client.containers.get(container_name).update(**settings)
+        snapshot.refresh(container_name)
+    except Exception as e:
+        ret.update(ok=False, error=str(e))
+    ret['took_ms'] = round((time.monotonic() - start) * 1000, 1)
+    return ret
+
+
+def _settings(component, val):
+    """
+    Build the arguments to Container.update() for a component
+
+    Parameters
+    ----------
+    str : component
+        One of `cpu`, `io` or `mem`
+
+    int : val
+        A value between 1-100
+
+    Returns
+    -------
+    dict
+        Keyword arguments for Container.update()
+    """
+    settings = {}
     c = component.lower()
     if c == 'cpu':
-        config['settings']['cpu_quota'] = _normalize_value(c, val)
+        settings['cpu_quota'] = _normalize_value(c, val)
     if c == 'io':
-        config['settings']['blkio_weight'] = _normalize_value(c, val)
+        settings['blkio_weight'] = _normalize_value(c, val)
     if c == 'mem':
-        config['settings']['mem_limit'] = str(_normalize_value(c, val)) + "m"
-        config['settings']['memswap_limit'] = -1
-    c = client.containers.get(config['container'])
-    c.update(**config['settings'])
-    return {}
+        settings['mem_limit'] = str(_normalize_value(c, val)) + "m"
+        settings['memswap_limit'] = -1
+    return settings
+
 
 def _range():
-    range_path = os.path.join(app.app.root_path, 'range.yml')
-    with open(range_path, 'r') as fh_:
-        slider_range = yaml.load(fh_, Loader=yaml.FullLoader)
-    return slider_range
+    """
+    Helper function to fetch the contents of the range.yml file,
+    shared with the control blueprint through `dyno.app.api.ranges`.
+    """
+    return ranges.cache.range()
+
+
+def _slide_to_raw(lval, uval, val):
+    """
+    Convert a slider position into a raw container setting
+    """
+    ret = (((val) * max([lval, uval]) - min([lval, uval])) / 100) + min([lval, uval])
+    return int(ret)
+
 
 def _denormalize_value(code, val):
     """
     Take a current value and return the percentage val
     """
-    slider_range = _range()
-    lval, uval = slider_range[code]
+    lval, uval = ranges.cache.bounds(code)
     ret = ((val - min([uval, lval])) / (max([lval, uval]) - min([lval-uval]))) + 1
     return int(ret)
 
+
 def _normalize_value(code, val):
     """
     This uses the range.yml configuration file which populates
@@ -202,9 +346,4 @@ def _normalize_value(code, val):
     which is in the range of 0-100 and we turn that into an actual
     value to pass to the toxic
     """
-    slider_range = _range()
-
-    lval, uval = slider_range[code]
-
-    ret = (((val) * max([lval, uval]) - min([lval, uval])) / 100) + min([lval, uval])
-    return int(ret)
+    return ranges.cache.slider_to_raw(code, val, _slide_to_raw)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Live metrics for the Dyno UI
+
+A single sampler thread collects container stats from the Docker
+stats API and toxic state from Toxiproxy, and hands every sample to
+all subscribers. Clients receive the samples as Server-Sent Events, so
+any number of open browser tabs costs one set of Docker stats calls.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, stream_with_context
+from dyno.app.api import bp
+from dyno.app.api import control
+from dyno.app.api import docker as dkr
+
+logger = logging.getLogger(__name__)
+
+# Number of seconds between two samples
+METRICS_INTERVAL = float(os.environ.get('DYNO_METRICS_INTERVAL', 2))
+
+# Maximum number of containers sampled concurrently
+METRICS_WORKERS = int(os.environ.get('DYNO_METRICS_WORKERS', 8))
+
+
+class Sampler(object):
+    """
+    Run a sample function periodically and fan the results
+    out to every subscriber.
+
+    The sampler thread only runs while there is at least one subscriber.
+    Subscribers which fall behind only receive the most recent sample.
+
+    Parameters
+    ----------
+    callable : sample
+        Returns a JSON-serializable sample
+
+    float : interval
+        Number of seconds between two samples
+    """
+    def __init__(self, sample, interval):
+        self.sample = sample
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+
+    def subscribe(self):
+        """
+        Register a new subscriber
+
+        Returns
+        -------
+        queue.Queue
+            A queue which receives each new sample
+        """
+        q = queue.Queue(maxsize=1)
+        with self._lock:
+            self._subscribers.add(q)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='dyno-metrics', daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        """
+        Remove a subscriber
+
+        Parameters
+        ----------
+        queue.Queue : q
+            A queue returned by subscribe()
+        """
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, sample):
+        """
+        Hand a sample to every subscriber, replacing any sample
+        which the subscriber has not consumed yet
+
+        Parameters
+        ----------
+        object : sample
+            The sample to publish
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                q.put_nowait(sample)
+            except queue.Full:
+                pass
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            start = time.monotonic()
+            try:
+                self.publish(self.sample())
+            except Exception:
+                logger.exception('Failed to collect metrics')
+            time.sleep(max(0, self.interval - (time.monotonic() - start)))
+
+
+def _container_stats(name):
+    """
+    Summarize the Docker stats for a single container
+
+    Parameters
+    ----------
+    str : name
+        The full container name
+
+    Returns
+    -------
+    dict
+        CPU usage as a percentage of the host, memory usage and limit
+        in bytes and network bytes received and sent
+    """
+    stats = dkr.low_client.stats(name, stream=False)
+    cpu = stats.get('cpu_stats', {})
+    precpu = stats.get('precpu_stats', {})
+    cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - precpu.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    online_cpus = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or [1])
+    cpu_percent = 0.0
+    if cpu_delta > 0 and system_delta > 0:
+        cpu_percent = round(cpu_delta / system_delta * online_cpus * 100, 2)
+    networks = (stats.get('networks') or {}).values()
+    return {
+        'cpu_percent': cpu_percent,
+        'mem_usage': stats.get('memory_stats', {}).get('usage', 0),
+        'mem_limit': stats.get('memory_stats', {}).get('limit', 0),
+        'net_rx': sum(n.get('rx_bytes', 0) for n in networks),
+        'net_tx': sum(n.get('tx_bytes', 0) for n in networks),
+    }
+
+
+def _proxy_state():
+    """
+    Collect the toxics which are set on each proxy
+
+    Returns
+    -------
+    dict
+        A mapping of proxy names to whether the proxy is enabled and
+        the raw value of each toxic, keyed by tox code
+    """
+    ret = {}
+    for name, proxy in control._fetch_proxy().proxies().items():
+        toxics = {}
+        for toxic in proxy.toxics().values():
+            for attribute, value in toxic.attributes.items():
+                tox_code = control._encode_toxic(toxic.type, attribute)
+                if tox_code:
+                    toxics[tox_code] = value
+        ret[name] = {'enabled': proxy.enabled, 'toxics': toxics}
+    return ret
+
+
+def _sample():
+    """
+    Collect one sample of container stats and proxy state
+
+    Returns
+    -------
+    dict
+        The sample, as sent to subscribers
+    """
+    ret = {'time': time.time(), 'containers': {}, 'proxies': {}}
+    names = dkr.snapshot.names()
+    if names:
+        with ThreadPoolExecutor(max_workers=min(len(names), METRICS_WORKERS)) as executor:
+            futures = {name: executor.submit(_container_stats, name) for name in names}
+            for name, future in futures.items():
+                try:
+                    ret['containers'][name] = future.result()
+                except Exception as e:
+                    logger.debug('Could not fetch stats for %s: %s', name, e)
+    try:
+        ret['proxies'] = _proxy_state()
+    except Exception as e:
+        logger.debug('Could not fetch proxy state: %s', e)
+    return ret
+
+
+sampler = Sampler(_sample, METRICS_INTERVAL)
+
+
+def _streaming_supported():
+    """
+    Whether this process can serve long-lived streams.
+
+    A sync gunicorn worker is tied up for as long as a stream is open,
+    and is killed mid-stream once the gunicorn timeout expires. Each
+    worker process would also run its own sampler. Streams are only
+    served when DYNO_WORKER_CLASS, as exported by entrypoint.sh, is
+    gevent, or when it is unset, such as under the Flask dev server.
+
+    Returns
+    -------
+    bool
+        True if /api/metrics/stream may be served
+    """
+    return os.environ.get('DYNO_WORKER_CLASS', 'gevent') == 'gevent'
+
+
+@bp.route('/metrics/stream', methods=['GET'])
+def metrics_stream():
+    """
+    Stream live container and proxy metrics
+
+    Samples are sent as Server-Sent Events, every DYNO_METRICS_INTERVAL
+    seconds. All clients share a single sampler.
+
+    Streaming requires the gevent worker class (`--dyno-worker-class gevent`),
+    which runs a single worker. With sync workers a 501 is returned instead.
+
+    Note
+    ----
+    Exposed via HTTP at /api/metrics/stream
+    Supported HTTP methods: GET
+
+    Returns
+    -------
+    flask.Response
+        A text/event-stream response, or a 501 with an `error` field
+        when running with sync workers
+
+    Examples
+    --------
+    > curl -sN http://localhost:9000/api/metrics/stream
+    data: {"containers": {"localtesting_8.0.0_opbeans-python": {"cpu_percent": 1.52, ...}},
+           "proxies": {"opbeans-python": {"enabled": true, "toxics": {"L": 100}}}, "time": 1609777451.2}
+    """
+    if not _streaming_supported():
+        return {'error': 'Streaming metrics requires the gevent worker class, '
+                         'start with --dyno-worker-class gevent'}, 501
+
+    def generate():
+        q = sampler.subscribe()
+        try:
+            while True:
+                yield 'data: {}\n\n'.format(json.dumps(q.get(), sort_keys=True))
+        finally:
+            sampler.unsubscribe(q)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Process-wide cache for the slider ranges described in range.yml
+
+Both the control and the docker blueprints need the contents of
+range.yml to convert between slider positions and raw values. The
+file is parsed once and then only re-read when its modification time
+changes, so edits to range.yml are still picked up by a running server.
+"""
+import os
+import threading
+import yaml
+
+RANGE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'range.yml'
+    )
+
+# Sliders move between these two positions, inclusive
+SLIDER_MIN = 0
+SLIDER_MAX = 100
+
+
+class RangeCache(object):
+    """
+    Holds the parsed contents of a range file along with
+    precomputed slider-to-raw lookup tables for each code.
+
+    Parameters
+    ----------
+    str : path
+        Path to the range file to load
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._range = {}
+        self._tables = {}
+
+    def _refresh(self):
+        """
+        Reload the range file if it has changed on disk since
+        it was last read. Cached lookup tables are discarded on reload.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with open(self.path, 'r') as fh_:
+                slider_range = yaml.load(fh_, Loader=yaml.FullLoader)
+            self._range = slider_range
+            self._tables = {}
+            self._mtime = mtime
+
+    def range(self):
+        """
+        Return the contents of the range file
+
+        Returns
+        -------
+        dict
+            A mapping of codes to a two-element list of [lower, upper] bounds
+        """
+        self._refresh()
+        return self._range
+
+    def bounds(self, code):
+        """
+        Return the bounds for a single code
+
+        Parameters
+        ----------
+        str : code
+            A toxic code or a docker setting such as `cpu`
+
+        Returns
+        -------
+        tuple
+            The (lower, upper) bounds as listed in the range file
+        """
+        lval, uval = self.range()[code]
+        return lval, uval
+
+    def slider_to_raw(self, code, val, normalizer):
+        """
+        Convert a slider position into a raw value for a code.
+
+        Every slider position for a code is computed once with the given
+        `normalizer` and then served from a lookup table. Values which are
+        not integer slider positions are computed directly.
+
+        Parameters
+        ----------
+        str : code
+            A toxic code or a docker setting such as `cpu`
+
+        int : val
+            The slider position, between 0-100
+
+        callable : normalizer
+            A function taking (lval, uval, val) and returning a raw value
+
+        Returns
+        -------
+        int
+            The raw value for the slider position
+        """
+        lval, uval = self.bounds(code)
+        if not isinstance(val, int) or not SLIDER_MIN <= val <= SLIDER_MAX:
+            return normalizer(lval, uval, val)
+        key = (code, normalizer)
+        table = self._tables.get(key)
+        if table is None:
+            table = [normalizer(lval, uval, pos) for pos in range(SLIDER_MIN, SLIDER_MAX + 1)]
+            self._tables[key] = table
+        return table[val - SLIDER_MIN]
+
+
+cache = RangeCache(RANGE_PATH)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Response cache for the read-only Dyno endpoints
+
+Cached responses are keyed on the query arguments of the request.
+Every route which changes a proxy or a container deletes the keys
+it affects, so reads which follow a write are never stale. The cache
+is shared by all worker processes, see `dyno.app.cfg`.
+"""
+from flask_caching import Cache
+
+cache = Cache()
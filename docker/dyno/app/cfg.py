@@ -15,8 +15,36 @@
 # "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitationsi
-import yaml
+import os
+import tempfile
+
+
+def _cache_timeout():
+    """
+    Seconds for which responses are cached. Flask-Caching treats 0 as
+    "never expire", so here it turns caching off instead.
+    """
+    timeout = int(os.environ.get('DYNO_CACHE_TIMEOUT', 2))
+    if timeout < 0:
+        raise ValueError('DYNO_CACHE_TIMEOUT must be 0 (disabled) or a number of seconds, got {}'.format(timeout))
+    return timeout
+
+
+def _cache_dir():
+    """
+    A directory shared by every gunicorn worker in the container, in
+    memory when /dev/shm is available
+    """
+    if 'DYNO_CACHE_DIR' in os.environ:
+        return os.environ['DYNO_CACHE_DIR']
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'dyno-cache')
 
 
 class Config(object):
-    pass
+    # Responses from the read-only endpoints are cached for a short time. The
+    # cache lives on disk rather than in each worker process, so that a write
+    # handled by one worker invalidates the cached responses of all of them.
+    CACHE_DEFAULT_TIMEOUT = _cache_timeout()
+    CACHE_TYPE = 'FileSystemCache' if CACHE_DEFAULT_TIMEOUT else 'NullCache'
+    CACHE_DIR = _cache_dir()
@@ -1,3 +1,15 @@
 #!/bin/bash
-echo "Staring server.."
-gunicorn -b 0.0.0.0 dyno.app:app --capture-output  -t 90 -w 8 --reload
+# DYNO_WORKER_CLASS selects the gunicorn worker model:
+#   sync   - one request at a time per worker process (default)
+#   gevent - cooperative workers which keep serving other requests
+#            while waiting on the Docker socket or the Toxiproxy API
+# The API reads DYNO_WORKER_CLASS to refuse streaming endpoints under sync workers.
+export DYNO_WORKER_CLASS=${DYNO_WORKER_CLASS:-sync}
+if [ "${DYNO_WORKER_CLASS}" = "sync" ]; then
+  DYNO_WORKERS=${DYNO_WORKERS:-8}
+else
+  DYNO_WORKERS=${DYNO_WORKERS:-1}
+fi
+echo "Staring server with ${DYNO_WORKERS} ${DYNO_WORKER_CLASS} worker(s).."
+gunicorn -b 0.0.0.0 dyno.app:app --capture-output  -t 90 -w "${DYNO_WORKERS}" -k "${DYNO_WORKER_CLASS}" \
+  --worker-connections "${DYNO_WORKER_CONNECTIONS:-1000}" --reload
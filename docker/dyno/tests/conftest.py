@@ -42,6 +42,15 @@ def app():
     dyno_app = dyno.app.create_app()
     return dyno_app
 
+@pytest.fixture(autouse=True)
+def clear_cache(app):
+    """
+    Start every test without any cached responses
+    """
+    from dyno.app.cache import cache
+    with app.app_context():
+        cache.clear()
+
 @pytest.fixture
 def range_stub(monkeypatch):
     """
@@ -50,6 +59,19 @@ def range_stub(monkeypatch):
     stub  = {'Fr': [1, 10]}
     return stub
 
+@pytest.fixture
+def range_cache(range_stub, tmp_path, monkeypatch):
+    """
+    Replace the process-wide range cache with one which is
+    backed by a file containing the range stub
+    """
+    from dyno.app.api import ranges
+    range_file = tmp_path / 'range.yml'
+    range_file.write_text(yaml.dump(range_stub))
+    cache = ranges.RangeCache(str(range_file))
+    monkeypatch.setattr(ranges, 'cache', cache)
+    return cache
+
 @pytest.fixture
 def toxi_default_environment(monkeypatch):
     """
@@ -59,6 +81,16 @@ def toxi_default_environment(monkeypatch):
     monkeypatch.setenv("TOXI_HOST", "dummy_toxi_host")
     monkeypatch.setenv("TOXI_PORT", "1648")
 
+@pytest.fixture
+def toxi_client(monkeypatch):
+    """
+    Start from a fresh Toxiproxy client, rather than the one
+    shared by the worker process
+    """
+    from dyno.app.api import control
+    monkeypatch.setattr(control, '_client', {'pid': None, 'addr': None, 'toxiproxy': None})
+    return control._client
+
 @pytest.fixture
 def fetch_proxy_mock():
     # Put the Toxiproxy mock into a container mock for use in 
@@ -95,6 +127,8 @@ def toxi_mock():
     p.toxics = toxic_mock
     # Overlay a dictionary as a return for the .proxies() function to Toxiproxy
     toxi_mock.proxies = lambda: {'fake_proxy': p}
+    # Single proxies are fetched directly by name
+    toxi_mock.get_proxy = lambda name: toxi_mock.proxies().get(name)
     # Put the Toxiproxy mock into a container mock for use in 
     #fetch_proxy_mock = mock.MagicMock(return_value=toxi_mock)
 
@@ -102,6 +136,21 @@ def toxi_mock():
     return toxi_mock
 
 
+@pytest.fixture
+def container_snapshot(monkeypatch):
+    """
+    Replace the container snapshot with one which is not fed by the
+    Docker events stream and so always queries the Docker client
+    """
+    from dyno.app.api import docker as dkr
+    from dyno.app.api.containers import ContainerSnapshot
+    snapshot = ContainerSnapshot(
+        lambda: [c.attrs for c in dkr.client.containers.list()],
+        lambda name: dkr.low_client.inspect_container(name)
+        )
+    monkeypatch.setattr(dkr, 'snapshot', snapshot)
+    return snapshot
+
 @pytest.fixture
 def docker_inspect():
     """
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Load test comparing the sync and gevent worker models for Dyno
+
+This starts Dyno under gunicorn once per worker model, in front of a
+stand-in Toxiproxy API which answers every call after a fixed delay, and
+drives both with the same concurrent load. It needs gunicorn, gevent and
+a reachable Docker daemon, and only runs when DYNO_LOAD_TEST is set:
+
+    DYNO_LOAD_TEST=1 pytest -s dyno/tests/load
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import urlopen
+
+import pytest
+
+pytestmark = [
+    pytest.mark.dyno,
+    pytest.mark.skipif(not os.environ.get('DYNO_LOAD_TEST'), reason='set DYNO_LOAD_TEST to run load tests'),
+]
+
+# Delay added to every Toxiproxy API call, in seconds
+TOXI_DELAY = float(os.environ.get('DYNO_LOAD_TEST_DELAY', 0.1))
+REQUESTS = int(os.environ.get('DYNO_LOAD_TEST_REQUESTS', 400))
+CONCURRENCY = int(os.environ.get('DYNO_LOAD_TEST_CONCURRENCY', 64))
+
+PROXY = {'name': 'opbeans-python', 'listen': '[::]:8000', 'upstream': 'opbeans-python:3000', 'enabled': True}
+
+
+class SlowToxiproxy(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(TOXI_DELAY)
+        if self.path == '/proxies':
+            body = {PROXY['name']: dict(PROXY, toxics=[])}
+        elif self.path.endswith('/toxics'):
+            body = []
+        else:
+            body = dict(PROXY, toxics=[])
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _rss_kb(pid):
+    """
+    Resident memory of a process and its children, in kB
+    """
+    total = 0
+    children = subprocess.run(['pgrep', '-P', str(pid)], stdout=subprocess.PIPE).stdout.split()
+    for p in [str(pid)] + [c.decode() for c in children]:
+        try:
+            with open('/proc/{}/status'.format(p)) as fh_:
+                for line in fh_:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+@pytest.fixture(scope='module')
+def toxiproxy():
+    server = ThreadingServer(('127.0.0.1', 0), SlowToxiproxy)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+def _run(worker_class, workers, toxi_port):
+    port = _free_port()
+    # Caching is off, so that every request reaches the slow Toxiproxy and exercises the worker model
+    env = dict(os.environ, TOXI_HOST='127.0.0.1', TOXI_PORT=str(toxi_port), DYNO_CACHE_TIMEOUT='0')
+    cwd = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-b', '127.0.0.1:{}'.format(port), '-w', str(workers),
+         '-k', worker_class, '--worker-connections', '1000', '-t', '90', 'dyno.app:app'],
+        cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    url = 'http://127.0.0.1:{}/api/app?name=opbeans-python'.format(port)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urlopen(url).read()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+        def fetch(_):
+            start = time.monotonic()
+            urlopen(url, timeout=120).read()
+            return time.monotonic() - start
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+            latencies = sorted(executor.map(fetch, range(REQUESTS)))
+        elapsed = time.monotonic() - start
+        return {
+            'mode': '{} x{}'.format(worker_class, workers),
+            'rps': REQUESTS / elapsed,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+            'rss_mb': _rss_kb(proc.pid) / 1024,
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def test_worker_modes(toxiproxy):
+    """
+    GIVEN Dyno served by 8 sync workers and by a single gevent worker
+    WHEN both receive the same concurrent load against a slow Toxiproxy
+    THEN the gevent worker serves more requests per second
+    """
+    pytest.importorskip('gunicorn')
+    pytest.importorskip('gevent')
+    results = [_run('sync', 8, toxiproxy), _run('gevent', 1, toxiproxy)]
+    print()
+    print('{:<12} {:>8} {:>9} {:>9} {:>8}'.format('mode', 'req/s', 'p50 ms', 'p99 ms', 'RSS MB'))
+    for r in results:
+        print('{mode:<12} {rps:>8.1f} {p50_ms:>9.1f} {p99_ms:>9.1f} {rss_mb:>8.1f}'.format(**r))
+    sync, gevent = results
+    assert gevent['rps'] > sync['rps']
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Tests for the Dyno update coalescer
+"""
+import threading
+from unittest import mock
+from dyno.app.api.coalesce import Coalescer
+
+
+def test_last_write_wins():
+    """
+    GIVEN several values submitted for the same key
+    WHEN the coalescer is drained
+    THEN only the latest value for each key is flushed
+    """
+    flush = mock.Mock()
+    coalescer = Coalescer(flush, 60)
+    with mock.patch.object(coalescer, '_ensure_thread'):
+        for val in range(10):
+            coalescer.submit(('opbeans-python', 'L'), val)
+        coalescer.submit(('postgres', 'L'), 5)
+    coalescer.drain()
+    flush.assert_called_once_with({('opbeans-python', 'L'): 9, ('postgres', 'L'): 5})
+
+
+def test_drain_empty():
+    """
+    GIVEN a coalescer with nothing pending
+    WHEN the coalescer is drained
+    THEN the flush function is not called
+    """
+    flush = mock.Mock()
+    Coalescer(flush, 60).drain()
+    flush.assert_not_called()
+
+
+def test_background_flush():
+    """
+    GIVEN a coalescer with a running flush thread
+    WHEN a value is submitted
+    THEN the value is flushed in the background
+    """
+    flushed = threading.Event()
+    coalescer = Coalescer(lambda pending: flushed.set(), 0.01)
+    coalescer.submit('key', 'val')
+    assert flushed.wait(5)
@@ -19,14 +19,16 @@
 """
 Tests for the Openbeans Dyno
 """
+import threading
 import toxiproxy
-from pytest import mark
+from pytest import mark, raises
 from unittest import mock
 from flask import url_for
 import dyno.app.api.control as ctl
+from dyno.app import cfg, create_app
 
-@mock.patch('toxiproxy.server.Toxiproxy.update_api_consumer')
-def test_fetch_proxy_update_consumer(consumer_patch, toxi_default_environment):
+@mock.patch('dyno.app.api.control.PooledToxiproxy.update_api_consumer')
+def test_fetch_proxy_update_consumer(consumer_patch, toxi_default_environment, toxi_client):
     """
     GIVEN an environment with TOXI_HOST or TOXI_PORT set
     WHEN the _fetch_proxy() helper function is called
@@ -37,8 +39,8 @@ def test_fetch_proxy_update_consumer(consumer_patch, toxi_default_environment):
 
 
 @mark.parametrize('toxi_env', ['TOXI_HOST', 'TOXI_PORT'])
-@mock.patch('toxiproxy.server.Toxiproxy.update_api_consumer')
-def test_fetch_proxy_no_update_consumer(consumer_patch, toxi_default_environment, toxi_env, monkeypatch):
+@mock.patch('dyno.app.api.control.PooledToxiproxy.update_api_consumer')
+def test_fetch_proxy_no_update_consumer(consumer_patch, toxi_default_environment, toxi_env, monkeypatch, toxi_client):
     """
     GIVEN an environment without both TOXI_HOST and TOXI_PORT set
     WHEN the _fetch_proxy() helper function is called
@@ -48,6 +50,81 @@ def test_fetch_proxy_no_update_consumer(consumer_patch, toxi_default_environment
     ctl._fetch_proxy()
     consumer_patch.assert_not_called()
 
+@mock.patch('dyno.app.api.control.PooledToxiproxy.update_api_consumer')
+def test_fetch_proxy_reused(consumer_patch, toxi_default_environment, toxi_client):
+    """
+    GIVEN an environment with TOXI_HOST and TOXI_PORT set
+    WHEN the _fetch_proxy() helper function is called repeatedly
+    THEN the same proxy is returned and the api consumer is only updated once
+    """
+    assert ctl._fetch_proxy() is ctl._fetch_proxy()
+    consumer_patch.assert_called_once()
+
+@mock.patch('dyno.app.api.control.PooledAPIConsumer.get')
+def test_pooled_get_proxy(get_patch, toxi_client):
+    """
+    GIVEN a proxy name
+    WHEN the proxy is requested from the pooled client
+    THEN only that proxy is fetched from the Toxiproxy API
+    """
+    get_patch.return_value.json.return_value = {
+        'name': 'opbeans-python',
+        'listen': '[::]:8000',
+        'upstream': 'opbeans-python:3000',
+        'enabled': True,
+        'toxics': [],
+        }
+    proxy = ctl._fetch_proxy().get_proxy('opbeans-python')
+    get_patch.assert_called_once_with('/proxies/opbeans-python')
+    assert proxy.name == 'opbeans-python'
+
+@mock.patch('dyno.app.api.control.PooledAPIConsumer.get', side_effect=toxiproxy.exceptions.NotFound)
+def test_pooled_get_proxy_not_found(get_patch, toxi_client):
+    """
+    GIVEN a proxy name which does not exist
+    WHEN the proxy is requested from the pooled client
+    THEN None is returned
+    """
+    assert ctl._fetch_proxy().get_proxy('missing') is None
+
+def test_pooled_client_own_consumer(toxi_default_environment, toxi_client):
+    """
+    GIVEN an environment with TOXI_HOST and TOXI_PORT set
+    WHEN the pooled client is created
+    THEN it has its own api consumer and the toxiproxy library is left untouched
+    """
+    t = ctl._fetch_proxy()
+    assert (t.api.host, t.api.port) == ('dummy_toxi_host', '1648')
+    assert toxiproxy.api.requests is ctl.requests
+    assert (toxiproxy.api.APIConsumer.host, toxiproxy.api.APIConsumer.port) == ('127.0.0.1', 8474)
+
+def test_pooled_client_sessions(toxi_client):
+    """
+    GIVEN the pooled client
+    WHEN it is used from several threads
+    THEN each thread has its own session, all sharing one connection pool
+    """
+    api = ctl._fetch_proxy().api
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(api.session))
+    thread.start()
+    thread.join()
+    assert api.session is api.session
+    assert sessions[0] is not api.session
+    assert sessions[0].get_adapter('http://toxi') is api.session.get_adapter('http://toxi') is api.adapter
+
+def test_pooled_proxy_edit_toxic(toxi_client):
+    """
+    GIVEN a proxy from the pooled client
+    WHEN an existing toxic is edited
+    THEN its attributes are posted to the toxic
+    """
+    api = mock.Mock(spec=ctl.PooledAPIConsumer)
+    proxy = ctl.PooledProxy(api, name='postgres', listen='[::]:5432', upstream='postgres:5432', enabled=True)
+    proxy.edit_toxic(type='latency', attributes={'latency': 100})
+    api.post.assert_called_once_with('/proxies/postgres/toxics/latency_downstream',
+                                     json={'attributes': {'latency': 100}})
+
 @mark.parametrize('toxi_code', ctl.toxic_map.keys())
 def test_decode_toxi(toxi_code):
     """
@@ -82,6 +159,72 @@ def test_get_app(fetch_proxy_mock, client):
                 'upstream': 'fake_upstream'
                 }
 
+def test_get_app_cached(fetch_proxy_mock, client):
+    """
+    GIVEN an HTTP client
+    WHEN that client requests the /app endpoint repeatedly and then enables the proxy
+    THEN Toxiproxy is only queried again after the proxy has been changed
+    """
+    with mock.patch('dyno.app.api.control._fetch_proxy', fetch_proxy_mock):
+        for _ in range(3):
+            res = client.get(url_for('api.fetch_app'), query_string={'name': 'fake_proxy'})
+            assert res.json['name'] == 'opbeans-proxy'
+        assert fetch_proxy_mock.call_count == 1
+        ctl._invalidate_proxy('fake_proxy')
+        client.get(url_for('api.fetch_app'), query_string={'name': 'fake_proxy'})
+        assert fetch_proxy_mock.call_count == 2
+
+def test_cache_shared_between_workers(fetch_proxy_mock, tmp_path):
+    """
+    GIVEN two worker processes serving the Dyno API
+    WHEN one of them changes a proxy
+    THEN the other one no longer serves its cached response
+    """
+    class Config(cfg.Config):
+        CACHE_DIR = str(tmp_path)
+
+    workers = [create_app(Config).test_client() for _ in range(2)]
+    with mock.patch('dyno.app.api.control._fetch_proxy', fetch_proxy_mock):
+        for worker in workers:
+            worker.get('/api/app', query_string={'name': 'fake_proxy'})
+        assert fetch_proxy_mock.call_count == 1
+        with workers[0].application.app_context():
+            ctl._invalidate_proxy('fake_proxy')
+        workers[1].get('/api/app', query_string={'name': 'fake_proxy'})
+        assert fetch_proxy_mock.call_count == 2
+
+@mark.parametrize('timeout,want', [('2', 2), ('0', 0)])
+def test_cache_timeout(timeout, want, monkeypatch):
+    """
+    GIVEN a DYNO_CACHE_TIMEOUT
+    WHEN the cache timeout is read
+    THEN 0 is kept, to turn caching off rather than caching forever
+    """
+    monkeypatch.setenv('DYNO_CACHE_TIMEOUT', timeout)
+    assert cfg._cache_timeout() == want
+
+def test_cache_timeout_negative(monkeypatch):
+    """
+    GIVEN a negative DYNO_CACHE_TIMEOUT
+    WHEN the cache timeout is read
+    THEN it is rejected
+    """
+    monkeypatch.setenv('DYNO_CACHE_TIMEOUT', '-1')
+    with raises(ValueError):
+        cfg._cache_timeout()
+
+def test_enable_invalidates(client):
+    """
+    GIVEN an HTTP client
+    WHEN that client requests the /enable endpoint
+    THEN cached responses for the proxy are removed
+    """
+    t_ = mock.Mock(spec=toxiproxy.Toxiproxy)
+    with mock.patch('dyno.app.api.control._fetch_proxy', return_value=t_), \
+            mock.patch('dyno.app.api.control._invalidate_proxy') as invalidate_mock:
+        client.get(url_for('api.enable_proxy'), query_string={'proxy': 'postgres'})
+        invalidate_mock.assert_called_once_with('postgres')
+
 def test_get_apps(fetch_proxy_mock, client):
     """
     GIVEN an HTTP client
@@ -166,9 +309,107 @@ def test_slide_exception_side_effect(toxi_code, client):
             proxy_mock.add_toxic.assert_called()
             proxy_mock.destroy_toxic.assert_called()
 
+def test_slide_coalesced(client, monkeypatch):
+    """
+    GIVEN a flush interval for slider adjustments
+    WHEN that client hits the /slide endpoint
+    THEN the adjustment is queued rather than applied
+    """
+    monkeypatch.setattr(ctl, 'TOXI_FLUSH_INTERVAL', 0.5)
+    with mock.patch.object(ctl.slide_queue, 'submit') as submit_mock, \
+            mock.patch('dyno.app.api.control._fetch_proxy') as fetch_mock:
+        client.post(url_for('api.slide'), json={'proxy': 'postgres', 'tox_code': 'L', 'val': 100})
+        submit_mock.assert_called_once_with(('postgres', 'L'), 100)
+        fetch_mock.assert_not_called()
+
+def test_flush_slides():
+    """
+    GIVEN queued slider adjustments
+    WHEN they are flushed
+    THEN they are applied as a batch
+    """
+    with mock.patch('dyno.app.api.control._apply_slides', return_value=[]) as apply_mock:
+        ctl._flush_slides({('postgres', 'L'): 10})
+        apply_mock.assert_called_once_with([{'proxy': 'postgres', 'tox_code': 'L', 'val': 10}])
+
+def test_slide_batch(client):
+    """
+    GIVEN an HTTP client
+    WHEN that client hits the /slide/batch endpoint with adjustments for several proxies
+    THEN each proxy is adjusted once per toxic and a result is returned for each adjustment
+    """
+    # edit_toxic() is only available in the forked toxiproxy library
+    proxies = {
+        'opbeans-python': mock.Mock(spec=toxiproxy.proxy.Proxy),
+        'postgres': mock.Mock(),
+        }
+    proxies['opbeans-python'].toxics.return_value = {}
+    proxies['postgres'].toxics.return_value = {'bandwidth_downstream': mock.Mock()}
+    t_ = mock.Mock(spec=toxiproxy.Toxiproxy)
+    t_.get_proxy.side_effect = proxies.get
+    slides = [
+        {'proxy': 'opbeans-python', 'tox_code': 'L', 'val': 100},
+        {'proxy': 'opbeans-python', 'tox_code': 'J', 'val': 100},
+        {'proxy': 'postgres', 'tox_code': 'B', 'val': 100},
+        ]
+    with mock.patch('dyno.app.api.control._fetch_proxy', return_value=t_):
+        res = client.post(url_for('api.slide_batch'), json=slides)
+    assert [r['ok'] for r in res.json['results']] == [True, True, True]
+    proxies['opbeans-python'].add_toxic.assert_called_once_with(
+        type='latency',
+        attributes={
+            'latency': ctl._normalize_value('L', 100),
+            'jitter': ctl._normalize_value('J', 100)
+            }
+        )
+    proxies['postgres'].edit_toxic.assert_called_once_with(
+        type='bandwidth',
+        attributes={'rate': ctl._normalize_value('B', 100)}
+        )
+
+def test_slide_batch_errors(client):
+    """
+    GIVEN an HTTP client
+    WHEN that client hits the /slide/batch endpoint with an unknown proxy and tox code
+    THEN the failed adjustments are reported in the results
+    """
+    t_ = mock.Mock(spec=toxiproxy.Toxiproxy)
+    t_.get_proxy.return_value = None
+    slides = [
+        {'proxy': 'missing', 'tox_code': 'L', 'val': 100},
+        {'proxy': 'missing', 'tox_code': 'nope', 'val': 100},
+        ]
+    with mock.patch('dyno.app.api.control._fetch_proxy', return_value=t_):
+        res = client.post(url_for('api.slide_batch'), json=slides)
+    results = res.json['results']
+    assert [r['ok'] for r in results] == [False, False]
+    assert 'not found' in results[0]['error']
+    assert 'Unknown tox_code' in results[1]['error']
+
+@mark.parametrize('slides', [
+    {'proxy': 'postgres', 'tox_code': 'L', 'val': 100},
+    ['postgres'],
+    [{'proxy': 'postgres', 'tox_code': 'L'}],
+    [{'proxy': ['postgres'], 'tox_code': 'L', 'val': 100}],
+    [{'proxy': {'name': 'postgres'}, 'tox_code': 'L', 'val': 100}],
+    [{'proxy': 'postgres', 'tox_code': 1, 'val': 100}],
+    [{'proxy': 'postgres', 'tox_code': 'L', 'val': '100'}],
+    [{'proxy': 'postgres', 'tox_code': 'L', 'val': True}],
+    ])
+def test_slide_batch_invalid(slides, client):
+    """
+    GIVEN an HTTP client
+    WHEN that client hits the /slide/batch endpoint with a malformed payload
+    THEN a 400 is returned and no proxy is adjusted
+    """
+    with mock.patch('dyno.app.api.control._fetch_proxy') as fetch_proxy_mock:
+        res = client.post(url_for('api.slide_batch'), json=slides)
+    assert res.status_code == 400
+    assert res.json['error']
+    fetch_proxy_mock.assert_not_called()
+
 @mark.parametrize('val', range(1,101, 10))
-@mock.patch('dyno.app.api.control._range', mock.Mock(return_value={'Fr': [1,10]}))
-def test_normalize(val):
+def test_normalize(val, range_cache):
     """
     GIVEN values between 1-100
     WHEN the value is sent to be normalized
@@ -179,8 +420,7 @@ def test_normalize(val):
     assert got == want
 
 @mark.parametrize('val', range(1,10))
-@mock.patch('dyno.app.api.control._range', mock.Mock(return_value={'Fr': [1,10]}))
-def test_denormalize(val):
+def test_denormalize(val, range_cache):
     """
     GIVEN values between 1-100
     WHEN the value is sent to be denormalized
@@ -19,51 +19,112 @@
 """
 Tests for the Openbeans Dyno Docker integration
 """
+import os
+import threading
 from pytest import mark, raises
 from unittest import mock
 from flask import url_for
 import dyno.app.api.docker as dkr
+from dyno.app.api.containers import ContainerSnapshot
 
 CONTAINER_NAME_FUZZ = ['a_foo', 'b__foo', '_c_foo']
 
+
+def _containers(names):
+    """
+    Build the containers returned by the Docker client for a list of names
+    """
+    ret = []
+    for name in names:
+        container = mock.Mock(name=name)
+        container.attrs = {'Id': name, 'Name': '/' + name, 'State': {'Status': 'running'}, 'HostConfig': {}}
+        ret.append(container)
+    return ret
+
+
 @mark.parametrize('container_fuzz', CONTAINER_NAME_FUZZ)
-@mock.patch('dyno.app.api.docker.container_list', return_value={'containers': CONTAINER_NAME_FUZZ})
-def test_normalize_name_multiple(cl, container_fuzz):
+@mock.patch('dyno.app.api.docker.client')
+def test_normalize_name_multiple(docker_mock, container_fuzz, container_snapshot):
     """
     GIVEN multiple containers with names which end in `foo`
     WHEN the name ending in `foo` is passed into the _normalize_name function
     THEN function raises an exception
     """
+    docker_mock.containers.list.return_value = _containers(CONTAINER_NAME_FUZZ)
     with raises(Exception, match="more than one"):
         dkr._normalize_name('foo')
 
 
-@mock.patch('dyno.app.api.docker.container_list', return_value={'containers': CONTAINER_NAME_FUZZ})
-def test_normalize_name_multiple_not_found(cl):
+@mock.patch('dyno.app.api.docker.client')
+def test_normalize_name_multiple_not_found(docker_mock, container_snapshot):
     """
     GIVEN no containers which end in `baz`
     WHEN a name ending in `baz` if passed into the _normalize_name func
     THEN an exception is raised
     """
+    docker_mock.containers.list.return_value = _containers(CONTAINER_NAME_FUZZ)
     with raises(Exception, match="not found"):
         dkr._normalize_name('baz')
 
+def test_snapshot_live(docker_inspect):
+    """
+    GIVEN a container snapshot fed by the Docker events stream
+    WHEN containers are listed, resolved and queried repeatedly
+    THEN the Docker daemon is only queried once
+    """
+    docker_inspect = dict(docker_inspect, Name='/localtesting_8.0.0_elasticsearch')
+    list_containers = mock.Mock(return_value=[docker_inspect])
+    inspect = mock.Mock()
+    snapshot = ContainerSnapshot(list_containers, inspect, lambda: iter(threading.Event().wait, True))
+    for _ in range(3):
+        assert snapshot.names() == ['localtesting_8.0.0_elasticsearch']
+        assert snapshot.lookup('elasticsearch') == 'localtesting_8.0.0_elasticsearch'
+        assert snapshot.host_config('localtesting_8.0.0_elasticsearch') == docker_inspect['HostConfig']
+    list_containers.assert_called_once()
+    inspect.assert_not_called()
+
+def test_snapshot_events():
+    """
+    GIVEN a container snapshot
+    WHEN containers are started, updated, renamed and stopped
+    THEN the snapshot reflects the changes
+    """
+    def inspect(name):
+        return {'Id': name, 'Name': '/' + name, 'State': {'Status': 'running'}, 'HostConfig': {'Memory': 10}}
+
+    snapshot = ContainerSnapshot(lambda: [], inspect)
+    snapshot._pid = os.getpid()
+
+    def event(action, name, **attributes):
+        attributes['name'] = name
+        return {'Type': 'container', 'Action': action, 'Actor': {'ID': name, 'Attributes': attributes}}
+
+    snapshot.handle_event(event('start', 'localtesting_8.0.0_kibana'))
+    assert snapshot.lookup('kibana') == 'localtesting_8.0.0_kibana'
+    assert snapshot.host_config('localtesting_8.0.0_kibana') == {'Memory': 10}
+    snapshot.handle_event(event('health_status: healthy', 'localtesting_8.0.0_kibana'))
+    assert snapshot._containers['localtesting_8.0.0_kibana']['health'] == 'healthy'
+    snapshot.handle_event(event('rename', 'localtesting_8.0.0_kibana01', oldName='/localtesting_8.0.0_kibana'))
+    assert snapshot.lookup('kibana01') == 'localtesting_8.0.0_kibana01'
+    with raises(Exception, match="not found"):
+        snapshot.lookup('kibana')
+    snapshot.handle_event(event('die', 'localtesting_8.0.0_kibana01'))
+    assert snapshot.names() == []
+
 @mock.patch('dyno.app.api.docker.client')
-def test_list(docker_mock, client):
+def test_list(docker_mock, client, container_snapshot):
     """
     GIVEN an HTTP call to /docker/list
     WHEN the results are returned
     THEN the results contain a list of running containers
     """
-    fake_container = mock.Mock()
-    fake_container.name = 'fake_container'
-    list_mock = mock.Mock(return_value=[fake_container], name='list_mock')
+    list_mock = mock.Mock(return_value=_containers(['fake_container']), name='list_mock')
     docker_mock.containers.list = list_mock
     ret = client.get(url_for('docker.container_list'))
     assert ret.json == {'containers': ['fake_container']}
 
 @mock.patch('dyno.app.api.docker._normalize_name', return_value='fake_container_name')
-def test_query(fake_container_patch, docker_inspect, client):
+def test_query(fake_container_patch, docker_inspect, client, container_snapshot):
     """
     GIVEN an HTTP call to /docker/query
     WHEN the results are returned
@@ -74,6 +135,22 @@ def test_query(fake_container_patch, docker_inspect, client):
         assert ret.json['CPU'] == 1000
         assert ret.json['Mem'] == 200
 
+@mock.patch('dyno.app.api.docker.client', name='docker_mock')
+@mock.patch('dyno.app.api.docker._normalize_name', return_value='fake_container_name')
+def test_query_cached(fake_container_patch, docker_mock, docker_inspect, client, container_snapshot):
+    """
+    GIVEN an HTTP call to /docker/query which has been answered before
+    WHEN the container is updated
+    THEN the container is only inspected again after the update
+    """
+    with mock.patch.object(dkr.low_client, 'inspect_container', return_value=docker_inspect) as inspect_mock:
+        for _ in range(3):
+            client.get(url_for('docker.query'), query_string={'c': 'opbeans-python'})
+        assert inspect_mock.call_count == 1
+        client.get(url_for('docker.update'), query_string={'c': 'opbeans-python', 'component': 'CPU', 'val': 100})
+        client.get(url_for('docker.query'), query_string={'c': 'opbeans-python'})
+        assert inspect_mock.call_count == 2
+
 @mock.patch('dyno.app.api.docker.client', name='docker_mock')
 @mock.patch('dyno.app.api.docker._normalize_name', return_value='fake_container_name', name='normalize_mock')
 def test_update(fake_container_patch, docker_mock, client):
@@ -90,11 +167,61 @@ def test_update(fake_container_patch, docker_mock, client):
 
     fake_container.update.assert_called_with(cpu_quota=25990)
 
+@mock.patch('dyno.app.api.docker.client', name='docker_mock')
+@mock.patch('dyno.app.api.docker._normalize_name', side_effect=lambda name: 'localtesting_' + name)
+def test_update_batch(fake_container_patch, docker_mock, client):
+    """
+    GIVEN an HTTP call to /docker/update/batch
+    WHEN the call contains settings for several containers
+    THEN each container is updated once with all of its settings
+    """
+    fake_containers = {
+        'localtesting_opbeans-python': mock.Mock(name='opbeans-python'),
+        'localtesting_opbeans-go': mock.Mock(name='opbeans-go'),
+        }
+    docker_mock.containers.get.side_effect = fake_containers.get
+    ret = client.post(url_for('docker.update_batch'), json={
+        'opbeans-python': {'cpu': 100},
+        'opbeans-go': {'CPU': 100, 'mem': 100},
+        })
+    results = ret.json['results']
+    assert results['opbeans-python']['ok'] and results['opbeans-go']['ok']
+    assert 'took_ms' in results['opbeans-python']
+    fake_containers['localtesting_opbeans-python'].update.assert_called_once_with(cpu_quota=25990)
+    fake_containers['localtesting_opbeans-go'].update.assert_called_once_with(
+        cpu_quota=25990, mem_limit='2004m', memswap_limit=-1)
+
+@mock.patch('dyno.app.api.docker._normalize_name', side_effect=Exception('not found'))
+def test_update_batch_error(fake_container_patch, client):
+    """
+    GIVEN an HTTP call to /docker/update/batch
+    WHEN a container cannot be found
+    THEN the error is reported in the results for that container
+    """
+    ret = client.post(url_for('docker.update_batch'), json={'missing': {'cpu': 100}})
+    assert ret.json['results']['missing']['ok'] is False
+    assert ret.json['results']['missing']['error'] == 'not found'
+
+@mark.parametrize('updates', [
+    [{'opbeans-python': {'cpu': 100}}],
+    {'opbeans-python': 100},
+    ])
+@mock.patch('dyno.app.api.docker.client', name='docker_mock')
+def test_update_batch_invalid(docker_mock, updates, client):
+    """
+    GIVEN an HTTP call to /docker/update/batch
+    WHEN the payload is not a mapping of container names to settings
+    THEN a 400 is returned and no container is updated
+    """
+    ret = client.post(url_for('docker.update_batch'), json=updates)
+    assert ret.status_code == 400
+    assert ret.json['error']
+    docker_mock.containers.get.assert_not_called()
+
 # FIXME This is marked as xfail pending a centralization of the normalization functions
 @mark.xfail
 @mark.parametrize('val', range(1,101, 10))
-@mock.patch('dyno.app.api.control._range', mock.Mock(return_value={'Fr': [1,10]}))
-def test_normalize(val):
+def test_normalize(val, range_cache):
     """
     GIVEN values between 1-100
     WHEN the value is sent to be normalized
@@ -107,8 +234,7 @@ def test_normalize(val):
 # FIXME This is marked as xfail pending a centralization of the normalization functions
 @mark.xfail
 @mark.parametrize('val', range(1,10))
-@mock.patch('dyno.app.api.control._range', mock.Mock(return_value={'Fr': [1,10]}))
-def test_denormalize(val):
+def test_denormalize(val, range_cache):
     """
     GIVEN values between 1-100
     WHEN the value is sent to be denormalized
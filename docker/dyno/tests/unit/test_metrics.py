@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Tests for the Dyno live metrics stream
+"""
+import json
+from unittest import mock
+from flask import url_for
+import dyno.app.api.metrics as mtr
+
+STATS = {
+    'cpu_stats': {'cpu_usage': {'total_usage': 300}, 'system_cpu_usage': 2000, 'online_cpus': 2},
+    'precpu_stats': {'cpu_usage': {'total_usage': 100}, 'system_cpu_usage': 1000},
+    'memory_stats': {'usage': 1024, 'limit': 4096},
+    'networks': {'eth0': {'rx_bytes': 10, 'tx_bytes': 20}, 'eth1': {'rx_bytes': 1, 'tx_bytes': 2}},
+}
+
+
+def test_fan_out():
+    """
+    GIVEN several subscribers
+    WHEN a sample is published
+    THEN every subscriber receives it
+    """
+    sampler = mtr.Sampler(mock.Mock(), 60)
+    with mock.patch('threading.Thread'):
+        queues = [sampler.subscribe() for _ in range(3)]
+    sampler.publish({'time': 1})
+    assert [q.get_nowait() for q in queues] == [{'time': 1}] * 3
+
+
+def test_latest_sample_only():
+    """
+    GIVEN a subscriber which has not consumed a sample
+    WHEN a new sample is published
+    THEN the subscriber only receives the new sample
+    """
+    sampler = mtr.Sampler(mock.Mock(), 60)
+    with mock.patch('threading.Thread'):
+        q = sampler.subscribe()
+    sampler.publish({'time': 1})
+    sampler.publish({'time': 2})
+    assert q.get_nowait() == {'time': 2}
+    assert q.empty()
+
+
+def test_container_stats():
+    """
+    GIVEN the output of the Docker stats API
+    WHEN it is summarized
+    THEN CPU, memory and network figures are returned
+    """
+    with mock.patch.object(mtr.dkr.low_client, 'stats', return_value=STATS):
+        assert mtr._container_stats('fake_container') == {
+            'cpu_percent': 40.0,
+            'mem_usage': 1024,
+            'mem_limit': 4096,
+            'net_rx': 11,
+            'net_tx': 22,
+        }
+
+
+def test_stream(client):
+    """
+    GIVEN an HTTP client
+    WHEN that client requests the /metrics/stream endpoint
+    THEN samples are received as Server-Sent Events
+    """
+    sample = {'containers': {}, 'proxies': {}, 'time': 1}
+    sampler = mtr.Sampler(mock.Mock(return_value=sample), 60)
+    with mock.patch.object(mtr, 'sampler', sampler):
+        res = client.get(url_for('api.metrics_stream'))
+        assert res.mimetype == 'text/event-stream'
+        event = next(res.response)
+        res.close()
+    if isinstance(event, bytes):
+        event = event.decode('utf-8')
+    assert json.loads(event[len('data: '):]) == sample
+
+
+def test_stream_sync_workers(client, monkeypatch):
+    """
+    GIVEN the Dyno API served by sync gunicorn workers
+    WHEN a client requests the /metrics/stream endpoint
+    THEN the stream is refused and no sampler is started
+    """
+    monkeypatch.setenv('DYNO_WORKER_CLASS', 'sync')
+    sampler = mock.Mock(spec=mtr.Sampler)
+    with mock.patch.object(mtr, 'sampler', sampler):
+        res = client.get(url_for('api.metrics_stream'))
+    assert res.status_code == 501
+    assert 'gevent' in res.json['error']
+    sampler.subscribe.assert_not_called()
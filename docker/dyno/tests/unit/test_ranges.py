@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Licensed to Elasticsearch B.V. under one or more contributor
+# license agreements. See the NOTICE file distributed with
+# this work for additional information regarding copyright
+# ownership. Elasticsearch B.V. licenses this file to you under
+# the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+
+"""
+Tests for the Dyno range cache
+"""
+import os
+import yaml
+from unittest import mock
+import dyno.app.api.ranges as rng
+
+
+def test_range_parsed_once(range_cache, range_stub):
+    """
+    GIVEN a range cache
+    WHEN the range is requested several times
+    THEN the range file is only parsed once
+    """
+    with mock.patch('yaml.load', wraps=yaml.load) as load_mock:
+        for _ in range(5):
+            assert range_cache.range() == range_stub
+        load_mock.assert_called_once()
+
+
+def test_range_reloaded_on_change(range_cache):
+    """
+    GIVEN a range cache which has already been loaded
+    WHEN the range file is modified
+    THEN the new contents are returned
+    """
+    range_cache.range()
+    with open(range_cache.path, 'w') as fh_:
+        yaml.dump({'Fr': [1, 20]}, fh_)
+    stat = os.stat(range_cache.path)
+    os.utime(range_cache.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert range_cache.bounds('Fr') == (1, 20)
+
+
+def test_slider_to_raw_table(range_cache):
+    """
+    GIVEN a normalizer function
+    WHEN slider positions are converted to raw values
+    THEN the normalizer is only called once per slider position
+    """
+    normalizer = mock.Mock(side_effect=lambda lval, uval, val: val)
+    for _ in range(3):
+        assert range_cache.slider_to_raw('Fr', 50, normalizer) == 50
+    assert normalizer.call_count == rng.SLIDER_MAX - rng.SLIDER_MIN + 1
+
+
+def test_slider_to_raw_non_integer(range_cache):
+    """
+    GIVEN a slider position which is not an integer
+    WHEN it is converted to a raw value
+    THEN the normalizer is called directly
+    """
+    normalizer = mock.Mock(return_value=7)
+    assert range_cache.slider_to_raw('Fr', 50.5, normalizer) == 7
+    normalizer.assert_called_once_with(1, 10, 50.5)
@@ -3,7 +3,7 @@
 #
 
 
-from .helpers import curl_healthcheck, parse_version
+from .helpers import StackVersion, curl_healthcheck
 from .service import StackService, Service
 
 
@@ -29,7 +29,7 @@ class Logstash(StackService, Service):
         if self.at_least_version("7.3") \
                 or self.options.get("apm_server_snapshot") \
                 or (not self.options.get("apm_server_version") is None and
-                    parse_version("7.3") <= parse_version(self.options.get("apm_server_version"))):
+                    StackVersion(self.options.get("apm_server_version")).at_least("7.3")):
             volumes = ["./docker/logstash/pipeline/:/usr/share/logstash/pipeline/"]
         else:
             volumes = ["./docker/logstash/pipeline-6.x-compat/:/usr/share/logstash/pipeline/"]
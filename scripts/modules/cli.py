@@ -9,14 +9,21 @@ import os
 import subprocess
 import sys
 import re
+import time
 
 from .beats import BeatMixin
-from .helpers import load_images, parse_version
+from .compose_cache import ComposeCache, compose_cache_key, mutable_images
+from .helpers import (BC_MANIFEST_CACHE_DIR, COMPOSE_OUTPUT_FORMATS, DEFAULT_BC_BASE_URL, DEFAULT_IMAGE_CACHE_SIZE,
+                      DEFAULT_IMAGE_CACHE_TTL, DEFAULT_LATEST_BC_TTL, IMAGE_LOAD_MODES, BuildManifestCache,
+                      StackVersion, adaptive_healthcheck, load_images, parse_rate, prefetch_bcs, write_compose)
 from .opbeans import OpbeansService, OpbeansRum
 from .service import Service, DEFAULT_APM_SERVER_URL
 from .proxy import Toxi, Dyno
+from .reconcile import changed_services, running_services, stamp_config_hashes
+from .scheduler import StartupError, StartupScheduler, compose_status
+from . import mirror, timeline
 
-# these imports are used by discover_services function to discover services from modules loaded
+# these imports are used to build the service registry below
 
 
 from .beats import (  # noqa: F401
@@ -39,11 +46,25 @@ PACKAGE_NAME = 'localmanager'
 __version__ = "4.0.0"
 
 
+# Static service registry, in the order discover_services() used to find them
+# by introspection. Keep it sorted by class name when adding a service, and
+# test_service_registry will complain if a service is missing.
+SERVICES = (
+    ApmManaged, ApmServer, Dyno, ElasticAgent, Elasticsearch, EnterpriseSearch, Filebeat, Heartbeat, Kafka, Kibana,
+    Logstash, Metricbeat, OpbeansDotnet, OpbeansDotnet01, OpbeansGo, OpbeansGo01, OpbeansJava, OpbeansJava01,
+    OpbeansLoadGenerator, OpbeansNode, OpbeansNode01, OpbeansPhp, OpbeansPython, OpbeansPython01, OpbeansRuby,
+    OpbeansRuby01, OpbeansRum, PackageRegistry, Packetbeat, Postgres, Redis, StatsD, Toxi, WaitService, Zookeeper,
+)
+
+# subcommands which need the per-service options
+SERVICE_COMMANDS = ('build', 'start', 'list-options')
+
+
 def discover_services(mod=None):
-    """discover list of services"""
-    ret = []
+    """discover list of services, using the static registry unless a module is given"""
     if not mod:
-        mod = sys.modules[__name__]
+        return list(SERVICES)
+    ret = []
     for obj in dir(mod):
         cls = getattr(mod, obj)
         if inspect.isclass(cls) and issubclass(cls, Service) \
@@ -106,6 +127,10 @@ class LocalSetup(object):
             services = discover_services()
         self.services = services
 
+        # only build the service options for subcommands which use them
+        command = self.find_command(sys.argv[1:] if argv is None else argv)
+        lazy = command is not None and command not in SERVICE_COMMANDS
+
         parser = argparse.ArgumentParser(
             description="""
             This is a CLI for managing the local testing stack.
@@ -135,16 +160,15 @@ class LocalSetup(object):
             description='Use one of the following commands:'
         )
 
-        self.init_start_parser(
-            subparsers.add_parser(
-                'start',
-                help="Start the stack. See `start --help` for options.",
-                description="Main command for this script, starts the stack. Use the arguments to specify which "
-                            "services to start. "
-            ),
-            services,
-            argv=argv,
-        ).set_defaults(func=self.start_handler)
+        start_parser = subparsers.add_parser(
+            'start',
+            help="Start the stack. See `start --help` for options.",
+            description="Main command for this script, starts the stack. Use the arguments to specify which "
+                        "services to start. "
+        )
+        if not lazy:
+            self.init_start_parser(start_parser, services, argv=argv)
+        start_parser.set_defaults(func=self.start_handler)
 
         subparsers.add_parser(
             'reset-enterprise-search-password',
@@ -183,23 +207,40 @@ class LocalSetup(object):
             description="Lists all available options (used for bash autocompletion)."
         ).set_defaults(func=self.listoptions_handler)
 
-        self.init_build_parser(
+        build_parser = subparsers.add_parser(
+            'build',
+            help="Build the stack. See `build --help` for options.",
+            description="Build the stack. Use the arguments to specify which "
+                        "services to build. "
+        )
+        if not lazy:
+            self.init_build_parser(build_parser, services, argv=argv)
+        build_parser.set_defaults(func=self.build_handler)
+
+        sourcemap_parser = subparsers.add_parser(
+            'upload-sourcemap',
+            help="Uploads sourcemap to the APM Server"
+        )
+        if not lazy or command == 'upload-sourcemap':
+            self.init_sourcemap_parser(sourcemap_parser)
+        sourcemap_parser.set_defaults(func=self.upload_sourcemaps_handler)
+
+        self.init_timeline_parser(
             subparsers.add_parser(
-                'build',
-                help="Build the stack. See `build --help` for options.",
-                description="Build the stack. Use the arguments to specify which "
-                            "services to build. "
-            ),
-            services,
-            argv=argv,
-        ).set_defaults(func=self.build_handler)
+                'timeline',
+                help="Prints when each service was created, running and healthy.",
+                description="Prints a per-service startup timeline of the running stack, from Docker events."
+            )
+        ).set_defaults(func=self.timeline_handler)
 
-        self.init_sourcemap_parser(
+        self.init_mirror_parser(
             subparsers.add_parser(
-                'upload-sourcemap',
-                help="Uploads sourcemap to the APM Server"
+                'mirror',
+                help="Mirrors a build candidate locally, or serves the mirror.",
+                description="Copies the manifest and docker images of a build candidate into a local directory, "
+                            "which --serve serves in place of staging.elastic.co for start --bc-base-url."
             )
-        ).set_defaults(func=self.upload_sourcemaps_handler)
+        ).set_defaults(func=self.mirror_handler)
 
         self.store_options(parser)
 
@@ -211,6 +252,17 @@ class LocalSetup(object):
         if not hasattr(self.args, "func"):
             parser.error("command required")
 
+    @staticmethod
+    def find_command(argv):
+        """
+        Return the subcommand in argv, or None if there is none.
+        Top level options take no values, so this is the first positional argument.
+        """
+        for arg in argv:
+            if not arg.startswith('-'):
+                return arg
+        return None
+
     def set_docker_compose_path(self, dst):
         """override docker-compose-path argument, for tests"""
         self.args.__setattr__("docker_compose_path", dst)
@@ -330,6 +382,109 @@ class LocalSetup(object):
             help='image cache directory',
         )
 
+        parser.add_argument(
+            '--image-download-concurrency',
+            type=int,
+            default=4,
+            help='number of images to download and load at the same time',
+        )
+
+        parser.add_argument(
+            '--image-download-rate',
+            type=parse_rate,
+            help='cap the combined image download bandwidth, in bytes per second, e.g. 20M',
+        )
+
+        parser.add_argument(
+            '--image-load',
+            choices=IMAGE_LOAD_MODES,
+            default='file',
+            dest='image_load_mode',
+            help='file: download images to the image cache, then load them. '
+                 'stream: stream downloads straight into docker load, without caching them. '
+                 'tee: stream downloads into docker load and also save them to the image cache',
+        )
+
+        parser.add_argument(
+            '--image-cache-ttl',
+            type=int,
+            default=DEFAULT_IMAGE_CACHE_TTL,
+            help='seconds during which cached images are used without checking for a newer version',
+        )
+
+        parser.add_argument(
+            '--image-cache-size',
+            type=parse_rate,
+            default=DEFAULT_IMAGE_CACHE_SIZE,
+            help='evict the least recently used images once the image cache grows beyond this size, e.g. 20G',
+        )
+
+        parser.add_argument(
+            '--schedule',
+            action='store_true',
+            dest='schedule',
+            help='start each service as soon as its dependencies are ready and report the critical path',
+            default=False,
+        )
+
+        parser.add_argument(
+            '--adaptive-healthchecks',
+            action='store_true',
+            dest='adaptive_healthchecks',
+            help='check the health of services more often, based on how long they took to become healthy before. '
+                 'Boot times are then recorded each time the stack is started',
+            default=False,
+        )
+
+        parser.add_argument(
+            "--boot-times",
+            dest="boot_times",
+            help="record the time each service takes to become healthy in this file. Defaults to "
+                 "scripts/modules/.timelines/boot_times.json with --adaptive-healthchecks, "
+                 "otherwise nothing is recorded",
+        )
+
+        parser.add_argument(
+            '--reconcile',
+            action='store_true',
+            dest='reconcile',
+            help='only recreate services whose configuration changed since they were started',
+            default=False,
+        )
+
+        # Add compose document cache arguments
+        parser.add_argument(
+            '--compose-cache-dir',
+            default=os.path.abspath(os.path.join(os.path.dirname(__file__), '.compose')),
+            help='cache directory for generated docker-compose configurations',
+        )
+
+        parser.add_argument(
+            '--no-compose-cache',
+            action='store_true',
+            dest='no_compose_cache',
+            help='always regenerate the docker-compose configuration and restart services',
+            default=False,
+        )
+
+        parser.add_argument(
+            '--bc-base-url',
+            help='where build candidates are published, e.g. a local mirror. Defaults to ' + DEFAULT_BC_BASE_URL,
+        )
+
+        parser.add_argument(
+            '--bc-manifest-cache-dir',
+            default=BC_MANIFEST_CACHE_DIR,
+            help='cache directory for build candidate manifests',
+        )
+
+        parser.add_argument(
+            '--bc-manifest-ttl',
+            type=int,
+            default=DEFAULT_LATEST_BC_TTL,
+            help='seconds during which the manifest of the latest build candidate is reused',
+        )
+
         parser.add_argument(
             "--build-parallel",
             action="store_true",
@@ -455,8 +610,8 @@ class LocalSetup(object):
 
         parser.add_argument(
             '--output-format',
-            choices=("json", "yaml"),
-            help='Select the output format for the docker-compose.yml file.',
+            choices=COMPOSE_OUTPUT_FORMATS,
+            help='Select the output format for the docker-compose.yml file, json-compact is json without whitespace.',
             default="json"
         )
 
@@ -484,6 +639,163 @@ class LocalSetup(object):
             print('ERROR: Docker Compose might be missing. See below for further details.\n')
             raise OSError(err)
 
+    @staticmethod
+    def record_boot_times(path, project, since):
+        """record how long the containers of a project started since `since` took to become healthy, if possible"""
+        try:
+            services = timeline.build_timeline(timeline.docker_events(project, since))
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return
+        if services:
+            timeline.BootTimes(path).record(services)
+
+    def scheduled_start(self, docker_compose_cmd, up_params, compose, changed=None, boot_times=None):
+        """
+        start services one by one as soon as their dependencies are ready, instead of leaving it to docker-compose,
+        and print when each service became ready along with the critical path
+        """
+        # create the project's network, volumes and containers in one go first,
+        # concurrent `up`s would race to create the network and volumes
+        create_cmd = docker_compose_cmd + [p for p in up_params if p != "-d"] + ["--no-start", "--no-deps"]
+        if changed is not None:
+            create_cmd.append("--force-recreate")
+        try:
+            self.run_docker_compose_process(create_cmd + sorted(compose["services"] if changed is None else changed))
+        except subprocess.CalledProcessError as err:
+            print("Failed to create the stack: {}\n".format(err))
+            sys.exit(1)
+        up_cmd = docker_compose_cmd + up_params + ["--no-deps"]
+        scheduler = StartupScheduler(
+            compose["services"],
+            start=lambda name: self.run_docker_compose_process(up_cmd + [name]),
+            status=lambda: compose_status(docker_compose_cmd),
+        )
+        try:
+            scheduler.run(changed)
+        except StartupError as err:
+            print("Failed to start the stack: {}\n".format(err))
+            print(scheduler.report())
+            sys.exit(1)
+        print("\nStartup timeline:\n")
+        print(scheduler.report())
+        if boot_times:
+            timeline.BootTimes(boot_times).record(scheduler.timeline, ready="ready")
+        return scheduler.timeline
+
+    @staticmethod
+    def changed_services(compose, project):
+        """
+        return the services whose rendered definition differs from their running container in project,
+        or None if the running containers could not be listed
+        """
+        try:
+            running = running_services(project)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print("Could not list running containers, starting all services: {}".format(err))
+            return None
+        return changed_services(compose["services"], running)
+
+    @classmethod
+    def project_up_to_date(cls, docker_compose_cmd, compose, project, stamped=False):
+        """
+        check that the running containers of project were created from compose: when services are stamped with
+        their config hash (--reconcile), every one of them must match its container, otherwise every long running
+        service must be up
+        """
+        if stamped:
+            try:
+                return not changed_services(compose["services"], running_services(project))
+            except (OSError, subprocess.CalledProcessError):
+                return False
+        return cls.project_running(docker_compose_cmd, compose)
+
+    @staticmethod
+    def project_running(docker_compose_cmd, compose):
+        """check that every long running service (those with a healthcheck) in compose has a running container"""
+        try:
+            running = subprocess.check_output(
+                docker_compose_cmd + ["ps", "--services", "--filter", "status=running"],
+                stderr=open(os.devnull, 'w')).decode('utf8').split()
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        expected = [name for name, service in compose["services"].items() if service.get("healthcheck")]
+        return bool(expected) and set(expected).issubset(running)
+
+    @staticmethod
+    def init_timeline_parser(parser):
+        parser.add_argument(
+            "--format",
+            choices=("text", "json"),
+            default="text",
+            dest="timeline_format",
+            help="Output format of the timeline.",
+        )
+
+        parser.add_argument(
+            "--project",
+            help="docker-compose project name. Defaults to the project of the default docker-compose.yml",
+        )
+
+        parser.add_argument(
+            "--since",
+            help="Only consider Docker events since this time (timestamp or duration, e.g. 30m). "
+                 "Defaults to when the oldest container of the project was created",
+        )
+        return parser
+
+    @staticmethod
+    def init_mirror_parser(parser):
+        parser.add_argument(
+            "stack-version",
+            nargs="?",
+            help="Version of the build candidate to mirror, e.g. 8.13 or 8.13.0. Omit to only serve the mirror",
+        )
+
+        parser.add_argument(
+            "--bc",
+            default="latest",
+            help="ID of the build candidate, e.g. 37b864a0. Defaults to the latest one",
+        )
+
+        parser.add_argument(
+            "--image",
+            action="append",
+            dest="mirror_images",
+            help="docker image to mirror, e.g. kibana-oss, repeatable. Defaults to " +
+                 ", ".join(mirror.DEFAULT_MIRROR_IMAGES),
+        )
+
+        parser.add_argument(
+            "--mirror-dir",
+            default=mirror.DEFAULT_MIRROR_DIR,
+            help="directory to mirror build candidates into",
+        )
+
+        parser.add_argument(
+            "--bc-base-url",
+            help="where build candidates are mirrored from. Defaults to " + DEFAULT_BC_BASE_URL,
+        )
+
+        parser.add_argument(
+            "--image-download-rate",
+            type=parse_rate,
+            help="cap the combined image download bandwidth, in bytes per second, e.g. 20M",
+        )
+
+        parser.add_argument(
+            "--serve",
+            action="store_true",
+            help="serve the mirror over HTTP once done",
+        )
+
+        parser.add_argument(
+            "--port",
+            type=int,
+            default=mirror.DEFAULT_MIRROR_PORT,
+            help="port to serve the mirror on",
+        )
+        return parser
+
     @staticmethod
     def init_sourcemap_parser(parser):
         parser.add_argument(
@@ -602,9 +914,13 @@ class LocalSetup(object):
             # use stack-version directly if not supported, to allow use of specific releases, eg 6.2.3
             args["version"] = self.SUPPORTED_VERSIONS.get(args["stack-version"], args["stack-version"])
 
-        if(parse_version(args["version"]) >= parse_version("8.0")):
+        if StackVersion(args["version"]).at_least("8.0"):
             args["enable_apm_managed"] = True
 
+        # boot times are only needed, and so only recorded, for adaptive healthchecks unless asked for
+        if args.get("adaptive_healthchecks") and not args.get("boot_times"):
+            args["boot_times"] = timeline.BOOT_TIMES_PATH
+
         if args.get("enable_apm_server") is False:
             args["enable_apm_managed"] = False
 
@@ -619,7 +935,148 @@ class LocalSetup(object):
             args["apm_server_url"] = args.get("apm_server_url", DEFAULT_APM_SERVER_URL).replace("http:", "https:")
             args["opbeans_apm_js_server_url"] = args["apm_server_url"]
 
+        docker_compose_path = args["docker_compose_path"]
+        # try to figure out if writing to a real file, not amazing
+        real_file = hasattr(docker_compose_path, "name") and os.path.isdir(os.path.dirname(docker_compose_path.name))
+
+        # reuse the document generated for identical arguments, unless it depends on the latest build candidate
+        cache = key = entry = None
+        if real_file and not args.get("no_compose_cache") and args.get("bc") != "latest":
+            cache = ComposeCache(args["compose_cache_dir"])
+            key = compose_cache_key(args)
+            entry = cache.get(key)
+        if entry is None:
+            compose, services_to_load, toxi_cfg = self.render_compose(args)
+            entry = dict(compose=compose, services_to_load=services_to_load, toxi_cfg=toxi_cfg)
+            if cache:
+                cache.put(key, entry)
+        else:
+            print("Using cached docker-compose configuration {}".format(key[:12]))
+        compose = entry["compose"]
+        services_to_load = entry["services_to_load"]
+
+        if entry["toxi_cfg"] is not None:
+            this_dir = os.path.dirname(os.path.realpath(__file__))
+            toxi_cfg_path = os.path.join(this_dir, "../../docker/toxi/toxi.cfg")
+            with open(toxi_cfg_path, 'w') as fh_:
+                fh_.write(entry["toxi_cfg"])
+
+        # skip docker-compose entirely when this exact document is already up and running,
+        # unless a rebuild was asked for or an image tag may have moved since
+        up_to_date = (action == "start" and cache is not None and
+                      not args.get("force_build") and not mutable_images(compose) and
+                      cache.last_up(docker_compose_path.name) == key and
+                      self.project_up_to_date(["docker-compose", "-f", docker_compose_path.name], compose,
+                                              timeline.project_name(os.path.dirname(docker_compose_path.name)),
+                                              stamped=args.get("reconcile")))
+
+        # `docker load` images if necessary, usually only for build candidates
+        if not args["skip_download"] and services_to_load and not up_to_date:
+            load_images(set(services_to_load.values()), args["image_cache_dir"],
+                        concurrency=args["image_download_concurrency"], max_rate=args["image_download_rate"],
+                        mode=args["image_load_mode"], ttl=args["image_cache_ttl"],
+                        max_size=args["image_cache_size"])
+
+        output_format = args.get("output_format", "json")
+        if output_format == 'yaml':
+            try:
+                import yaml  # noqa: F401
+            except ImportError:
+                print("Failed to import 'yaml': pip install yaml, or specify an alternative --output-format.")
+                sys.exit(1)
+        write_compose(compose, docker_compose_path, output_format)
+        docker_compose_path.flush()
+
+        if real_file and up_to_date:
+            docker_compose_path.close()
+            print("Stack services are already up to date, nothing to do.")
+        elif real_file:
+            docker_compose_path.close()
+            print("Starting/Building stack services..\n")
+            docker_compose_cmd = ["docker-compose", "-f", docker_compose_path.name]
+            if not sys.stdin.isatty() and action not in ["build"]:
+                docker_compose_cmd.extend(["--no-ansi", "--log-level", "ERROR"])
+
+            # in reconcile mode, only build, pull and recreate the services whose definition changed
+            project = timeline.project_name(os.path.dirname(docker_compose_path.name))
+            changed = None
+            if args.get("reconcile") and action in ["start"]:
+                changed = self.changed_services(compose, project)
+
+            # always build if possible, should be quick for rebuilds
+            build_services = [name for name, service in compose["services"].items() if 'build' in service and
+                              (changed is None or name in changed)]
+            if build_services:
+                docker_compose_build = docker_compose_cmd + ["build"]
+                if not args["skip_pull"]:
+                    docker_compose_build.append("--pull")
+                if args["force_build"]:
+                    docker_compose_build.append("--no-cache")
+                if args["build_parallel"]:
+                    docker_compose_build.append("--parallel")
+                self.run_docker_compose_process(docker_compose_build + build_services)
+
+            # pull any images
+            image_services = [name for name, service in compose["services"].items() if
+                              'image' in service and name not in services_to_load and
+                              (changed is None or name in changed)]
+            if args.get("kibana_src") and 'kibana' in image_services:
+                image_services.remove('kibana')
+
+            if image_services and not args["skip_download"]:
+                pull_params = ["pull"]
+                if not sys.stdin.isatty():
+                    pull_params.extend(["-q"])
+                self.run_docker_compose_process(docker_compose_cmd + pull_params + image_services)
+
+            # really start
+            since = int(time.time())
+            if action in ["start"]:
+                up_params = ["up", "-d"]
+                if args["remove_orphans"]:
+                    up_params.append("--remove-orphans")
+            if action in ["build"]:
+                up_params = ["build"]
+            if not sys.stdin.isatty() and action not in ["build"]:
+                up_params.extend(["--quiet-pull"])
+            if changed is not None and not changed:
+                print("All services are up to date.")
+            elif action in ["start"] and args.get("schedule"):
+                self.scheduled_start(docker_compose_cmd, up_params, compose, changed, args["boot_times"])
+            elif changed is None:
+                self.run_docker_compose_process(docker_compose_cmd + up_params)
+            else:
+                print("Recreating changed services: {}".format(", ".join(changed)))
+                wait = WaitService.name()
+                recreate = [name for name in changed if name != wait]
+                if recreate:
+                    self.run_docker_compose_process(
+                        docker_compose_cmd + up_params + ["--no-deps", "--force-recreate"] + recreate)
+                # bring up the wait service without touching anything else, to wait for the stack to be healthy
+                if wait in compose["services"]:
+                    self.run_docker_compose_process(docker_compose_cmd + ["up", "-d", "--no-recreate", wait])
+            # the wait service holds `up` until the stack is healthy, so the boots of this start are complete.
+            # --schedule records its own timeline
+            if action in ["start"] and args.get("boot_times") and not args.get("schedule") and (
+                    changed is None or changed):
+                self.record_boot_times(args["boot_times"], project, since)
+            # also forget what was last up when this document was not cached, it replaced that stack
+            if action in ["start"]:
+                ComposeCache(args["compose_cache_dir"]).record_up(docker_compose_path.name, key)
+            if args.get("shutdown_kibana", False):
+                print("Stopping Kibana after configuring APM integration.")
+                self.run_docker_compose_process(docker_compose_cmd + ["stop", "kibana"])
+
+    def render_compose(self, args):
+        """
+        instantiate the selected services and render the docker-compose document
+
+        returns the document, the image download url for each service that needs to be loaded
+        and the toxiproxy configuration, or None when dyno is not enabled
+        """
         selections = set()
+        selected = []
+        toxi_cfg = None
         run_all = args.get("run_all")
         all_opbeans = args.get('run_all_opbeans') or run_all
         any_opbeans = all_opbeans or any(v and k.startswith('enable_opbeans_') for k, v in args.items())
@@ -636,18 +1093,23 @@ class LocalSetup(object):
                     (all_opbeans and is_opbeans_service and not is_opbeans_2nd) or
                     (any_opbeans and is_opbeans_sidecar and not is_opbeans_2nd) or
                     (run_all and is_obs and not is_opbeans_2nd)):
-                selections.add(service(**args))
+                selected.append(service)
+
+        # fetch the build candidate manifests of all services at once rather than as each service is created
+        manifest_cache = None
+        if args.get("bc_manifest_cache_dir"):
+            manifest_cache = BuildManifestCache(args["bc_manifest_cache_dir"], args["bc_manifest_ttl"])
+        prefetch_bcs([service.build_candidate(args) for service in selected], cache=manifest_cache,
+                     base_url=args.get("bc_base_url"))
+        for service in selected:
+            selections.add(service(**args))
 
         if args.get('dyno'):
             toxi = Toxi()
             selections.add(toxi)
             toxi.gen_ports(selections)
-            c = toxi.gen_config(selections)
-            this_dir = os.path.dirname(os.path.realpath(__file__))
-            toxi_cfg_path = os.path.join(this_dir, "../../docker/toxi/toxi.cfg")
-            with open(toxi_cfg_path, 'w') as fh_:
-                fh_.write(c)
-            dyno = Dyno()
+            toxi_cfg = toxi.gen_config(selections)
+            dyno = Dyno(**args)
             selections.add(dyno)
             statsd = StatsD()
             selections.add(statsd)
@@ -687,8 +1149,6 @@ class LocalSetup(object):
             download_url = service.image_download_url()
             if download_url:
                 services_to_load[list(service.render().keys())[0]] = download_url
-        if not args["skip_download"] and services_to_load:
-            load_images(set(services_to_load.values()), args["image_cache_dir"])
 
         # generate docker-compose.yml
         services = {}
@@ -701,8 +1161,9 @@ class LocalSetup(object):
 
         # expose a list of enabled opbeans services to all opbeans services. This allows them to talk amongst each other
         # and have a jolly good distributed time
-        enabled_opbeans_services = [k for k in services.keys()
-                                    if k.startswith("opbeans-") and k not in ("opbeans-rum", "opbeans-load-generator")]
+        # sorted, as services are selected in no particular order and the value must not change between runs
+        enabled_opbeans_services = sorted(k for k in services.keys() if k.startswith("opbeans-") and
+                                          k not in ("opbeans-rum", "opbeans-load-generator"))
         enabled_opbeans_services_str = ",".join(enabled_opbeans_services)
         for s in enabled_opbeans_services:
             if isinstance(services[s]["environment"], dict):
@@ -716,6 +1177,17 @@ class LocalSetup(object):
             if args.get("disable_opbeans_load_generator") or not enabled_opbeans:
                 del services["opbeans-load-generator"]
 
+        # tune healthchecks to how long each service took to become healthy before
+        if args.get("adaptive_healthchecks"):
+            expected = timeline.BootTimes(args["boot_times"]).expected()
+            for name, service in services.items():
+                if name in expected and service.get("healthcheck"):
+                    service["healthcheck"] = adaptive_healthcheck(service["healthcheck"], expected[name])
+
+        # label each service with a hash of its definition, to find out which services changed next time
+        if args.get("reconcile"):
+            stamp_config_hashes(services)
+
         compose = dict(
             version="2.4",
             services=services,
@@ -727,68 +1199,7 @@ class LocalSetup(object):
                 pgdata={"driver": "local"},
             ),
         )
-        docker_compose_path = args["docker_compose_path"]
-
-        if args.get("output_format") == 'yaml':
-            try:
-                import yaml
-            except ImportError:
-                print("Failed to import 'yaml': pip install yaml, or specify an alternative --output-format.")
-                sys.exit(1)
-            yaml.dump(compose, docker_compose_path,
-                      explicit_start=True,
-                      default_flow_style=False,
-                      indent=2
-                      )
-        elif args.get("output_format") == 'json':
-            json.dump(compose, docker_compose_path, indent=2, sort_keys=True)
-        docker_compose_path.flush()
-
-        # try to figure out if writing to a real file, not amazing
-        if hasattr(docker_compose_path, "name") and os.path.isdir(os.path.dirname(docker_compose_path.name)):
-            docker_compose_path.close()
-            print("Starting/Building stack services..\n")
-            docker_compose_cmd = ["docker-compose", "-f", docker_compose_path.name]
-            if not sys.stdin.isatty() and action not in ["build"]:
-                docker_compose_cmd.extend(["--no-ansi", "--log-level", "ERROR"])
-
-            # always build if possible, should be quick for rebuilds
-            build_services = [name for name, service in compose["services"].items() if 'build' in service]
-            if build_services:
-                docker_compose_build = docker_compose_cmd + ["build"]
-                if not args["skip_pull"]:
-                    docker_compose_build.append("--pull")
-                if args["force_build"]:
-                    docker_compose_build.append("--no-cache")
-                if args["build_parallel"]:
-                    docker_compose_build.append("--parallel")
-                self.run_docker_compose_process(docker_compose_build + build_services)
-
-            # pull any images
-            image_services = [name for name, service in compose["services"].items() if
-                              'image' in service and name not in services_to_load]
-            if args.get("kibana_src"):
-                image_services.remove('kibana')
-
-            if image_services and not args["skip_download"]:
-                pull_params = ["pull"]
-                if not sys.stdin.isatty():
-                    pull_params.extend(["-q"])
-                self.run_docker_compose_process(docker_compose_cmd + pull_params + image_services)
-
-            # really start
-            if action in ["start"]:
-                up_params = ["up", "-d"]
-                if args["remove_orphans"]:
-                    up_params.append("--remove-orphans")
-            if action in ["build"]:
-                up_params = ["build"]
-            if not sys.stdin.isatty() and action not in ["build"]:
-                up_params.extend(["--quiet-pull"])
-            self.run_docker_compose_process(docker_compose_cmd + up_params)
-            if args.get("shutdown_kibana", False):
-                print("Stopping Kibana after configuring APM integration.")
-                self.run_docker_compose_process(docker_compose_cmd + ["stop", "kibana"])
+        return compose, services_to_load, toxi_cfg
 
     @staticmethod
     def reset_enterprise_search_password_handler():
@@ -869,6 +1280,41 @@ class LocalSetup(object):
               "-v {}:/tmp/sourcemap centos:7 ".format(sourcemap_file) + cmd
         subprocess.check_output(cmd, shell=True).decode('utf8').strip()
 
+    def mirror_handler(self):
+        args = vars(self.args)
+        stack_version = args["stack-version"]
+        if not stack_version and not args["serve"]:
+            print("Nothing to do, pass a version to mirror and/or --serve.")
+            sys.exit(1)
+        if stack_version:
+            version = self.SUPPORTED_VERSIONS.get(stack_version, stack_version)
+            failed = mirror.snapshot(version, args["bc"], args["mirror_dir"],
+                                     images=args["mirror_images"] or mirror.DEFAULT_MIRROR_IMAGES,
+                                     base_url=args["bc_base_url"], max_rate=args["image_download_rate"])
+            if failed:
+                print("Errors while downloading. Exiting.")
+                sys.exit(1)
+        if args["serve"]:
+            mirror.serve(args["mirror_dir"], args["port"])
+
+    def timeline_handler(self):
+        project = self.args.project or timeline.project_name(
+            os.path.join(os.path.dirname(__file__), '..', '..'))
+        try:
+            since = self.args.since or timeline.project_created(project)
+            if since is None:
+                print('No containers found for project {}.'.format(project))
+                sys.exit(1)
+            events = timeline.docker_events(project, since)
+        except (OSError, subprocess.CalledProcessError):
+            print('Make sure Docker is running before running this script.')
+            sys.exit(1)
+        services = timeline.build_timeline(events)
+        if self.args.timeline_format == "json":
+            print(timeline.to_json(services))
+        else:
+            print(timeline.to_text(services))
+
     @staticmethod
     def versions_handler():
         Container = collections.namedtuple(
@@ -0,0 +1,138 @@
+#
+# content-addressed cache for generated docker-compose documents
+#
+
+import glob
+import hashlib
+import json
+import os
+
+# arguments which do not serialize and have no effect on the generated document
+IGNORED_ARGS = ("func", "docker_compose_path", "compose_cache_dir", "no_compose_cache", "bc_manifest_cache_dir")
+
+MODULES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# files which rendering reads from directories passed as arguments, by argument
+READ_FILES = {
+    "kibana_src": (".node-version",),
+}
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _referenced_files(value):
+    """yield any existing file paths found in an argument value"""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    for v in values:
+        if isinstance(v, str) and os.path.isfile(v):
+            yield os.path.abspath(v)
+
+
+def _read_files(name, value):
+    """yield the paths of the files read from the directory passed as argument name, as listed in READ_FILES"""
+    if isinstance(value, str) and value:
+        for filename in READ_FILES.get(name, ()):
+            yield os.path.abspath(os.path.join(os.path.expanduser(value), filename))
+
+
+def compose_cache_key(args):
+    """
+    hash everything that goes into the docker-compose document:
+    the normalized arguments, the service module sources, any config files passed as arguments
+    and the files read from directories passed as arguments
+    """
+    h = hashlib.sha256()
+    normalized = {k: v for k, v in args.items() if k not in IGNORED_ARGS}
+    h.update(json.dumps(normalized, sort_keys=True, default=str).encode("utf-8"))
+    for path in sorted(glob.glob(os.path.join(MODULES_DIR, "*.py"))):
+        h.update(os.path.basename(path).encode("utf-8"))
+        h.update(_file_digest(path).encode("utf-8"))
+    for name in sorted(normalized):
+        for path in _referenced_files(normalized[name]):
+            h.update(path.encode("utf-8"))
+            h.update(_file_digest(path).encode("utf-8"))
+        for path in _read_files(name, normalized[name]):
+            h.update(path.encode("utf-8"))
+            h.update((_file_digest(path) if os.path.isfile(path) else "missing").encode("utf-8"))
+    return h.hexdigest()
+
+
+class ComposeCache(object):
+    """
+    store rendered docker-compose documents by cache key, along with the
+    key of the document that was last brought up for each compose file
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        """return the cached entry for key, or None"""
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, entry):
+        """store an entry, atomically so concurrent runs never see a partial file"""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp = "{}.{}.tmp".format(self._path(key), os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(entry, f, sort_keys=True)
+        os.rename(tmp, self._path(key))
+
+    def _up_path(self):
+        return os.path.join(self.cache_dir, "up.json")
+
+    def _up_state(self):
+        try:
+            with open(self._up_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def last_up(self, compose_path):
+        """return the key of the document last brought up from compose_path"""
+        return self._up_state().get(os.path.abspath(compose_path))
+
+    def record_up(self, compose_path, key):
+        """record the key of the document brought up from compose_path, None when it was not cached"""
+        state = self._up_state()
+        if key is None:
+            state.pop(os.path.abspath(compose_path), None)
+        else:
+            state[os.path.abspath(compose_path)] = key
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp = "{}.{}.tmp".format(self._up_path(), os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(tmp, self._up_path())
+
+
+def mutable_images(compose):
+    """
+    return the long running services (those with a healthcheck) whose image tag may point to another image
+    over time, like snapshots or latest, so that an unchanged document does not mean unchanged containers
+    """
+    ret = []
+    for name, service in sorted(compose["services"].items()):
+        image = service.get("image")
+        if not image or "@" in image or not service.get("healthcheck"):
+            continue
+        repository = image.rsplit("/", 1)[-1]
+        tag = repository.rsplit(":", 1)[1] if ":" in repository else "latest"
+        if tag == "latest" or "SNAPSHOT" in tag.upper():
+            ret.append(name)
+    return ret
@@ -4,21 +4,30 @@
 
 import codecs
 import functools
+import hashlib
 import json
+import math
 import multiprocessing
 import os
 import re
 import subprocess
 import sys
+import tarfile
+import threading
 import uuid
 import time
+import zlib
+
+from multiprocessing.pool import ThreadPool
 
 try:
-    from urllib.request import urlopen, urlretrieve, Request
+    from http.client import IncompleteRead
+    from urllib.error import HTTPError
+    from urllib.request import urlopen, Request
     from urllib.parse import urlparse
 except ImportError:
-    from urllib import urlretrieve
-    from urllib2 import urlopen, Request
+    from httplib import IncompleteRead
+    from urllib2 import urlopen, HTTPError, Request
     import urllib2
     urlparse = urllib2.urlparse.urlparse
 
@@ -27,39 +36,517 @@ def _camel_hyphen(string):
     return re.sub(r'([a-z])([A-Z])', r'\1-\2', string)
 
 
-def _load_image(cache_dir, url):
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+# seconds before the first retry of a download, doubled on each retry up to DOWNLOAD_RETRY_MAX_DELAY
+DOWNLOAD_RETRY_DELAY = 1
+DOWNLOAD_RETRY_MAX_DELAY = 30
+
+
+def parse_rate(rate):
+    """parse a bandwidth such as 500K, 20M or 1G into bytes per second"""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?(?:/s)?\s*$', str(rate), re.IGNORECASE)
+    if not m:
+        raise ValueError("invalid rate: {}".format(rate))
+    return int(float(m.group(1)) * 1024 ** " kmg".index(m.group(2).lower() or " "))
+
+
+class RateLimiter(object):
+    """token bucket shared by all downloads, to cap their combined bandwidth"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= size
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class DownloadProgress(object):
+    """aggregate progress of concurrent downloads, printed at most once per interval"""
+
+    def __init__(self, out=sys.stdout, interval=1.0):
+        self.out = out
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.total = {}
+        self.done = {}
+        self.started = time.time()
+        self.printed = 0
+
+    def start(self, url, total, done=0):
+        with self.lock:
+            self.total[url] = total
+            self.done[url] = done
+
+    def update(self, url, size):
+        with self.lock:
+            self.done[url] = self.done.get(url, 0) + size
+            now = time.time()
+            if now - self.printed < self.interval:
+                return
+            self.printed = now
+            line = self.line(now)
+        self.out.write(line + "\n")
+        self.out.flush()
+
+    def line(self, now=None):
+        done = sum(self.done.values())
+        total = sum(self.total.values())
+        elapsed = max((now or time.time()) - self.started, 0.001)
+        percent = " ({:.0f}%)".format(100.0 * done / total) if total else ""
+        return "downloading {} images: {:.1f}/{:.1f} MB{} at {:.1f} MB/s".format(
+            len(self.total), done / 1048576.0, total / 1048576.0, percent, done / 1048576.0 / elapsed)
+
+
+def _content_range_size(value):
+    """return the complete size from a Content-Range header, such as bytes */1234, or None"""
+    m = re.match(r'^\s*bytes\s+(?:\*|\d+-\d+)/(\d+)\s*$', value or '')
+    return int(m.group(1)) if m else None
+
+
+def _retryable(error):
+    """whether a download may succeed when tried again: after connection errors, server errors and short reads"""
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+    return isinstance(error, (IOError, OSError, IncompleteRead))
+
+
+def _download(url, filepath, etag=None, progress=None, limiter=None, load=False, reader=None):
+    """
+    download url to filepath, through filepath.part. an existing partial download of the same
+    version of the file (same etag) is resumed with a range request.
+
+    with load, the download is also streamed into `docker load` as it arrives, replaying any partial
+    download first. filepath may then be None to load the image without keeping a copy of it.
+    reader, such as a ManifestReader, is reset and then sent the whole file in the same way on each attempt.
+
+    returns the sha256 of the downloaded file on success, None otherwise.
+    """
+    part = filepath + '.part' if filepath else None
+    part_etag_file = part + '.etag' if part else None
+    for attempt in range(DOWNLOAD_RETRIES):
+        offset = 0
+        if part and os.path.exists(part):
+            part_etag = None
+            if os.path.exists(part_etag_file):
+                with open(part_etag_file) as f:
+                    part_etag = f.read().strip()
+            if etag and part_etag == etag:
+                offset = os.path.getsize(part)
+        if part:
+            with open(part_etag_file, 'w') as f:
+                f.write(etag or '')
+        request = Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        loader = None
+        out = None
+        try:
+            try:
+                response = urlopen(request)
+            except HTTPError as e:
+                if not offset or e.code != 416:
+                    raise
+                if _content_range_size(e.info().get('Content-Range')) != offset:
+                    print("Partial download of %s doesn't match the file, starting over" % url)
+                    os.remove(part)
+                    continue
+                # the partial download is already complete, only finish it
+                response = None
+            if response is not None and offset and response.getcode() != 206:
+                # the server ignored the range, start over
+                offset = 0
+            length = response.info().get('Content-Length') if response is not None else '0'
+            if progress:
+                progress.start(url, offset + int(length) if length else 0, offset)
+            digest = hashlib.sha256()
+            if load:
+                loader = subprocess.Popen(["docker", "load"], stdin=subprocess.PIPE)
+            if reader:
+                reader.reset()
+            if offset:
+                with open(part, 'rb') as f:
+                    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        if loader:
+                            loader.stdin.write(chunk)
+                        if reader:
+                            reader.write(chunk)
+            sinks = []
+            if part:
+                out = open(part, 'ab' if offset else 'wb')
+                sinks.append(out)
+            if loader:
+                sinks.append(loader.stdin)
+            if reader:
+                sinks.append(reader)
+            size = offset
+            while response is not None:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if limiter:
+                    limiter.consume(len(chunk))
+                digest.update(chunk)
+                for sink in sinks:
+                    sink.write(chunk)
+                size += len(chunk)
+                if progress:
+                    progress.update(url, len(chunk))
+            if out:
+                out.close()
+            if length and size != offset + int(length):
+                raise IOError("incomplete download, got {} of {} bytes".format(size, offset + int(length)))
+            if loader:
+                loader.stdin.close()
+                if loader.wait():
+                    raise IOError("docker load exited with code {}".format(loader.returncode))
+        except Exception as e:
+            print('Error while fetching %s (attempt %d/%d): %s' % (url, attempt + 1, DOWNLOAD_RETRIES, str(e)))
+            if out:
+                out.close()
+            if loader and loader.poll() is None:
+                loader.kill()
+                loader.wait()
+            if not _retryable(e):
+                return None
+            if attempt + 1 < DOWNLOAD_RETRIES:
+                time.sleep(min(DOWNLOAD_RETRY_DELAY * 2 ** attempt, DOWNLOAD_RETRY_MAX_DELAY))
+            continue
+        if part:
+            os.rename(part, filepath)
+            os.remove(part_etag_file)
+        return digest.hexdigest()
+    return None
+
+
+# how images are loaded: downloaded to the cache and then loaded, streamed into docker load,
+# or streamed into docker load while keeping a copy in the cache
+IMAGE_LOAD_MODES = ("file", "stream", "tee")
+
+# seconds during which a cached image is assumed current without asking the server
+DEFAULT_IMAGE_CACHE_TTL = 3600
+
+# size of the image cache, in bytes, before the least recently used images are evicted
+DEFAULT_IMAGE_CACHE_SIZE = 20 * 1024 ** 3
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageCache(object):
+    """
+    index of the image cache directory, in index.json, recording for each image url its file,
+    etag, size, sha256, and when it was last used, last checked against the server and last verified.
+    entries without a file record images which were streamed into docker load.
+    """
+
+    def __init__(self, cache_dir, ttl=DEFAULT_IMAGE_CACHE_TTL, max_size=DEFAULT_IMAGE_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, index):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.index_path)
+
+    def get(self, url):
+        """return the entry for url, falling back to the .etag files written by earlier versions"""
+        with self.lock:
+            entry = self._read().get(url)
+        if entry:
+            return entry
+        filename = os.path.basename(url)
+        filepath = os.path.join(self.cache_dir, filename)
+        if os.path.exists(filepath + '.etag') and os.path.exists(filepath):
+            with open(filepath + '.etag') as f:
+                return dict(file=filename, etag=f.read().strip(), size=os.path.getsize(filepath))
+        return None
+
+    def update(self, url, **fields):
+        """update the entry for url, re-reading the index so concurrent runs don't drop each other's entries"""
+        with self.lock:
+            index = self._read()
+            entry = index.setdefault(url, {})
+            entry.update(fields)
+            self._write(index)
+            return entry
+
+    def path(self, entry):
+        return os.path.join(self.cache_dir, entry['file']) if entry and entry.get('file') else None
+
+    def fresh(self, entry):
+        """whether the entry was checked against the server less than ttl seconds ago"""
+        return bool(entry) and time.time() - entry.get('checked', 0) < self.ttl
+
+    def verified_recently(self, entry):
+        """whether the cached file of the entry was verified less than ttl seconds ago"""
+        return time.time() - entry.get('verified', 0) < self.ttl
+
+    def present(self, entry):
+        """whether the cached file of an entry exists with the recorded size"""
+        path = self.path(entry)
+        return bool(path) and os.path.exists(path) and os.path.getsize(path) == entry.get('size')
+
+    def verify(self, entry):
+        """whether the cached file of an entry has the recorded size and sha256"""
+        return self.present(entry) and _file_sha256(self.path(entry)) == entry.get('sha256')
+
+    def evict(self, keep=()):
+        """remove the least recently used files until the cache fits in max_size, except those of urls in keep"""
+        if self.max_size is None:
+            return []
+        evicted = []
+        with self.lock:
+            index = self._read()
+            cached = [(url, entry) for url, entry in index.items() if self.present(entry)]
+            total = sum(entry['size'] for _, entry in cached)
+            for url, entry in sorted(cached, key=lambda e: e[1].get('last_used', 0)):
+                if total <= self.max_size:
+                    break
+                if url in keep:
+                    continue
+                os.remove(self.path(entry))
+                total -= entry['size']
+                del index[url]
+                evicted.append(url)
+            if evicted:
+                self._write(index)
+        for url in evicted:
+            print("evicted %s from the image cache" % os.path.basename(url))
+        return evicted
+
+
+def _remove_legacy_etag(filepath):
+    # superseded by the cache index
+    if os.path.exists(filepath + '.etag'):
+        os.remove(filepath + '.etag')
+
+
+def _manifest_image(manifest):
+    if not manifest:
+        return None, []
+    # Config is <id>.json, or blobs/sha256/<id> for OCI layouts
+    image_id = 'sha256:' + os.path.basename(manifest[0]['Config']).replace('.json', '')
+    return image_id, sorted(tag for image in manifest for tag in image.get('RepoTags') or [])
+
+
+def image_manifest(path):
+    """
+    return the image id and tags from the manifest of an image tar, as written by `docker save`,
+    or (None, []) if it can't be read
+    """
+    try:
+        with tarfile.open(path, 'r|*') as tar:
+            for member in tar:
+                if member.name == 'manifest.json':
+                    manifest = json.loads(tar.extractfile(member).read().decode('utf-8'))
+                    break
+            else:
+                return None, []
+    except (tarfile.TarError, IOError, OSError, ValueError):
+        return None, []
+    return _manifest_image(manifest)
+
+
+class ManifestReader(object):
+    """
+    picks manifest.json out of a, possibly gzipped, image tar as it is downloaded, so that the image id
+    and tags are known without reading the tar again. only the tar headers are parsed, member data is skipped.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.decompressor = None
+        self.started = False
+        self.head = b''
+        self.buffer = b''
+        self.skip = 0
+        self.size = None
+        self.manifest = None
+        self.done = False
+
+    def write(self, chunk):
+        if self.done or not chunk:
+            return
+        if not self.started:
+            # enough to tell gzip from tar
+            self.head += chunk
+            if len(self.head) < 2:
+                return
+            chunk, self.head = self.head, b''
+            self.started = True
+            if chunk[:2] == b'\x1f\x8b':
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            self.buffer += self.decompressor.decompress(chunk) if self.decompressor else chunk
+        except zlib.error:
+            self.done = True
+            return
+        while not self.done:
+            if self.skip:
+                skipped = min(self.skip, len(self.buffer))
+                self.buffer = self.buffer[skipped:]
+                self.skip -= skipped
+                if self.skip:
+                    return
+            if self.size is not None:
+                if len(self.buffer) < self.size:
+                    return
+                try:
+                    self.manifest = json.loads(self.buffer[:self.size].decode('utf-8'))
+                except ValueError:
+                    pass
+                self.done = True
+                self.buffer = b''
+                return
+            if len(self.buffer) < 512:
+                return
+            header, self.buffer = self.buffer[:512], self.buffer[512:]
+            try:
+                size = int(header[124:136].split(b'\0')[0].strip() or b'0', 8)
+            except ValueError:
+                # end of the archive, or not a tar
+                self.done = True
+                return
+            if header[:100].split(b'\0')[0] == b'manifest.json' and header[156:157] in (b'0', b'\0'):
+                self.size = size
+            else:
+                # member data is padded to 512 bytes blocks
+                self.skip = (size + 511) // 512 * 512
+
+    def image(self):
+        """return the image id and tags from the manifest, or (None, []) if it wasn't found"""
+        try:
+            return _manifest_image(self.manifest)
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return None, []
+
+
+def image_loaded(image_id, tags):
+    """whether the docker daemon has the image, under all of its tags"""
+    with open(os.devnull, 'w') as devnull:
+        for ref in tags or [image_id]:
+            try:
+                got = subprocess.check_output(["docker", "image", "inspect", "--format", "{{.Id}}", ref],
+                                              stderr=devnull)
+            except (subprocess.CalledProcessError, OSError):
+                return False
+            if got.decode('utf-8').strip() != image_id:
+                return False
+    return True
+
+
+def _ensure_loaded(cache, url, entry):
+    """
+    docker load the cached file of an entry, unless the daemon already has its image.
+    returns False, after removing it, when the file doesn't match its sha256 anymore.
+    """
+    filepath = cache.path(entry)
+    if 'image_id' not in entry:
+        image_id, tags = image_manifest(filepath)
+        entry = cache.update(url, image_id=image_id, tags=tags)
+    if entry['image_id'] and image_loaded(entry['image_id'], entry['tags']):
+        print("Skipping docker load of %s, %s is already loaded" % (
+            entry['file'], ", ".join(entry['tags']) or entry['image_id']))
+        return True
+    # the file is about to be loaded, make sure it wasn't damaged since it was downloaded
+    if not cache.verified_recently(entry):
+        if not cache.verify(entry):
+            print("Checksum mismatch for %s, downloading it again" % entry['file'])
+            os.remove(filepath)
+            return False
+        cache.update(url, verified=time.time())
+    subprocess.check_call(["docker", "load", "-i", filepath])
+    return True
+
+
+def _load_image(cache_dir, url, progress=None, limiter=None, mode="file", cache=None):
+    if cache is None:
+        cache = ImageCache(cache_dir)
     filename = os.path.basename(url)
     filepath = os.path.join(cache_dir, filename)
-    etag_cache_file = filepath + '.etag'
-    if os.path.exists(etag_cache_file):
-        with open(etag_cache_file, mode='r') as f:
-            etag = f.read().strip()
+    entry = cache.get(url)
+    current = entry and (mode == "stream" or cache.present(entry))
+    if current and cache.fresh(entry):
+        print("Skipping download of %s, local file was checked recently" % filename)
+        entry = cache.update(url, last_used=time.time())
+        new_etag = entry.get('etag')
     else:
-        etag = None
-    request = Request(url)
-    request.get_method = lambda: 'HEAD'
-    try:
-        response = urlopen(request)
-    except Exception as e:
-        print('Error while fetching %s: %s' % (url, str(e)))
-        return False
-    new_etag = response.info().get('ETag')
-    if etag == new_etag:
-        print("Skipping download of %s, local file is current" % filename)
+        request = Request(url)
+        request.get_method = lambda: 'HEAD'
+        try:
+            response = urlopen(request)
+        except Exception as e:
+            print('Error while fetching %s: %s' % (url, str(e)))
+            return False
+        new_etag = response.info().get('ETag')
+        current = current and entry.get('etag') == new_etag
+        if current:
+            print("Skipping download of %s, local file is current" % filename)
+            if entry.get('file') and not entry.get('sha256'):
+                # migrated from an .etag file
+                entry = dict(entry, sha256=_file_sha256(filepath), verified=time.time())
+            entry = cache.update(url, **dict(entry, last_used=time.time(), checked=time.time()))
+            _remove_legacy_etag(filepath)
+    if current and cache.present(entry):
+        if _ensure_loaded(cache, url, entry):
+            return True
+        current = False
+    if current and entry.get('image_id') and image_loaded(entry['image_id'], entry.get('tags')):
         return True
+    if current:
+        # streamed into docker load, but the daemon doesn't have it (anymore)
+        print("%s is not loaded, streaming it again" % filename)
     print("downloading", url)
     try:
         os.makedirs(cache_dir)
     except Exception:  # noqa: E722
         pass  # ignore
-    try:
-        urlretrieve(url, filepath)
-    except Exception as e:
-        print('Error while fetching %s: %s' % (url, str(e)))
+    keep_file = mode in ("file", "tee")
+    reader = ManifestReader()
+    sha256 = _download(url, filepath if keep_file else None, new_etag, progress, limiter, load=mode != "file",
+                       reader=reader)
+    if not sha256:
         return False
-    subprocess.check_call(["docker", "load", "-i", filepath])
-    with open(etag_cache_file, mode='w') as f:
-        f.write(new_etag)
+    image_id, tags = reader.image()
+    # sha256 is the digest of what was written to the file, there's no need to read it back
+    entry = cache.update(url, file=filename if keep_file else None, etag=new_etag, sha256=sha256,
+                         size=os.path.getsize(filepath) if keep_file else None, image_id=image_id, tags=tags,
+                         last_used=time.time(), checked=time.time(), verified=time.time())
+    if mode == "file":
+        _ensure_loaded(cache, url, entry)
+    _remove_legacy_etag(filepath)
     return True
 
 
@@ -68,15 +555,30 @@ def generated_version():
     return uuid.uuid4()
 
 
-def load_images(urls, cache_dir):
-    load_image_fn = functools.partial(_load_image, cache_dir)
-    pool = multiprocessing.Pool(4)
+def load_images(urls, cache_dir, concurrency=4, max_rate=None, mode="file", ttl=DEFAULT_IMAGE_CACHE_TTL,
+                max_size=DEFAULT_IMAGE_CACHE_SIZE):
+    """
+    download and docker load images, concurrency at a time.
+    max_rate caps the combined download bandwidth, in bytes per second.
+    mode is one of IMAGE_LOAD_MODES.
+    images checked less than ttl seconds ago are not checked again, and the least recently used
+    images are evicted from the cache once it grows beyond max_size bytes.
+    """
+    progress = DownloadProgress()
+    limiter = RateLimiter(max_rate) if max_rate else None
+    cache = ImageCache(cache_dir, ttl=ttl, max_size=max_size)
+    load_image_fn = functools.partial(_load_image, cache_dir, progress=progress, limiter=limiter, mode=mode,
+                                      cache=cache)
+    pool = ThreadPool(max(1, min(concurrency, len(urls))))
     # b/c python2
     try:
         results = pool.map_async(load_image_fn, urls).get(timeout=10000000)
     except KeyboardInterrupt:
         pool.terminate()
         raise
+    finally:
+        pool.close()
+    cache.evict(keep=urls)
     if not all(results):
         print("Errors while downloading. Exiting.")
         sys.exit(1)
@@ -191,23 +693,134 @@ def wget_healthcheck(port, host="localhost", path="/healthcheck",
     }
 
 
-build_manifests = {}  # version -> manifest cache
+def _duration_seconds(duration):
+    """parse a docker-compose duration such as 1m30s or 500ms into seconds"""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001, "us": 0.000001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(h|ms|us|m|s)", duration)
+    if not parts:
+        raise ValueError("invalid duration: {}".format(duration))
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+def adaptive_healthcheck(healthcheck, boot_time, max_interval=DEFAULT_HEALTHCHECK_INTERVAL):
+    """
+    tune a healthcheck for a service which usually becomes healthy after boot_time seconds:
+    check often, at a fifth of the boot time but at least every second, and don't count failures
+    during twice the boot time. retries are raised so the service is given at least as long
+    to become healthy as before.
+    """
+    if not healthcheck or healthcheck.get("disable"):
+        return healthcheck
+    ret = dict(healthcheck)
+    old_interval = _duration_seconds(healthcheck.get("interval", "30s"))
+    interval = max(1, min(int(round(boot_time / 5.0)), int(_duration_seconds(max_interval))))
+    if interval >= old_interval:
+        return healthcheck
+    budget = old_interval * healthcheck.get("retries", 3)
+    start_period = max(int(math.ceil(boot_time * 2)), 1)
+    if "start_period" in healthcheck:
+        start_period = max(start_period, int(_duration_seconds(healthcheck["start_period"])))
+    ret["interval"] = "{}s".format(interval)
+    ret["start_period"] = "{}s".format(start_period)
+    ret["retries"] = max(healthcheck.get("retries", 3), int(math.ceil(budget / interval)))
+    return ret
+
+
+build_manifests = {}  # (version, build id) -> manifest cache
+
+# where build candidates are published, overridden to use a mirror
+DEFAULT_BC_BASE_URL = "https://staging.elastic.co"
+
+# where build candidate manifests are cached by default
+BC_MANIFEST_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.manifests')
+
+# seconds during which the manifest of the latest build candidate of a version is reused
+DEFAULT_LATEST_BC_TTL = 600
+
+
+class BuildManifestCache(object):
+    """
+    build candidate manifests on disk, one file per version and build id.
+    the manifest of a build id never changes, the latest build candidate's expires after latest_ttl seconds.
+    """
 
+    def __init__(self, cache_dir=BC_MANIFEST_CACHE_DIR, latest_ttl=DEFAULT_LATEST_BC_TTL):
+        self.cache_dir = cache_dir
+        self.latest_ttl = latest_ttl
 
-def latest_build_manifest(version):
+    def path(self, version, build_id):
+        return os.path.join(self.cache_dir, re.sub(r'[^\w.-]', '_', '{}-{}.json'.format(version, build_id)))
+
+    def get(self, version, build_id):
+        path = self.path(version, build_id)
+        try:
+            if build_id == "latest" and time.time() - os.path.getmtime(path) >= self.latest_ttl:
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, version, build_id, manifest):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.path(version, build_id)
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, path)
+
+
+def rebase_urls(value, base_url):
+    """rewrite the urls in a build candidate manifest to the same paths under base_url"""
+    if isinstance(value, dict):
+        return {k: rebase_urls(v, base_url) for k, v in value.items()}
+    if isinstance(value, list):
+        return [rebase_urls(v, base_url) for v in value]
+    if isinstance(value, (str, type(u''))) and re.match(r'^https?://', value):
+        return base_url.rstrip('/') + urlparse(value).path
+    return value
+
+
+def latest_build_manifest(version, base_url=None):
+    base_url = (base_url or DEFAULT_BC_BASE_URL).rstrip('/')
     minor_version = ".".join(version.split(".", 2)[:2])
-    rsp = urlopen("https://staging.elastic.co/latest/{}.json".format(minor_version))
+    rsp = urlopen("{}/latest/{}.json".format(base_url, minor_version))
     if rsp.code != 200:
         raise Exception("failed to query build candidates at {}: {}".format(rsp.geturl(), rsp.info()))
     encoding = "utf-8"  # python2 rsp.headers.get_content_charset("utf-8")
-    info = json.load(codecs.getreader(encoding)(rsp))
+    info = rebase_urls(json.load(codecs.getreader(encoding)(rsp)), base_url)
     if "summary_url" in info:
         print("found latest build candidate for {} - {} at {}".format(minor_version, info["summary_url"], rsp.geturl()))
     return info["manifest_url"]
 
 
-def resolve_bc(version, build_id):
-    """construct or discover build candidate manifest url"""
+def build_manifest_url(version, build_id, base_url=None):
+    """return the url of a build candidate manifest, that of the latest build candidate if build_id is latest"""
+    base_url = (base_url or DEFAULT_BC_BASE_URL).rstrip('/')
+    if build_id == "latest":
+        return latest_build_manifest(version, base_url)
+    return "{base_url}/{patch_version}-{sha}/manifest-{patch_version}.json".format(
+        base_url=base_url,
+        patch_version=version,
+        sha=build_id,
+    )
+
+
+def fetch_build_manifest(version, build_id, base_url=None):
+    """fetch a build candidate manifest from base_url, as published"""
+    rsp = urlopen(build_manifest_url(version, build_id, base_url))
+    if rsp.code != 200:
+        raise Exception("failed to fetch build manifest at {}: {}".format(rsp.geturl(), rsp.info()))
+    encoding = "utf-8"  # python2 rsp.headers.get_content_charset("utf-8")
+    return json.load(codecs.getreader(encoding)(rsp))
+
+
+def resolve_bc(version, build_id, cache=None, base_url=None):
+    """
+    construct or discover build candidate manifest url.
+    with base_url, the manifest is fetched from there and its urls point there too.
+    """
     if build_id is None:
         return
 
@@ -215,25 +828,36 @@ def resolve_bc(version, build_id):
         return
 
     # check cache
-    if version in build_manifests:
-        return build_manifests[version]
-
-    if build_id == "latest":
-        manifest_url = latest_build_manifest(version)
-    else:
-        manifest_url = "https://staging.elastic.co/{patch_version}-{sha}/manifest-{patch_version}.json".format(
-            patch_version=version,
-            sha=build_id,
-        )
-    rsp = urlopen(manifest_url)
-    if rsp.code != 200:
-        raise Exception("failed to fetch build manifest at {}: {}".format(rsp.geturl(), rsp.info()))
-    encoding = "utf-8"  # python2 rsp.headers.get_content_charset("utf-8")
-    manifest = json.load(codecs.getreader(encoding)(rsp))
-    build_manifests[version] = manifest  # fill cache
+    key = (version, build_id)
+    if key in build_manifests:
+        return build_manifests[key]
+
+    manifest = cache.get(version, build_id) if cache else None
+    if manifest is None:
+        manifest = fetch_build_manifest(version, build_id, base_url)
+        if cache:
+            cache.put(version, build_id, manifest)
+    if base_url:
+        # download images from the same place
+        manifest = rebase_urls(manifest, base_url)
+    build_manifests[key] = manifest  # fill cache
     return manifest
 
 
+def prefetch_bcs(candidates, cache=None, base_url=None, concurrency=8):
+    """
+    resolve the manifests of (version, build id) pairs concurrently, ahead of services resolving them one by one
+    """
+    pending = sorted(set(c for c in candidates if c[0] and c[1]) - set(build_manifests))
+    if not pending:
+        return
+    pool = ThreadPool(min(concurrency, len(pending)))
+    try:
+        pool.map(lambda candidate: resolve_bc(candidate[0], candidate[1], cache, base_url), pending)
+    finally:
+        pool.close()
+
+
 def parse_version(version):
     res = []
     for x in version.split('.'):
@@ -245,6 +869,85 @@ def parse_version(version):
     return res
 
 
+@functools.total_ordering
+class StackVersion(object):
+    """
+    a stack version such as 8.13.0, 7.17 or 8.0.0-SNAPSHOT, parsed once and interned:
+    StackVersion("8.0.0") is StackVersion("8.0.0").
+
+    versions order by release, with missing components counting as 0, and a snapshot or pre-release
+    orders before its release. at_least and lower_than gate features on the release alone,
+    so 8.0.0-SNAPSHOT and 8.0.0-rc1 are at least 8.0.
+    """
+    __slots__ = ("string", "release", "prerelease", "_key", "_at_least")
+
+    _interned = {}
+
+    def __new__(cls, version):
+        if isinstance(version, StackVersion):
+            return version
+        interned = cls._interned.get(version)
+        if interned is not None:
+            return interned
+        self = object.__new__(cls)
+        self.string = version
+        release, _, self.prerelease = version.partition("-")
+        numbers = [int(x) for x in release.split(".")]
+        self.release = tuple(numbers + [0] * (3 - len(numbers)))
+        self._key = (self.release, 0 if self.prerelease else 1, self.prerelease)
+        self._at_least = {}
+        return cls._interned.setdefault(version, self)
+
+    def at_least(self, target):
+        """whether this is a release of target or later, ignoring any pre-release suffix"""
+        ret = self._at_least.get(target)
+        if ret is None:
+            ret = self._at_least[target] = self.release >= StackVersion(target).release
+        return ret
+
+    def lower_than(self, target):
+        return not self.at_least(target)
+
+    @property
+    def snapshot(self):
+        return self.prerelease == "SNAPSHOT"
+
+    @staticmethod
+    def _coerce(other):
+        """other as a StackVersion, or None when it is neither a version nor a version string"""
+        if isinstance(other, StackVersion):
+            return other
+        try:
+            return StackVersion(other) if isinstance(other, str) else None
+        except ValueError:
+            return None
+
+    def __eq__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __lt__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return self._key < other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __str__(self):
+        return self.string
+
+    def __repr__(self):
+        return "StackVersion({!r})".format(self.string)
+
+
 def add_agent_environment(mappings):
     def fn(func):
         def add_content(self):
@@ -276,3 +979,41 @@ def dyno(dyno_env):
             return content
         return munge_env
     return fn
+
+
+COMPOSE_OUTPUT_FORMATS = ("json", "json-compact", "yaml")
+
+
+def _yaml_chunks(compose, yaml):
+    """
+    yaml for a docker-compose document, one top level key and one service at a time.
+
+    each service is dumped under its own `services:` key, which is only kept for the first one,
+    so the document reads exactly as if it had been dumped in one go.
+    """
+    dumper = getattr(yaml, "CDumper", yaml.Dumper)
+    kwargs = dict(Dumper=dumper, default_flow_style=False, indent=2)
+    yield "---\n"
+    for key in sorted(compose):
+        services = compose[key]
+        if key != "services" or not isinstance(services, dict) or not services:
+            yield yaml.dump({key: services}, **kwargs)
+            continue
+        yield "services:\n"
+        for name in sorted(services):
+            chunk = yaml.dump({key: {name: services[name]}}, **kwargs)
+            yield chunk[chunk.index("\n") + 1:]
+
+
+def write_compose(compose, stream, output_format="json"):
+    """write a docker-compose document to stream, libyaml is used for yaml when pyyaml was built with it"""
+    if output_format == "yaml":
+        import yaml
+        for chunk in _yaml_chunks(compose, yaml):
+            stream.write(chunk)
+    elif output_format == "json-compact":
+        # docker-compose reads json, the C encoder is only used without indentation
+        stream.write(json.dumps(compose, separators=(",", ":"), sort_keys=True))
+    else:
+        # one write of the whole document rather than one per token
+        stream.write(json.dumps(compose, indent=2, sort_keys=True))
@@ -0,0 +1,168 @@
+#
+# local mirror of build candidates, served in place of staging.elastic.co
+#
+
+import codecs
+import json
+import os
+import posixpath
+import re
+import shutil
+
+from multiprocessing.pool import ThreadPool
+
+from .helpers import (DEFAULT_BC_BASE_URL, DownloadProgress, RateLimiter, _download, build_manifest_url,
+                      rebase_urls)
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote, urlparse
+    from urllib.request import urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urllib2 import urlopen
+    from urlparse import urlparse
+
+# where build candidates are mirrored by default
+DEFAULT_MIRROR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.mirror')
+
+DEFAULT_MIRROR_PORT = 8899
+
+# images of the services started by default
+DEFAULT_MIRROR_IMAGES = ("elasticsearch", "kibana", "apm-server")
+
+
+def mirror_path(mirror_dir, url):
+    """return where a url is kept in the mirror: under the same path as on the server"""
+    parts = [p for p in posixpath.normpath(unquote(urlparse(url).path)).split('/') if p and p != '..']
+    return os.path.join(mirror_dir, *parts)
+
+
+def _fetch_json(url, mirror_dir):
+    """fetch a json document and keep a copy of it in the mirror, as published"""
+    rsp = urlopen(url)
+    if rsp.code != 200:
+        raise Exception("failed to fetch {}: {}".format(rsp.geturl(), rsp.info()))
+    doc = json.load(codecs.getreader("utf-8")(rsp))
+    path = mirror_path(mirror_dir, url)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+    return doc
+
+
+def image_urls(manifest, version, images):
+    """return the docker image urls of a build candidate for each image name, e.g. apm-server or kibana-oss"""
+    packages = {}
+    for project in manifest.get("projects", {}).values():
+        packages.update(project.get("packages", {}))
+    ret = {}
+    for image in images:
+        info = packages.get("{}-{}-docker-image.tar.gz".format(image, version))
+        if info and info.get("type") == "docker":
+            ret[image] = info["url"]
+        else:
+            print("WARNING: no docker image for {} in the {} build candidate".format(image, version))
+    return ret
+
+
+def snapshot(version, build_id, mirror_dir=DEFAULT_MIRROR_DIR, images=DEFAULT_MIRROR_IMAGES, base_url=None,
+             concurrency=4, max_rate=None):
+    """
+    copy a build candidate manifest and the docker images of the given names from base_url into mirror_dir.
+    returns the urls of images which could not be downloaded.
+    """
+    base_url = (base_url or DEFAULT_BC_BASE_URL).rstrip('/')
+    if build_id == "latest":
+        minor_version = ".".join(version.split(".", 2)[:2])
+        info = _fetch_json("{}/latest/{}.json".format(base_url, minor_version), mirror_dir)
+        manifest_url = rebase_urls(info["manifest_url"], base_url)
+    else:
+        manifest_url = build_manifest_url(version, build_id, base_url)
+    print("mirroring", manifest_url)
+    manifest = _fetch_json(manifest_url, mirror_dir)
+    urls = sorted(rebase_urls(url, base_url) for url in image_urls(manifest, version, images).values())
+    pending = [url for url in urls if not os.path.exists(mirror_path(mirror_dir, url))]
+    for url in sorted(set(urls) - set(pending)):
+        print("Skipping download of %s, already mirrored" % os.path.basename(url))
+    if not pending:
+        return []
+    for url in pending:
+        directory = os.path.dirname(mirror_path(mirror_dir, url))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    progress = DownloadProgress()
+    limiter = RateLimiter(max_rate) if max_rate else None
+
+    def download(url):
+        return _download(url, mirror_path(mirror_dir, url), progress=progress, limiter=limiter)
+
+    pool = ThreadPool(max(1, min(concurrency, len(pending))))
+    try:
+        results = pool.map(download, pending)
+    finally:
+        pool.close()
+    return [url for url, sha256 in zip(pending, results) if not sha256]
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """serve the mirror directory, with the etags and range requests image downloads rely on"""
+
+    def _send_head(self):
+        path = mirror_path(self.server.mirror_dir, self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None, 0
+        stat = os.stat(path)
+        size = stat.st_size
+        start = 0
+        m = re.match(r'^bytes=(\d+)-$', self.headers.get('Range') or '')
+        if m and int(m.group(1)) < size:
+            start = int(m.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json" if path.endswith(".json") else "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("ETag", '"{:x}-{:x}"'.format(int(stat.st_mtime), size))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return path, start
+
+    def do_HEAD(self):
+        self._send_head()
+
+    def do_GET(self):
+        path, start = self._send_head()
+        if path:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                shutil.copyfileobj(f, self.wfile)
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, mirror_dir=DEFAULT_MIRROR_DIR):
+        HTTPServer.__init__(self, address, MirrorRequestHandler)
+        self.mirror_dir = mirror_dir
+
+
+def serve(mirror_dir=DEFAULT_MIRROR_DIR, port=DEFAULT_MIRROR_PORT, bind="0.0.0.0"):
+    """serve the mirror until interrupted"""
+    server = MirrorServer((bind, port), mirror_dir)
+    print("serving {} at http://{}:{}, use it with --bc-base-url http://localhost:{}".format(
+        mirror_dir, bind, server.server_address[1], server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
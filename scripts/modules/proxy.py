@@ -14,15 +14,30 @@ class Dyno(Service):
 
     def __init__(self, **options):
         super(Dyno, self).__init__(**options)
+        self.worker_class = options.get("dyno_worker_class") or "sync"
+
+    @classmethod
+    def add_arguments(cls, parser):
+        super(Dyno, cls).add_arguments(parser)
+        parser.add_argument(
+            "--dyno-worker-class",
+            choices=("sync", "gevent"),
+            default="sync",
+            help="gunicorn worker model for the Dyno management interface. "
+                 "gevent serves all requests from a single async worker."
+        )
 
     def _content(self):
+        environment = {"TOXI_HOST": "toxi", "TOXI_PORT": "8474"}
+        if self.worker_class != "sync":
+            environment["DYNO_WORKER_CLASS"] = self.worker_class
         return dict(
             build=dict(
                 context="docker/dyno",
                 dockerfile="Dockerfile",
                 args=[]
             ),
-            environment={"TOXI_HOST": "toxi", "TOXI_PORT": "8474"},
+            environment=environment,
             container_name="dyno",
             image=None,
             labels=None,
@@ -0,0 +1,90 @@
+#
+# diff rendered docker-compose services against running containers
+#
+
+import hashlib
+import json
+import subprocess
+
+STACK_VERSION_LABEL = "co.elastic.apm.stack-version"
+CONFIG_HASH_LABEL = "co.elastic.apm.config-hash"
+PROJECT_LABEL = "com.docker.compose.project"
+
+
+def _labels(service):
+    """return the labels of a rendered service as a dict"""
+    labels = service.get("labels") or {}
+    if isinstance(labels, dict):
+        return dict(labels)
+    return dict(label.split("=", 1) if "=" in label else (label, "") for label in labels)
+
+
+# healthcheck settings tuned by --adaptive-healthchecks, which do not warrant recreating a service on their own
+ADAPTIVE_HEALTHCHECK_KEYS = ("interval", "retries", "start_period")
+
+
+def config_hash(service):
+    """
+    hash a rendered service definition, ignoring any config hash label already stamped on it
+    and the healthcheck timing settings
+    """
+    content = dict(service)
+    labels = _labels(service)
+    labels.pop(CONFIG_HASH_LABEL, None)
+    content["labels"] = labels
+    if isinstance(service.get("healthcheck"), dict):
+        content["healthcheck"] = {k: v for k, v in service["healthcheck"].items() if k not in ADAPTIVE_HEALTHCHECK_KEYS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def stamp_config_hashes(services):
+    """add a config hash label to every rendered service, in place"""
+    for service in services.values():
+        digest = config_hash(service)
+        labels = service.get("labels")
+        if isinstance(labels, dict):
+            labels[CONFIG_HASH_LABEL] = digest
+        else:
+            service["labels"] = [label for label in (labels or []) if not label.startswith(CONFIG_HASH_LABEL + "=")]
+            service["labels"].append(CONFIG_HASH_LABEL + "=" + digest)
+
+
+def running_services(project):
+    """
+    return the stack version, config hash and state of every container of a docker-compose project
+    created from a stamped service definition, keyed by docker-compose service name
+    """
+    fmt = '\t'.join((
+        '{{ .Label "com.docker.compose.service" }}',
+        '{{ .Label "' + STACK_VERSION_LABEL + '" }}',
+        '{{ .Label "' + CONFIG_HASH_LABEL + '" }}',
+        '{{ .State }}',
+    ))
+    output = subprocess.check_output(
+        ["docker", "ps", "-a", "--filter", "label=" + CONFIG_HASH_LABEL,
+         "--filter", "label={}={}".format(PROJECT_LABEL, project), "--format", fmt]
+    ).decode("utf8")
+    ret = {}
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) == 4 and fields[0]:
+            ret[fields[0]] = dict(stack_version=fields[1], config_hash=fields[2], state=fields[3])
+    return ret
+
+
+def changed_services(services, running):
+    """
+    return the names of the rendered services which need to be (re)created: those without a
+    container, those whose stack version or config hash differ from their container, and long
+    running services (those with a healthcheck) whose container is not running
+    """
+    changed = []
+    for name, service in sorted(services.items()):
+        container = running.get(name)
+        labels = _labels(service)
+        if (container is None or
+                container["stack_version"] != labels.get(STACK_VERSION_LABEL, "") or
+                container["config_hash"] != labels.get(CONFIG_HASH_LABEL) or
+                (service.get("healthcheck") and container["state"] != "running")):
+            changed.append(name)
+    return changed
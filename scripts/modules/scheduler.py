@@ -0,0 +1,204 @@
+#
+# start docker-compose services in dependency order, as soon as their dependencies are ready
+#
+
+import json
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+SERVICE_LABEL = "com.docker.compose.service"
+
+
+class StartupError(Exception):
+    pass
+
+
+def dependency_graph(services):
+    """
+    return {service: {dependency: condition}} for the rendered services,
+    ignoring dependencies on services which are not part of the document
+    """
+    graph = {}
+    for name, service in services.items():
+        depends_on = service.get("depends_on") or {}
+        if not isinstance(depends_on, dict):
+            depends_on = {d: {"condition": "service_started"} for d in depends_on}
+        graph[name] = {d: (c or {}).get("condition", "service_started")
+                       for d, c in depends_on.items() if d in services}
+    return graph
+
+
+def layers(graph):
+    """group services into layers which only depend on services in earlier layers"""
+    remaining = {name: set(deps) for name, deps in graph.items()}
+    ret = []
+    while remaining:
+        layer = sorted(name for name, deps in remaining.items() if not deps)
+        if not layer:
+            raise StartupError("dependency cycle between: {}".format(", ".join(sorted(remaining))))
+        ret.append(layer)
+        for name in layer:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(layer)
+    return ret
+
+
+def compose_status(docker_compose_cmd):
+    """return the container state of every service in the docker-compose project"""
+    ids = subprocess.check_output(docker_compose_cmd + ["ps", "-q"]).decode("utf8").split()
+    if not ids:
+        return {}
+    ret = {}
+    for container in json.loads(subprocess.check_output(["docker", "inspect"] + ids).decode("utf8")):
+        state = container.get("State", {})
+        name = (container.get("Config", {}).get("Labels") or {}).get(SERVICE_LABEL)
+        if name:
+            ret[name] = dict(
+                status=state.get("Status"),
+                health=(state.get("Health") or {}).get("Status"),
+                exit_code=state.get("ExitCode"),
+            )
+    return ret
+
+
+class StartupScheduler(object):
+    """
+    start services as soon as the conditions on their dependencies are met, rather than layer by layer,
+    and record when each service was started, running and ready
+    """
+
+    def __init__(self, services, start, status, poll_interval=1.0, timeout=900, workers=8,
+                 clock=time.time, sleep=time.sleep, executor=None):
+        """
+        services: rendered docker-compose services
+        start: called with a service name to create and start its container, without dependencies
+        status: returns {service: {"status", "health", "exit_code"}} for all containers
+        executor: runs the start calls, a pool of `workers` threads by default
+        """
+        self.services = services
+        self.graph = dependency_graph(services)
+        layers(self.graph)  # reject cycles before starting anything
+        self.start = start
+        self.status = status
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.workers = workers
+        self.clock = clock
+        self.sleep = sleep
+        self.executor = executor
+        self.timeline = {}
+
+    def _healthchecked(self, name):
+        healthcheck = self.services[name].get("healthcheck")
+        return bool(healthcheck) and not healthcheck.get("disable")
+
+    def _update(self, name, state, now):
+        """record state transitions, raise if the service failed"""
+        times = self.timeline[name]
+        if state["status"] in ("running", "exited") and "running" not in times:
+            times["running"] = now
+        if state["health"] == "unhealthy":
+            raise StartupError("{} is unhealthy".format(name))
+        if state["status"] == "exited" and state["exit_code"]:
+            raise StartupError("{} exited with code {}".format(name, state["exit_code"]))
+        if self._healthchecked(name):
+            ready = state["health"] == "healthy"
+        else:
+            ready = state["status"] == "running" or state["status"] == "exited"
+        if ready and "ready" not in times:
+            times["ready"] = now
+
+    def _satisfied(self, name, done):
+        for dep, condition in self.graph[name].items():
+            if dep in done:
+                continue
+            times = self.timeline.get(dep, {})
+            if condition == "service_healthy" or condition == "service_completed_successfully":
+                if "ready" not in times:
+                    return False
+            elif "running" not in times:
+                return False
+        return True
+
+    def run(self, names=None):
+        """
+        start the given services, or all of them. dependencies outside of names are assumed to be ready.
+        returns the timeline: {service: {"start", "running", "ready"}} in seconds since the scheduler started
+        """
+        names = set(self.services if names is None else names)
+        done = set(self.services) - names
+        executor = self.executor or ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            return self._run(names, done, executor)
+        finally:
+            if self.executor is None:
+                executor.shutdown()
+
+    def _run(self, names, done, executor):
+        begin = self.clock()
+        futures = {}
+        # services whose start call returned. until then, the status of a service may still be that of
+        # the container it replaces, e.g. with --force-recreate
+        started = set()
+        while True:
+            now = self.clock() - begin
+            for name, future in list(futures.items()):
+                if future.done():
+                    del futures[name]
+                    try:
+                        future.result()
+                    except (OSError, subprocess.CalledProcessError) as err:
+                        raise StartupError("{} failed to start: {}".format(name, err))
+                    started.add(name)
+            if started:
+                try:
+                    status = self.status()
+                except (OSError, ValueError, subprocess.CalledProcessError) as err:
+                    raise StartupError("failed to get the status of the containers: {}".format(err))
+                for name in sorted(started):
+                    if name in status:
+                        self._update(name, status[name], now)
+            if all("ready" in self.timeline.get(name, {}) for name in names):
+                return self.timeline
+            # start everything that became ready to start, in the same tick
+            for name in sorted(names - set(self.timeline)):
+                if self._satisfied(name, done):
+                    self.timeline[name] = {"start": now}
+                    futures[name] = executor.submit(self.start, name)
+            if now > self.timeout:
+                waiting = sorted(name for name in names if "ready" not in self.timeline.get(name, {}))
+                raise StartupError("timed out waiting for: {}".format(", ".join(waiting)))
+            self.sleep(self.poll_interval)
+
+    def critical_path(self):
+        """return the chain of services, ending with the last one to become ready, which gated startup"""
+        if not self.timeline:
+            return []
+        name = max(self.timeline, key=lambda n: self.timeline[n].get("ready", 0))
+        path = [name]
+        while True:
+            deps = [d for d in self.graph[name] if d in self.timeline]
+            if not deps:
+                break
+            name = max(deps, key=lambda n: self.timeline[n].get("ready", 0))
+            path.append(name)
+        return list(reversed(path))
+
+    def report(self):
+        """format the timeline, marking services on the critical path"""
+        critical = self.critical_path()
+        lines = ["  {:<28} {:>8} {:>8} {:>8}".format("service", "start", "running", "ready")]
+        for name in sorted(self.timeline, key=lambda n: (self.timeline[n]["start"], n)):
+            times = self.timeline[name]
+            lines.append("{} {:<28} {:>7.1f}s {:>7} {:>7}".format(
+                "*" if name in critical else " ",
+                name,
+                times["start"],
+                "{:.1f}s".format(times["running"]) if "running" in times else "-",
+                "{:.1f}s".format(times["ready"]) if "ready" in times else "-",
+            ))
+        lines.append("critical path: " + " -> ".join(critical))
+        return "\n".join(lines)
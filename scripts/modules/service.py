@@ -5,7 +5,7 @@ import sys
 
 from abc import abstractmethod
 
-from .helpers import resolve_bc, parse_version, _camel_hyphen
+from .helpers import StackVersion, resolve_bc, _camel_hyphen
 
 DEFAULT_STACK_VERSION = "8.0"
 DEFAULT_APM_SERVER_URL = "http://apm-server:8200"
@@ -48,11 +48,12 @@ class Service(object):
         self._ubi8 = options.get(self.option_name() + "_ubi8") or options.get("ubi8")
 
         # version is service specific or stack or default
-        self._version = options.get(self.option_name() + "_version") or options.get("version", DEFAULT_STACK_VERSION)
+        self._version, build_id = self.build_candidate(options)
+        self._stack_version = None
 
         # bc depends on version for resolution
         if not self.option_name().startswith("opbeans"):
-            self._bc = resolve_bc(self._version, options.get(self.option_name() + "_bc") or options.get("bc"))
+            self._bc = resolve_bc(self._version, build_id, base_url=options.get("bc_base_url"))
         else:
             self._bc = ""
 
@@ -73,6 +74,14 @@ class Service(object):
         self._kibana_tls = options.get("kibana_enable_tls", False)
         self._env_vars = options.get(self.option_name() + "_env_vars", [])
 
+    @classmethod
+    def build_candidate(cls, options):
+        """return the version and build candidate id, if any, a service created with options resolves"""
+        version = options.get(cls.option_name() + "_version") or options.get("version", DEFAULT_STACK_VERSION)
+        if cls.option_name().startswith("opbeans"):
+            return version, None
+        return version, options.get(cls.option_name() + "_bc") or options.get("bc")
+
     @property
     def bc(self):
         return self._bc
@@ -114,10 +123,10 @@ class Service(object):
         return False
 
     def at_least_version(self, target):
-        return parse_version(self.version) >= parse_version(target)
+        return self.stack_version.at_least(target)
 
     def version_lower_than(self, target):
-        return parse_version(self.version) < parse_version(target)
+        return self.stack_version.lower_than(target)
 
     @classmethod
     def name(cls):
@@ -175,6 +184,13 @@ class Service(object):
     def version(self):
         return self._version
 
+    @property
+    def stack_version(self):
+        """the version, parsed on first use"""
+        if self._stack_version is None:
+            self._stack_version = StackVersion(self.version)
+        return self._stack_version
+
     @classmethod
     def add_arguments(cls, parser):
         """add service-specific command line arguments"""
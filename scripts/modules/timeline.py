@@ -0,0 +1,180 @@
+#
+# per-service startup timeline from docker events
+#
+
+import calendar
+import json
+import os
+import re
+import subprocess
+import time
+
+PROJECT_LABEL = "com.docker.compose.project"
+SERVICE_LABEL = "com.docker.compose.service"
+
+# where boot times are recorded by default
+BOOT_TIMES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".timelines", "boot_times.json")
+
+# docker event actions and the phase they start
+PHASES = (
+    ("create", "created"),
+    ("start", "running"),
+    ("health_status: healthy", "healthy"),
+)
+
+
+def project_name(compose_dir):
+    """return the docker-compose project name, the way docker-compose derives it"""
+    name = os.environ.get("COMPOSE_PROJECT_NAME") or os.path.basename(os.path.abspath(compose_dir))
+    return re.sub(r"[^-_a-z0-9]", "", name.lower())
+
+
+def project_created(project):
+    """return the creation time of the oldest container of a project, as a unix timestamp, or None"""
+    ids = subprocess.check_output(
+        ["docker", "ps", "-a", "-q", "--filter", "label={}={}".format(PROJECT_LABEL, project)]
+    ).decode("utf8").split()
+    if not ids:
+        return None
+    created = subprocess.check_output(
+        ["docker", "inspect", "-f", "{{ .Created }}"] + ids
+    ).decode("utf8").split()
+    # 2021-01-04T16:24:11.2034Z, only keep seconds precision
+    return min(_parse_time(c) for c in created)
+
+
+def _parse_time(value):
+    return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def docker_events(project, since, until=None):
+    """return the container events of a project between since and until, as decoded json"""
+    cmd = [
+        "docker", "events", "--format", "{{ json . }}",
+        "--since", str(since), "--until", str(until if until is not None else int(time.time())),
+        "--filter", "type=container", "--filter", "label={}={}".format(PROJECT_LABEL, project),
+    ]
+    return [json.loads(line) for line in subprocess.check_output(cmd).decode("utf8").splitlines() if line.strip()]
+
+
+def build_timeline(events):
+    """
+    return {service: {phase: timestamp}} from container events, with the phases listed in PHASES.
+    a container which is created again starts a new timeline for its service.
+    """
+    ret = {}
+    for event in sorted(events, key=lambda e: e.get("timeNano") or e.get("time", 0) * 1e9):
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        service = attributes.get(SERVICE_LABEL)
+        action = event.get("Action") or event.get("status", "")
+        if not service:
+            continue
+        stamp = event["timeNano"] / 1e9 if event.get("timeNano") else float(event.get("time", 0))
+        for trigger, phase in PHASES:
+            if action != trigger:
+                continue
+            if phase == "created":
+                ret[service] = {}
+            phases = ret.setdefault(service, {})
+            if phase not in phases:
+                phases[phase] = stamp
+    return ret
+
+
+def relative(timeline):
+    """return the timeline with timestamps as seconds since the first event, and the first event's timestamp"""
+    stamps = [stamp for phases in timeline.values() for stamp in phases.values()]
+    if not stamps:
+        return {}, None
+    start = min(stamps)
+    return {service: {phase: round(stamp - start, 3) for phase, stamp in phases.items()}
+            for service, phases in timeline.items()}, start
+
+
+def to_json(timeline):
+    services, start = relative(timeline)
+    return json.dumps({"start": start, "services": services}, indent=2, sort_keys=True)
+
+
+def to_text(timeline, width=50):
+    """
+    format the timeline as a gantt chart, one line per service in order of creation:
+    '.' while created, '=' while running and '#' once healthy
+    """
+    services, _ = relative(timeline)
+    if not services:
+        return "No container events found."
+    end = max(stamp for phases in services.values() for stamp in phases.values()) or 1
+    scale = float(width) / end
+
+    def col(seconds):
+        return int(round(seconds * scale))
+
+    lines = ["{:<28} {:>8} {:>8} {:>8}".format("service", "created", "running", "healthy")]
+    for service, phases in sorted(services.items(), key=lambda s: (min(s[1].values()), s[0])):
+        created = phases.get("created", min(phases.values()))
+        running = phases.get("running")
+        healthy = phases.get("healthy")
+        bar = [" "] * (width + 1)
+        for i in range(col(created), col(running if running is not None else end) + 1):
+            bar[i] = "."
+        if running is not None:
+            for i in range(col(running), col(healthy if healthy is not None else end) + 1):
+                bar[i] = "="
+        if healthy is not None:
+            bar[col(healthy)] = "#"
+        lines.append("{:<28} {:>8} {:>8} {:>8} |{}|".format(
+            service,
+            "{:.1f}s".format(created),
+            "{:.1f}s".format(running) if running is not None else "-",
+            "{:.1f}s".format(healthy) if healthy is not None else "-",
+            "".join(bar),
+        ))
+    return "\n".join(lines)
+
+
+class BootTimes(object):
+    """
+    locally recorded boot times, from running to healthy, of each service.
+    only the most recent samples are kept.
+    """
+
+    def __init__(self, path, keep=10):
+        self.path = path
+        self.keep = keep
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def record(self, timeline, ready="healthy"):
+        """
+        record the boot time of every service in a timeline which has reached the ready phase
+        and has a healthcheck, that is, whose ready phase differs from its running phase
+        """
+        samples = self.load()
+        for service, phases in timeline.items():
+            if "running" in phases and ready in phases and phases[ready] > phases["running"]:
+                history = samples.setdefault(service, [])
+                history.append(round(phases[ready] - phases["running"], 3))
+                del history[:-self.keep]
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(samples, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+        return samples
+
+    def expected(self):
+        """return the median recorded boot time of each service"""
+        ret = {}
+        for service, history in self.load().items():
+            if history:
+                ordered = sorted(history)
+                ret[service] = ordered[len(ordered) // 2]
+        return ret
@@ -0,0 +1,119 @@
+#
+# benchmarks for generating the docker-compose configuration, see `make bench-compose`
+#
+# docker-compose and image downloads are stubbed out, so this only measures compose.py itself.
+# The baseline is measured from the merge base in the same run, timings don't compare across machines.
+#
+
+from __future__ import print_function
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from ..modules import cli
+from ..modules.aux_services import WaitService
+from ..modules.cli import LocalSetup, discover_services
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+pytest.importorskip("pytest_benchmark")
+
+STACK_VERSION = "main"
+
+# representative configurations
+CONFIGURATIONS = {
+    "default": [],
+    "all": ["--all"],
+    "all-opbeans-8-apm-servers": ["--all-opbeans", "--apm-server-count", "8"],
+    "dyno": ["--dyno", "--with-opbeans-python"],
+}
+
+
+@pytest.fixture
+def compose_dir():
+    path = tempfile.mkdtemp()
+    yield path
+    shutil.rmtree(path)
+
+
+@pytest.fixture
+def docker_compose():
+    """
+    stub out docker-compose, image downloads and docker events,
+    and remove the toxiproxy configuration written for dyno
+    """
+    toxi_cfg = os.path.join(os.path.dirname(cli.__file__), "..", "..", "docker", "toxi", "toxi.cfg")
+    existed = os.path.exists(toxi_cfg)
+    with contextlib.ExitStack() as stack:
+        run = stack.enter_context(mock.patch.object(LocalSetup, "run_docker_compose_process"))
+        stack.enter_context(mock.patch.object(cli, "load_images"))
+        # boot times are recorded from docker events, which the merge base may not do
+        if hasattr(LocalSetup, "record_boot_times"):
+            stack.enter_context(mock.patch.object(LocalSetup, "record_boot_times"))
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        yield run
+    if not existed and os.path.exists(toxi_cfg):
+        os.remove(toxi_cfg)
+
+
+def argv(compose_dir, configuration):
+    # only options which the merge base understands too, see `make bench-compose-baseline`
+    return ["start", STACK_VERSION, "--docker-compose-path", os.path.join(compose_dir, "docker-compose.yml")
+            ] + CONFIGURATIONS[configuration]
+
+
+def start_setup(compose_dir, configuration):
+    """a LocalSetup which always generates the configuration, without a compose cache in the source tree"""
+    setup = LocalSetup(argv=argv(compose_dir, configuration))
+    setup.args.no_compose_cache = True
+    setup.args.compose_cache_dir = os.path.join(compose_dir, "cache")
+    return setup
+
+
+@pytest.mark.parametrize("configuration", sorted(CONFIGURATIONS))
+def test_parse_arguments(benchmark, compose_dir, configuration):
+    benchmark(LocalSetup, argv=argv(compose_dir, configuration))
+
+
+def test_parse_arguments_lazy(benchmark):
+    """subcommands which don't need the per-service options"""
+    benchmark(LocalSetup, argv=["status"])
+
+
+def test_discover_services(benchmark):
+    benchmark(discover_services)
+
+
+def test_discover_services_introspection(benchmark):
+    benchmark(discover_services, cli)
+
+
+def service_options(compose_dir):
+    setup = LocalSetup(argv=argv(compose_dir, "all"))
+    args = vars(setup.args)
+    args["version"] = LocalSetup.SUPPORTED_VERSIONS[STACK_VERSION]
+    return args
+
+
+@pytest.mark.parametrize("service", [s for s in discover_services() if s is not WaitService], ids=lambda s: s.name())
+def test_render(benchmark, compose_dir, service):
+    args = service_options(compose_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        benchmark(lambda: service(**args).render())
+
+
+@pytest.mark.parametrize("configuration", sorted(CONFIGURATIONS))
+def test_build_start_handler(benchmark, compose_dir, docker_compose, configuration):
+    def setup():
+        return (start_setup(compose_dir, configuration),), {}
+
+    benchmark.pedantic(lambda setup: setup.build_start_handler("start"), setup=setup, rounds=20)
+    assert docker_compose.called
@@ -0,0 +1,379 @@
+from __future__ import print_function
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from ..modules import helpers
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+IMAGE_ID = "sha256:" + "ab" * 32
+TAGS = ["docker.elastic.co/apm/apm-server:8.0.0"]
+ETAG = '"v1"'
+
+
+def image_tar(image_id, tags):
+    """a gzipped tar laid out like `docker save` output, with an uncompressible layer"""
+    config = image_id.split(":")[1]
+    manifest = [{"Config": config + ".json", "RepoTags": tags, "Layers": ["layer/layer.tar"]}]
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in (("layer/layer.tar", os.urandom(3 * 1024 * 1024)),
+                           (config + ".json", b"{}"),
+                           ("manifest.json", json.dumps(manifest).encode("utf-8"))):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+CONTENT = image_tar(IMAGE_ID, TAGS)
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """serve CONTENT with an etag, honouring range requests, after answering GETs with the statuses in errors"""
+    requests = []
+    errors = []
+
+    def _headers(self, status, length, extra=None):
+        self.send_response(status)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(length))
+        for k, v in (extra or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.requests.append(("HEAD", None))
+        self._headers(200, len(CONTENT))
+
+    def do_GET(self):
+        rng = self.headers.get("Range")
+        self.requests.append(("GET", rng))
+        if self.errors:
+            self._headers(self.errors.pop(0), 0)
+            return
+        if rng and int(rng.split("=")[1].rstrip("-")) >= len(CONTENT):
+            self._headers(416, 0, {"Content-Range": "bytes */{}".format(len(CONTENT))})
+            return
+        if rng:
+            start = int(rng.split("=")[1].rstrip("-"))
+            body = CONTENT[start:]
+            self._headers(206, len(body), {"Content-Range": "bytes {}-{}/{}".format(
+                start, len(CONTENT) - 1, len(CONTENT))})
+        else:
+            body = CONTENT
+            self._headers(200, len(body))
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeDockerLoad(object):
+    """stands in for a `docker load` process, keeping what it was sent"""
+    loaded = []
+
+    def __init__(self, cmd, stdin=None):
+        assert cmd == ["docker", "load"]
+        self.stdin = io.BytesIO()
+        self.stdin.close = lambda: None
+        self.returncode = None
+        self.loaded.append(self.stdin)
+
+    def wait(self):
+        self.returncode = 0
+        return 0
+
+    def poll(self):
+        return self.returncode
+
+
+class ImageTest(unittest.TestCase):
+    maxDiff = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), ImageHandler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.url = "http://127.0.0.1:{}/apm-server-8.0.0-docker-image.tar.gz".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.filepath = os.path.join(self.cache_dir, os.path.basename(self.url))
+        del ImageHandler.requests[:]
+        del ImageHandler.errors[:]
+
+    def partial(self, size, etag):
+        with open(self.filepath + ".part", "wb") as f:
+            f.write(CONTENT[:size])
+        with open(self.filepath + ".part.etag", "w") as f:
+            f.write(etag)
+
+    def test_download_resume(self):
+        self.partial(1024 * 1024, ETAG)
+        progress = helpers.DownloadProgress(out=open(os.devnull, "w"))
+        self.assertTrue(helpers._download(self.url, self.filepath, ETAG, progress=progress))
+        self.assertEqual(ImageHandler.requests, [("GET", "bytes=1048576-")])
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertFalse(os.path.exists(self.filepath + ".part"))
+        self.assertEqual(progress.done[self.url], len(CONTENT))
+        self.assertEqual(progress.total[self.url], len(CONTENT))
+
+    def test_download_resume_complete(self):
+        # interrupted after the last byte was written, but before the rename
+        self.partial(len(CONTENT), ETAG)
+        self.assertEqual(helpers._download(self.url, self.filepath, ETAG), hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual(ImageHandler.requests, [("GET", "bytes={}-".format(len(CONTENT)))])
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertFalse(os.path.exists(self.filepath + ".part"))
+
+        # a partial download larger than the file can't be resumed
+        os.remove(self.filepath)
+        del ImageHandler.requests[:]
+        with open(self.filepath + ".part", "wb") as f:
+            f.write(CONTENT + b"garbage")
+        with open(self.filepath + ".part.etag", "w") as f:
+            f.write(ETAG)
+        with mock.patch("sys.stdout"):
+            self.assertEqual(helpers._download(self.url, self.filepath, ETAG), hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual(ImageHandler.requests, [("GET", "bytes={}-".format(len(CONTENT) + 7)), ("GET", None)])
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_download_retry(self):
+        ImageHandler.errors[:] = [503, 502]
+        with mock.patch("sys.stdout"), mock.patch.object(helpers.time, "sleep") as sleep:
+            self.assertEqual(helpers._download(self.url, self.filepath, ETAG), hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual(ImageHandler.requests, [("GET", None)] * 3)
+        # exponential backoff
+        self.assertEqual(sleep.call_args_list, [mock.call(1), mock.call(2)])
+
+    def test_download_not_found(self):
+        ImageHandler.errors[:] = [404]
+        with mock.patch("sys.stdout"), mock.patch.object(helpers.time, "sleep") as sleep:
+            self.assertIsNone(helpers._download(self.url, self.filepath, ETAG))
+        # not retried
+        self.assertEqual(ImageHandler.requests, [("GET", None)])
+        sleep.assert_not_called()
+        self.assertFalse(os.path.exists(self.filepath))
+
+    def test_download_changed(self):
+        # partial download of another version of the image
+        self.partial(1024 * 1024, '"v0"')
+        self.assertTrue(helpers._download(self.url, self.filepath, ETAG))
+        self.assertEqual(ImageHandler.requests, [("GET", None)])
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_load_image(self):
+        with mock.patch.object(helpers.subprocess, "check_call") as docker_load, \
+                mock.patch.object(helpers, "image_loaded", side_effect=[False, True, True]) as loaded, \
+                mock.patch.object(helpers, "_file_sha256", wraps=helpers._file_sha256) as file_sha256:
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url))
+            docker_load.assert_called_once_with(["docker", "load", "-i", self.filepath])
+            # checked recently, nothing to do
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url))
+            # hashed while downloading and verified recently, the file wasn't read again
+            file_sha256.assert_not_called()
+            # etag matches, nothing to do
+            cache = helpers.ImageCache(self.cache_dir, ttl=0)
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, cache=cache))
+            docker_load.assert_called_once_with(["docker", "load", "-i", self.filepath])
+        self.assertEqual([r[0] for r in ImageHandler.requests], ["HEAD", "GET", "HEAD"])
+        self.assertEqual(loaded.call_args_list, [mock.call(IMAGE_ID, TAGS)] * 3)
+        entry = cache.get(self.url)
+        self.assertEqual(entry["size"], len(CONTENT))
+        self.assertEqual(entry["sha256"], hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual((entry["image_id"], entry["tags"]), (IMAGE_ID, TAGS))
+        self.assertTrue(cache.verify(entry))
+
+    def test_load_image_not_loaded(self):
+        # a warm image cache shared with a fresh docker daemon
+        with mock.patch.object(helpers.subprocess, "check_call"), \
+                mock.patch.object(helpers, "image_loaded", return_value=False):
+            helpers._load_image(self.cache_dir, self.url)
+        with mock.patch.object(helpers.subprocess, "check_call") as docker_load, \
+                mock.patch.object(helpers, "image_manifest") as manifest, \
+                mock.patch.object(helpers, "image_loaded", return_value=False):
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url))
+        docker_load.assert_called_once_with(["docker", "load", "-i", self.filepath])
+        # the image id was recorded, the file isn't read again
+        manifest.assert_not_called()
+
+    def test_load_image_legacy_etag(self):
+        with open(self.filepath, "wb") as f:
+            f.write(CONTENT)
+        with open(self.filepath + ".etag", "w") as f:
+            f.write(ETAG)
+        with mock.patch.object(helpers.subprocess, "check_call") as docker_load, \
+                mock.patch.object(helpers, "image_loaded", return_value=True):
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url))
+        docker_load.assert_not_called()
+        self.assertEqual(ImageHandler.requests, [("HEAD", None)])
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["apm-server-8.0.0-docker-image.tar.gz", "index.json"])
+        self.assertEqual(helpers.ImageCache(self.cache_dir).get(self.url)["image_id"], IMAGE_ID)
+
+    def test_image_manifest(self):
+        with open(self.filepath, "wb") as f:
+            f.write(CONTENT)
+        self.assertEqual(helpers.image_manifest(self.filepath), (IMAGE_ID, TAGS))
+        with open(self.filepath, "wb") as f:
+            f.write(os.urandom(1024))
+        self.assertEqual(helpers.image_manifest(self.filepath), (None, []))
+
+    def test_manifest_reader(self):
+        for size in (1, 1000, 1024 * 1024):
+            reader = helpers.ManifestReader()
+            for i in range(0, len(CONTENT), size):
+                reader.write(CONTENT[i:i + size])
+            self.assertEqual(reader.image(), (IMAGE_ID, TAGS))
+        # an uncompressed tar, as written by `docker save`
+        reader = helpers.ManifestReader()
+        reader.write(gzip.decompress(CONTENT))
+        self.assertEqual(reader.image(), (IMAGE_ID, TAGS))
+        reader.reset()
+        reader.write(os.urandom(4096))
+        self.assertEqual(reader.image(), (None, []))
+
+    def test_load_image_tee_manifest(self):
+        del FakeDockerLoad.loaded[:]
+        self.partial(1024 * 1024, ETAG)
+        with mock.patch.object(helpers.subprocess, "Popen", FakeDockerLoad), \
+                mock.patch.object(helpers, "image_manifest") as manifest:
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, mode="tee"))
+        # read while downloading, including the resumed part, not from the file afterwards
+        manifest.assert_not_called()
+        entry = helpers.ImageCache(self.cache_dir).get(self.url)
+        self.assertEqual((entry["image_id"], entry["tags"]), (IMAGE_ID, TAGS))
+
+    def test_image_loaded(self):
+        with mock.patch.object(helpers.subprocess, "check_output", return_value=IMAGE_ID.encode() + b"\n") as inspect:
+            self.assertTrue(helpers.image_loaded(IMAGE_ID, TAGS))
+        inspect.assert_called_once_with(["docker", "image", "inspect", "--format", "{{.Id}}", TAGS[0]],
+                                        stderr=mock.ANY)
+        # the tag points at another build
+        with mock.patch.object(helpers.subprocess, "check_output", return_value=b"sha256:0000\n"):
+            self.assertFalse(helpers.image_loaded(IMAGE_ID, TAGS))
+        with mock.patch.object(helpers.subprocess, "check_output",
+                               side_effect=subprocess.CalledProcessError(1, "docker")):
+            self.assertFalse(helpers.image_loaded(IMAGE_ID, TAGS))
+
+    def test_load_image_loaded_not_verified(self):
+        with mock.patch.object(helpers.subprocess, "check_call"), \
+                mock.patch.object(helpers, "image_loaded", return_value=False):
+            helpers._load_image(self.cache_dir, self.url)
+        # verified long ago, but the daemon has the image, so the file isn't read at all
+        cache = helpers.ImageCache(self.cache_dir)
+        cache.update(self.url, verified=0)
+        with mock.patch.object(helpers.subprocess, "check_call") as docker_load, \
+                mock.patch.object(helpers, "image_loaded", return_value=True), \
+                mock.patch.object(helpers, "_file_sha256") as file_sha256:
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, cache=cache))
+        file_sha256.assert_not_called()
+        docker_load.assert_not_called()
+
+    def test_load_image_corrupted(self):
+        with mock.patch.object(helpers.subprocess, "check_call"), \
+                mock.patch.object(helpers, "image_loaded", return_value=False):
+            helpers._load_image(self.cache_dir, self.url)
+        # damaged on disk since it was last verified
+        with open(self.filepath, "r+b") as f:
+            f.write(b"\0" * 1024)
+        cache = helpers.ImageCache(self.cache_dir)
+        cache.update(self.url, verified=0)
+        with mock.patch.object(helpers.subprocess, "check_call") as docker_load, \
+                mock.patch.object(helpers, "image_loaded", return_value=False):
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, cache=cache))
+        # downloaded again rather than loaded
+        self.assertEqual(ImageHandler.requests, [("HEAD", None), ("GET", None), ("GET", None)])
+        docker_load.assert_called_once_with(["docker", "load", "-i", self.filepath])
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertTrue(cache.verified_recently(cache.get(self.url)))
+
+    def test_evict(self):
+        cache = helpers.ImageCache(self.cache_dir, max_size=25)
+        for i, name in enumerate(["a", "b", "c"]):
+            with open(os.path.join(self.cache_dir, name), "wb") as f:
+                f.write(b"x" * 10)
+            cache.update("http://images/" + name, file=name, size=10, last_used=i)
+        # streamed images have no file and don't count
+        cache.update("http://images/d", file=None, size=None, last_used=0)
+        with mock.patch("sys.stdout"):
+            self.assertEqual(cache.evict(keep=["http://images/a"]), ["http://images/b"])
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ["a", "c", "index.json"])
+        self.assertIsNone(cache.get("http://images/b"))
+
+    def test_load_image_stream(self):
+        del FakeDockerLoad.loaded[:]
+        with mock.patch.object(helpers.subprocess, "Popen", FakeDockerLoad):
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, mode="stream"))
+        self.assertEqual([p.getvalue() for p in FakeDockerLoad.loaded], [CONTENT])
+        # only the index entry is kept
+        self.assertEqual(os.listdir(self.cache_dir), ["index.json"])
+        entry = helpers.ImageCache(self.cache_dir).get(self.url)
+        self.assertEqual((entry["file"], entry["etag"]), (None, ETAG))
+        # read from the stream
+        self.assertEqual((entry["image_id"], entry["tags"]), (IMAGE_ID, TAGS))
+        # streamed recently and still loaded, nothing to do
+        with mock.patch.object(helpers.subprocess, "Popen", FakeDockerLoad), \
+                mock.patch.object(helpers, "image_loaded", return_value=True) as loaded:
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, mode="stream"))
+        loaded.assert_called_once_with(IMAGE_ID, TAGS)
+        self.assertEqual(len(FakeDockerLoad.loaded), 1)
+        # the daemon lost it
+        with mock.patch.object(helpers.subprocess, "Popen", FakeDockerLoad), \
+                mock.patch.object(helpers, "image_loaded", return_value=False):
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, mode="stream"))
+        self.assertEqual([p.getvalue() for p in FakeDockerLoad.loaded], [CONTENT, CONTENT])
+
+    def test_load_image_tee_resume(self):
+        del FakeDockerLoad.loaded[:]
+        self.partial(1024 * 1024, ETAG)
+        with mock.patch.object(helpers.subprocess, "Popen", FakeDockerLoad):
+            self.assertTrue(helpers._load_image(self.cache_dir, self.url, mode="tee"))
+        self.assertEqual(ImageHandler.requests, [("HEAD", None), ("GET", "bytes=1048576-")])
+        # the partial download is replayed into docker load before the rest
+        self.assertEqual([p.getvalue() for p in FakeDockerLoad.loaded], [CONTENT])
+        with open(self.filepath, "rb") as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_load_images_rate(self):
+        with mock.patch.object(helpers.subprocess, "check_call"), \
+                mock.patch.object(helpers, "image_loaded", return_value=False), \
+                mock.patch.object(helpers.RateLimiter, "consume") as consume:
+            helpers.load_images([self.url], self.cache_dir, concurrency=2, max_rate=helpers.parse_rate("100M"))
+        self.assertEqual(sum(c[0][0] for c in consume.call_args_list), len(CONTENT))
+
+    def test_parse_rate(self):
+        self.assertEqual(helpers.parse_rate("500"), 500)
+        self.assertEqual(helpers.parse_rate("500K"), 500 * 1024)
+        self.assertEqual(helpers.parse_rate("20MB/s"), 20 * 1024 * 1024)
+        self.assertEqual(helpers.parse_rate("1g"), 1024 ** 3)
+        with self.assertRaises(ValueError):
+            helpers.parse_rate("fast")
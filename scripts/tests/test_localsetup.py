@@ -1,17 +1,23 @@
 from __future__ import print_function
 
 import io
+import json
+import shutil
 import sys
+import tempfile
 import unittest
 import collections
 import yaml
 import os
 
 from ..modules import cli
+from ..modules import compose_cache
+from ..modules import reconcile
 from ..modules import service
 from ..modules.aux_services import Postgres, Redis
 from ..modules.elastic_stack import ApmServer, Elasticsearch
-from ..modules.helpers import parse_version
+from ..modules.helpers import StackVersion, parse_version
+from ..modules.reconcile import CONFIG_HASH_LABEL, stamp_config_hashes
 from ..modules.opbeans import (
     OpbeansService, OpbeansDotnet, OpbeansGo, OpbeansJava, OpbeansNode, OpbeansPhp,
     OpbeansPython, OpbeansRuby, OpbeansRum, OpbeansLoadGenerator
@@ -769,6 +775,15 @@ class LocalTest(unittest.TestCase):
     def test_service_registry(self):
         registry = discover_services()
         self.assertIn(ApmServer, registry)
+        # the static registry must hold every service the cli module imports
+        self.assertEqual(registry, discover_services(cli))
+
+    def test_lazy_service_options(self):
+        setup = LocalSetup(argv=["--debug", "status"])
+        self.assertIn("status", setup.available_options)
+        self.assertNotIn("--with-apm-server", setup.available_options)
+        setup = LocalSetup(argv=["list-options"])
+        self.assertIn("--with-apm-server", setup.available_options)
 
     def test_version_options(self):
         docker_compose_yml = stringIO()
@@ -796,6 +811,259 @@ class LocalTest(unittest.TestCase):
         want = yaml.safe_load(open('scripts/tests/config/test_start_main_default.yml', 'r'))
         self.assertDictEqual(got, want)
 
+    def test_output_format(self):
+        got = {}
+        for output_format in ("json", "json-compact", "yaml"):
+            docker_compose_yml = stringIO()
+            with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '7.17.0'}):
+                setup = LocalSetup(argv=self.common_setup_args + ["main", "--image-cache-dir", "/foo",
+                                                                  "--output-format", output_format])
+                setup.set_docker_compose_path(docker_compose_yml)
+                setup()
+            got[output_format] = docker_compose_yml.getvalue()
+        want = yaml.safe_load(open('scripts/tests/config/test_start_main_default.yml', 'r'))
+        self.assertDictEqual(json.loads(got["json"]), want)
+        self.assertDictEqual(json.loads(got["json-compact"]), want)
+        self.assertNotIn("\n", got["json-compact"])
+        self.assertDictEqual(yaml.safe_load(got["yaml"]), want)
+        # streamed one service at a time, reads the same as a single dump
+        self.assertEqual(got["yaml"], yaml.dump(want, explicit_start=True, default_flow_style=False, indent=2))
+
+    def test_compose_cache(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        compose_path = os.path.join(tmp, "docker-compose.yml")
+        # released images, which tags never move
+        argv = ["start", "main", "--release", "--docker-compose-path", compose_path,
+                "--compose-cache-dir", os.path.join(tmp, "cache"), "--no-apm-server-self-instrument", "--skip-download"]
+
+        def start(running, *extra):
+            with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}), \
+                    mock.patch.object(LocalSetup, "render_compose", autospec=True,
+                                      side_effect=LocalSetup.render_compose) as render, \
+                    mock.patch.object(LocalSetup, "run_docker_compose_process") as docker_compose, \
+                    mock.patch.object(cli.timeline, "docker_events", return_value=[]), \
+                    mock.patch.object(LocalSetup, "project_running", return_value=running):
+                LocalSetup(argv=argv + list(extra))()
+            up = [c for c in docker_compose.call_args_list if "up" in c[0][0]]
+            return render.called, bool(up)
+
+        # first run renders and starts the stack
+        self.assertEqual(start(False), (True, True))
+        with open(compose_path) as f:
+            want = f.read()
+        self.assertEqual(compose_cache.mutable_images(json.loads(want)), [])
+        # identical run with the stack running does nothing
+        self.assertEqual(start(True), (False, False))
+        # identical run with the stack stopped only skips rendering
+        self.assertEqual(start(False), (False, True))
+        with open(compose_path) as f:
+            self.assertEqual(want, f.read())
+        # a rebuild is never skipped
+        self.assertEqual(start(True, "--force-build"), (True, True))
+        self.assertEqual(start(True, "--force-build"), (False, True))
+
+        # another, uncached, configuration replaces the running stack
+        self.assertEqual(start(True, "--no-compose-cache", "--with-opbeans-java"), (True, True))
+        # so the cached one has to be brought up again
+        self.assertEqual(start(True), (False, True))
+        self.assertEqual(start(True), (False, False))
+
+    def test_compose_cache_mutable_images(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        argv = ["start", "main", "--docker-compose-path", os.path.join(tmp, "docker-compose.yml"),
+                "--compose-cache-dir", os.path.join(tmp, "cache"), "--no-apm-server-self-instrument", "--skip-download"]
+        for _ in range(2):
+            with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}), \
+                    mock.patch.object(LocalSetup, "run_docker_compose_process") as docker_compose, \
+                    mock.patch.object(cli.timeline, "docker_events", return_value=[]), \
+                    mock.patch.object(LocalSetup, "project_running", return_value=True):
+                LocalSetup(argv=argv)()
+            # snapshot images may have moved, so the stack is always brought up
+            self.assertTrue([c for c in docker_compose.call_args_list if "up" in c[0][0]])
+
+    def test_compose_cache_key_read_files(self):
+        kibana_src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, kibana_src)
+        args = {"kibana_src": kibana_src, "with_services": []}
+        missing = compose_cache.compose_cache_key(args)
+        with open(os.path.join(kibana_src, ".node-version"), "w") as f:
+            f.write("16.13.0\n")
+        first = compose_cache.compose_cache_key(args)
+        self.assertNotEqual(missing, first)
+        self.assertEqual(first, compose_cache.compose_cache_key(args))
+        # rendering reads the node version from the kibana sources
+        with open(os.path.join(kibana_src, ".node-version"), "w") as f:
+            f.write("16.14.0\n")
+        self.assertNotEqual(first, compose_cache.compose_cache_key(args))
+
+    def test_mutable_images(self):
+        healthcheck = {"test": ["CMD", "true"]}
+        compose = {"services": {
+            "a": {"image": "docker.elastic.co/elasticsearch/elasticsearch:8.0.0-SNAPSHOT", "healthcheck": healthcheck},
+            "b": {"image": "docker.elastic.co/elasticsearch/elasticsearch:8.0.0", "healthcheck": healthcheck},
+            "c": {"image": "opbeans/opbeans-python:latest", "healthcheck": healthcheck},
+            "d": {"image": "localhost:5000/redis", "healthcheck": healthcheck},
+            "e": {"image": "redis@sha256:abcdef", "healthcheck": healthcheck},
+            "f": {"build": {"context": "docker/dyno"}, "healthcheck": healthcheck},
+            # one-shot helpers
+            "g": {"image": "busybox"},
+        }}
+        self.assertEqual(compose_cache.mutable_images(compose), ["a", "c", "d"])
+
+    def test_project_up_to_date_stamped(self):
+        compose = {"services": {"redis": {"image": "redis:4", "healthcheck": {"test": ["CMD", "true"]}}}}
+        stamp_config_hashes(compose["services"])
+        labels = dict(label.split("=", 1) for label in compose["services"]["redis"]["labels"])
+        running = {"redis": dict(stack_version="", config_hash=labels[CONFIG_HASH_LABEL], state="running")}
+        with mock.patch.object(cli, "running_services", return_value=running), \
+                mock.patch.object(LocalSetup, "project_running", return_value=True):
+            self.assertTrue(LocalSetup.project_up_to_date([], compose, "apm", stamped=True))
+            # the running container was created from another definition
+            running["redis"]["config_hash"] = "0" * 64
+            self.assertFalse(LocalSetup.project_up_to_date([], compose, "apm", stamped=True))
+
+    def test_config_hash_stable(self):
+        argv = self.common_setup_args + ["main", "--reconcile", "--with-opbeans-java", "--with-opbeans-python",
+                                         "--with-opbeans-go", "--with-opbeans-node", "--with-opbeans-ruby"]
+        hashes = []
+        for _ in range(3):
+            docker_compose_yml = stringIO()
+            with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}):
+                setup = LocalSetup(argv=argv)
+                setup.set_docker_compose_path(docker_compose_yml)
+                setup()
+            services = json.loads(docker_compose_yml.getvalue())["services"]
+            hashes.append({name: [label for label in service["labels"] if label.startswith(CONFIG_HASH_LABEL)]
+                           for name, service in services.items()})
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertEqual(hashes[0], hashes[2])
+
+    def test_running_services_project(self):
+        output = "elasticsearch\t8.0.0\tabc\trunning\n".encode("utf8")
+        with mock.patch.object(reconcile.subprocess, "check_output", return_value=output) as docker_ps:
+            running = reconcile.running_services("apm-integration-testing")
+        self.assertEqual(running, {"elasticsearch": dict(stack_version="8.0.0", config_hash="abc", state="running")})
+        cmd = docker_ps.call_args[0][0]
+        self.assertIn("label=com.docker.compose.project=apm-integration-testing", cmd)
+        self.assertIn("label=" + CONFIG_HASH_LABEL, cmd)
+
+    def test_reconcile(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        compose_path = os.path.join(tmp, "docker-compose.yml")
+        running = {}
+
+        def start(*extra):
+            argv = ["start", "main", "--docker-compose-path", compose_path, "--no-compose-cache", "--reconcile",
+                    "--compose-cache-dir", os.path.join(tmp, "cache"),
+                    "--no-apm-server-self-instrument", "--with-opbeans-java"] + list(extra)
+            with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}), \
+                    mock.patch.object(cli, "running_services", return_value=running), \
+                    mock.patch.object(cli, "load_images"), \
+                    mock.patch.object(cli.timeline, "docker_events", return_value=[]), \
+                    mock.patch.object(LocalSetup, "run_docker_compose_process") as docker_compose:
+                LocalSetup(argv=argv)()
+            with open(compose_path) as f:
+                services = json.load(f)["services"]
+            return services, [c[0][0][3:] for c in docker_compose.call_args_list]
+
+        services, calls = start()
+        for name, definition in services.items():
+            labels = dict(label.split("=", 1) for label in definition["labels"])
+            self.assertIn("co.elastic.apm.config-hash", labels, name)
+            running[name] = dict(stack_version=labels.get("co.elastic.apm.stack-version", ""),
+                                 config_hash=labels["co.elastic.apm.config-hash"], state="running")
+        # nothing was running, so everything is recreated
+        self.assertIn("opbeans-java", calls[-2])
+        self.assertIn("elasticsearch", calls[-2])
+
+        # nothing changed
+        _, calls = start()
+        self.assertFalse([c for c in calls if "up" in c])
+
+        # only the changed service is built and recreated, then the stack is awaited
+        _, calls = start("--opbeans-java-service-version", "1.2.3")
+        build, recreate, wait = calls
+        self.assertIn("build", build)
+        self.assertEqual(build[-1], "opbeans-java")
+        self.assertEqual(recreate[-3:], ["--no-deps", "--force-recreate", "opbeans-java"])
+        self.assertEqual(wait[-4:], ["up", "-d", "--no-recreate", "wait-service"])
+
+    def test_scheduled_start(self):
+        compose = {"services": {"redis": {"image": "redis:4"}, "postgres": {"image": "postgres:10"}}}
+        running = {name: dict(status="running", health=None, exit_code=0) for name in compose["services"]}
+        scheduler = cli.StartupScheduler
+        with mock.patch.object(LocalSetup, "run_docker_compose_process") as docker_compose, \
+                mock.patch.object(cli, "compose_status", return_value=running), \
+                mock.patch.object(cli, "StartupScheduler",
+                                  side_effect=lambda *args, **kwargs: scheduler(*args, poll_interval=0.01, **kwargs)), \
+                mock.patch("sys.stdout"):
+            LocalSetup(argv=["status"]).scheduled_start(["docker-compose"], ["up", "-d", "--quiet-pull"], compose)
+        calls = [c[0][0] for c in docker_compose.call_args_list]
+        # the network and volumes are created once, before the concurrent starts
+        self.assertEqual(calls[0], ["docker-compose", "up", "--quiet-pull", "--no-start", "--no-deps",
+                                    "postgres", "redis"])
+        self.assertEqual(sorted(calls[1:]), [["docker-compose", "up", "-d", "--quiet-pull", "--no-deps", name]
+                                             for name in ["postgres", "redis"]])
+
+    def test_adaptive_healthchecks(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        boot_times = os.path.join(tmp, "boot_times.json")
+        with open(boot_times, "w") as f:
+            json.dump({"redis": [2, 3, 2], "postgres": [4]}, f)
+        docker_compose_yml = stringIO()
+        with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}):
+            setup = LocalSetup(argv=self.common_setup_args + ["main", "--with-opbeans-python",
+                                                              "--adaptive-healthchecks", "--boot-times", boot_times])
+            setup.set_docker_compose_path(docker_compose_yml)
+            setup()
+        docker_compose_yml.seek(0)
+        got = yaml.safe_load(docker_compose_yml)["services"]
+        self.assertEqual(got["redis"]["healthcheck"]["interval"], "1s")
+        self.assertEqual(got["redis"]["healthcheck"]["start_period"], "4s")
+        self.assertEqual(got["postgres"]["healthcheck"]["interval"], "1s")
+        # no boot time recorded
+        self.assertEqual(got["elasticsearch"]["healthcheck"]["interval"], "20s")
+
+    def test_start_records_boot_times(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        boot_times = os.path.join(tmp, "boot_times.json")
+        events = [
+            {"Action": "create", "Actor": {"Attributes": {"com.docker.compose.service": "redis"}}, "time": 100},
+            {"Action": "start", "Actor": {"Attributes": {"com.docker.compose.service": "redis"}}, "time": 101},
+            {"Action": "health_status: healthy", "Actor": {"Attributes": {"com.docker.compose.service": "redis"}},
+             "time": 104},
+        ]
+        argv = ["start", "main", "--docker-compose-path", os.path.join(tmp, "docker-compose.yml"),
+                "--compose-cache-dir", os.path.join(tmp, "cache"), "--no-apm-server-self-instrument",
+                "--skip-download", "--boot-times", boot_times]
+        with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}), \
+                mock.patch.object(LocalSetup, "run_docker_compose_process"), \
+                mock.patch.object(cli.timeline, "docker_events", return_value=events) as docker_events:
+            LocalSetup(argv=argv)()
+        # only the events of this start
+        self.assertEqual(docker_events.call_args[0][0], cli.timeline.project_name(tmp))
+        self.assertGreater(docker_events.call_args[0][1], 0)
+        with open(boot_times) as f:
+            self.assertEqual(json.load(f), {"redis": [3]})
+
+        # nothing is recorded unless asked for
+        with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}), \
+                mock.patch.object(LocalSetup, "run_docker_compose_process"), \
+                mock.patch.object(cli.timeline, "docker_events", return_value=events) as docker_events:
+            LocalSetup(argv=argv[:-2] + ["--no-compose-cache"])()
+        docker_events.assert_not_called()
+
+        # the timeline command only reads the events, so that the same boot is not recorded again
+        with mock.patch.object(cli.timeline, "docker_events", return_value=events), \
+                mock.patch.object(cli.timeline.BootTimes, "record") as record:
+            LocalSetup(argv=["timeline", "--project", "apm", "--since", "1"])()
+        self.assertFalse(record.called)
+
     def test_start_main_with_oss(self):
         docker_compose_yml = stringIO()
         image_cache_dir = "/foo"
@@ -1105,6 +1373,25 @@ class LocalTest(unittest.TestCase):
                 ]}
         self.assertDictEqual(got, want)
 
+    @mock.patch(cli.__name__ + ".load_images")
+    @mock.patch(cli.__name__ + ".open")
+    def test_start_with_dyno_worker_class(self, _ignore_load_images, _ignore_open):
+        """
+        GIVEN a mocked CLI which does not actually load images
+        WHEN the CLI is called with the --dyno and --dyno-worker-class flags
+        THEN the Dyno container is configured to use that worker class
+        """
+        docker_compose_yml = stringIO()
+        with mock.patch.dict(LocalSetup.SUPPORTED_VERSIONS, {'main': '8.0.0'}):
+            setup = LocalSetup(argv=self.common_setup_args + ["main", "--all", "--dyno",
+                                                              "--dyno-worker-class", "gevent"])
+            setup.set_docker_compose_path(docker_compose_yml)
+            setup()
+        docker_compose_yml.seek(0)
+        got = yaml.safe_load(docker_compose_yml)
+        self.assertEqual(got['services']['dyno']['environment'],
+                         {'TOXI_HOST': 'toxi', 'TOXI_PORT': '8474', 'DYNO_WORKER_CLASS': 'gevent'})
+
     @mock.patch(cli.__name__ + ".load_images")
     @mock.patch(cli.__name__ + ".open")
     def test_start_with_toxi(self, _ignore_load_images, _ignore_open):
@@ -1255,6 +1542,7 @@ class LocalTest(unittest.TestCase):
         want = '[\n    {\n        "enabled": true,\n        "listen": "[::]:3004",\n        "name": "opbeans-dotnet",\n        "upstream": "opbeans-dotnet:3000"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:3003",\n        "name": "opbeans-go",\n        "upstream": "opbeans-go:3000"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:3002",\n        "name": "opbeans-java",\n        "upstream": "opbeans-java:3000"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:3000",\n        "name": "opbeans-node",\n        "upstream": "opbeans-node:3000"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:3105",\n        "name": "opbeans-php",\n        "upstream": "opbeans-php:3000"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:8000",\n        "name": "opbeans-python",\n        "upstream": "opbeans-python:3000"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:3001",\n        "name": "opbeans-ruby",\n        "upstream": "opbeans-ruby:3000"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:5432",\n        "name": "postgres",\n        "upstream": "postgres:5432"\n    },\n    {\n        "enabled": true,\n        "listen": "[::]:6379",\n        "name": "redis",\n        "upstream": "redis:6379"\n    }\n]'
         toxi_open().write.assert_called_once_with(want)
 
+    @mock.patch(cli.__name__ + ".prefetch_bcs", mock.Mock())
     @mock.patch(service.__name__ + ".resolve_bc")
     @mock.patch(cli.__name__ + ".load_images")
     def test_start_bc(self, mock_load_images, mock_resolve_bc):
@@ -1327,8 +1615,10 @@ class LocalTest(unittest.TestCase):
                 "https://staging.elastic.co/.../apm-server-6.9.5-docker-image.tar.gz",
                 "https://staging.elastic.co/.../metricbeat-6.9.5-docker-image.tar.gz",
             },
-            image_cache_dir)
+            image_cache_dir, concurrency=4, max_rate=None, mode="file",
+            ttl=3600, max_size=20 * 1024 ** 3)
 
+    @mock.patch(cli.__name__ + ".prefetch_bcs", mock.Mock())
     @mock.patch(service.__name__ + ".resolve_bc")
     @mock.patch(cli.__name__ + ".load_images")
     def test_start_bc_oss(self, mock_load_images, mock_resolve_bc):
@@ -1383,8 +1673,10 @@ class LocalTest(unittest.TestCase):
                 "https://staging.elastic.co/.../kibana-oss-6.9.5-docker-image.tar.gz",
                 "https://staging.elastic.co/.../apm-server-oss-6.9.5-docker-image.tar.gz",
             },
-            image_cache_dir)
+            image_cache_dir, concurrency=4, max_rate=None, mode="file",
+            ttl=3600, max_size=20 * 1024 ** 3)
 
+    @mock.patch(cli.__name__ + ".prefetch_bcs", mock.Mock())
     @mock.patch(service.__name__ + ".resolve_bc")
     @mock.patch(cli.__name__ + ".load_images")
     def test_start_bc_with_release(self, mock_load_images, mock_resolve_bc):
@@ -1439,8 +1731,10 @@ class LocalTest(unittest.TestCase):
                 "https://staging.elastic.co/.../elasticsearch-6.9.5-docker-image.tar.gz",
                 "https://staging.elastic.co/.../kibana-6.9.5-docker-image.tar.gz",
             },
-            image_cache_dir)
+            image_cache_dir, concurrency=4, max_rate=None, mode="file",
+            ttl=3600, max_size=20 * 1024 ** 3)
 
+    @mock.patch(cli.__name__ + ".prefetch_bcs", mock.Mock())
     @mock.patch(service.__name__ + ".resolve_bc")
     @mock.patch(cli.__name__ + ".load_images")
     def test_start_bc_ubi8(self, mock_load_images, mock_resolve_bc):
@@ -1495,7 +1789,8 @@ class LocalTest(unittest.TestCase):
                 "https://staging.elastic.co/.../kibana-ubi8-7.10.0-docker-image.tar.gz",
                 "https://staging.elastic.co/.../apm-server-ubi8-7.10.0-docker-image.tar.gz",
             },
-            image_cache_dir)
+            image_cache_dir, concurrency=4, max_rate=None, mode="file",
+            ttl=3600, max_size=20 * 1024 ** 3)
 
     @mock.patch(service.__name__ + ".resolve_bc")
     def test_docker_download_image_url(self, mock_resolve_bc):
@@ -1576,6 +1871,36 @@ class LocalTest(unittest.TestCase):
             got = parse_version(ver)
             self.assertEqual(want, got)
 
+    def test_stack_version(self):
+        self.assertIs(StackVersion("8.0.0-SNAPSHOT"), StackVersion("8.0.0-SNAPSHOT"))
+        self.assertIs(StackVersion(StackVersion("7.17.0")), StackVersion("7.17.0"))
+        self.assertEqual(StackVersion("7.3"), StackVersion("7.3.0"))
+        self.assertEqual(StackVersion("6.3.10-alpha1").release, (6, 3, 10))
+        # pre-releases order before their release, but are gated as that release
+        self.assertLess(StackVersion("8.0.0-SNAPSHOT"), "8.0.0")
+        self.assertLess(StackVersion("8.0.0-rc1"), "8.0.0")
+        self.assertLess(StackVersion("7.17.8"), StackVersion("8.0.0-alpha1"))
+        # anything else is just not equal, and doesn't order
+        self.assertNotEqual(StackVersion("8.0.0"), None)
+        self.assertFalse(StackVersion("8.0.0") == "main")
+        self.assertIn(StackVersion("7.17.0"), [None, 7, "latest", "7.17"])
+        self.assertNotIn(StackVersion("7.17.0"), [None, 7, "latest"])
+        with self.assertRaises(TypeError):
+            StackVersion("8.0.0") < None
+        self.assertTrue(StackVersion("8.0.0-SNAPSHOT").at_least("8.0"))
+        self.assertTrue(StackVersion("8.0.0-SNAPSHOT").snapshot)
+        self.assertTrue(StackVersion("7.3").at_least("7.3.0"))
+        self.assertTrue(StackVersion("7.16.3").lower_than("7.17"))
+        self.assertFalse(StackVersion("7.10.2").lower_than("7.10"))
+        self.assertEqual(sorted(["8.1.0", "7.17.0", "8.1.0-SNAPSHOT", "7.9.3"], key=StackVersion),
+                         ["7.9.3", "7.17.0", "8.1.0-SNAPSHOT", "8.1.0"])
+
+    def test_service_stack_version(self):
+        apm_server = ApmServer(version="7.16.3")
+        self.assertTrue(apm_server.at_least_version("7.16"))
+        self.assertIs(apm_server.stack_version, StackVersion("7.16.3"))
+        self.assertTrue(apm_server.version_lower_than("8.0"))
+
     @mock.patch(cli.__name__ + ".load_images")
     def test_elasticsearch_tls(self, _ignore_load_images):
         docker_compose_yml = stringIO()
@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ..modules import helpers
+from ..modules.beats import Filebeat, Metricbeat
+from ..modules.elastic_stack import ApmServer, Elasticsearch, Kibana
+from ..modules.opbeans import OpbeansPython
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+
+class FakeStaging(object):
+    """stands in for staging.elastic.co, counting requests and how many were in flight at once"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def fetch(self, version, build_id, base_url=None):
+        with self.lock:
+            self.requests.append((version, build_id))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return {"version": version, "build_id": build_id}
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.cache = helpers.BuildManifestCache(os.path.join(tmp, "manifests"), latest_ttl=600)
+        self.staging = FakeStaging()
+        patcher = mock.patch.object(helpers, "fetch_build_manifest", self.staging.fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(helpers.build_manifests, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resolve_bc_build_id(self):
+        self.assertEqual(helpers.resolve_bc("8.0.0", "abc123")["build_id"], "abc123")
+        # another build of the same version isn't served from the cache
+        self.assertEqual(helpers.resolve_bc("8.0.0", "def456")["build_id"], "def456")
+        self.assertEqual(helpers.resolve_bc("8.0.0", "abc123")["build_id"], "abc123")
+        self.assertEqual(self.staging.requests, [("8.0.0", "abc123"), ("8.0.0", "def456")])
+
+    def test_resolve_bc_disk_cache(self):
+        helpers.resolve_bc("8.0.0", "abc123", self.cache)
+        helpers.build_manifests.clear()
+        # a later run
+        self.assertEqual(helpers.resolve_bc("8.0.0", "abc123", self.cache)["build_id"], "abc123")
+        self.assertEqual(self.staging.requests, [("8.0.0", "abc123")])
+        with open(self.cache.path("8.0.0", "abc123")) as f:
+            self.assertEqual(json.load(f), {"version": "8.0.0", "build_id": "abc123"})
+
+    def test_latest_ttl(self):
+        helpers.resolve_bc("8.0.0", "latest", self.cache)
+        helpers.build_manifests.clear()
+        helpers.resolve_bc("8.0.0", "latest", self.cache)
+        self.assertEqual(len(self.staging.requests), 1)
+        # expired
+        old = time.time() - 601
+        os.utime(self.cache.path("8.0.0", "latest"), (old, old))
+        helpers.build_manifests.clear()
+        helpers.resolve_bc("8.0.0", "latest", self.cache)
+        self.assertEqual(len(self.staging.requests), 2)
+
+    def test_prefetch(self):
+        options = dict(version="8.0.0", bc="abc123", kibana_version="7.17.0", filebeat_version="7.17.0")
+        services = [Elasticsearch, Kibana, ApmServer, Filebeat, Metricbeat, OpbeansPython]
+        helpers.prefetch_bcs([service.build_candidate(options) for service in services], cache=self.cache)
+        self.assertEqual(sorted(self.staging.requests), [("7.17.0", "abc123"), ("8.0.0", "abc123")])
+        self.assertEqual(self.staging.max_in_flight, 2)
+        # services then resolve their build candidate without any request
+        with mock.patch.object(helpers, "fetch_build_manifest") as fetch:
+            self.assertEqual(Kibana(**options).bc["version"], "7.17.0")
+            self.assertEqual(ApmServer(**options).bc["version"], "8.0.0")
+        fetch.assert_not_called()
+
+    def test_build_candidate(self):
+        options = dict(version="8.0.0", bc="latest", apm_server_bc="abc123")
+        self.assertEqual(Elasticsearch.build_candidate(options), ("8.0.0", "latest"))
+        self.assertEqual(ApmServer.build_candidate(options), ("8.0.0", "abc123"))
+        self.assertEqual(OpbeansPython.build_candidate(options), ("8.0.0", None))
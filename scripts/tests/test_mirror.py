@@ -0,0 +1,117 @@
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ..modules import helpers, mirror
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+STAGING = "https://staging.elastic.co"
+IMAGE_PATH = "/8.13.0-abc123/downloads/apm-server/apm-server-8.13.0-docker-image.tar.gz"
+MANIFEST_PATH = "/8.13.0-abc123/manifest-8.13.0.json"
+MANIFEST = {
+    "projects": {
+        "apm-server": {"packages": {
+            "apm-server-8.13.0-docker-image.tar.gz": {"url": STAGING + IMAGE_PATH, "type": "docker"},
+        }},
+    },
+}
+IMAGE = os.urandom(256 * 1024)
+
+
+def write(root, path, data):
+    path = os.path.join(root, path.lstrip("/"))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data if isinstance(data, bytes) else json.dumps(data).encode("utf-8"))
+
+
+class MirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        # stands in for staging.elastic.co, as published
+        self.upstream = self.serve(os.path.join(self.tmp, "upstream"))
+        write(self.upstream.mirror_dir, "/latest/8.13.json", {"manifest_url": STAGING + MANIFEST_PATH})
+        write(self.upstream.mirror_dir, MANIFEST_PATH, MANIFEST)
+        write(self.upstream.mirror_dir, IMAGE_PATH, IMAGE)
+        self.mirror_dir = os.path.join(self.tmp, "mirror")
+        patcher = mock.patch.dict(helpers.build_manifests, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("sys.stdout")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def serve(self, mirror_dir):
+        server = mirror.MirrorServer(("127.0.0.1", 0), mirror_dir)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+        return server
+
+    def test_snapshot_and_serve(self):
+        failed = mirror.snapshot("8.13.0", "latest", self.mirror_dir, images=["apm-server", "kibana"],
+                                 base_url=self.upstream.url)
+        self.assertEqual(failed, [])
+        with open(mirror.mirror_path(self.mirror_dir, IMAGE_PATH), "rb") as f:
+            self.assertEqual(f.read(), IMAGE)
+        # manifests are kept as published
+        with open(mirror.mirror_path(self.mirror_dir, MANIFEST_PATH)) as f:
+            self.assertEqual(json.load(f), MANIFEST)
+
+        # start from the mirror alone
+        self.upstream.shutdown()
+        local = self.serve(self.mirror_dir)
+        manifest = helpers.resolve_bc("8.13.0", "latest", base_url=local.url)
+        url = manifest["projects"]["apm-server"]["packages"]["apm-server-8.13.0-docker-image.tar.gz"]["url"]
+        self.assertEqual(url, local.url + IMAGE_PATH)
+        cache_dir = os.path.join(self.tmp, "images")
+        with mock.patch.object(helpers.subprocess, "check_call") as docker_load, \
+                mock.patch.object(helpers, "image_loaded", return_value=False):
+            self.assertTrue(helpers._load_image(cache_dir, url))
+        docker_load.assert_called_once()
+        with open(os.path.join(cache_dir, os.path.basename(IMAGE_PATH)), "rb") as f:
+            self.assertEqual(f.read(), IMAGE)
+
+    def test_snapshot_build_id(self):
+        mirror.snapshot("8.13.0", "abc123", self.mirror_dir, base_url=self.upstream.url)
+        # only apm-server is in the build candidate
+        self.assertEqual(sorted(os.listdir(mirror.mirror_path(self.mirror_dir, "/8.13.0-abc123/downloads"))),
+                         ["apm-server"])
+        self.assertFalse(os.path.exists(os.path.join(self.mirror_dir, "latest")))
+
+    def test_range(self):
+        write(self.mirror_dir, IMAGE_PATH, IMAGE)
+        local = self.serve(self.mirror_dir)
+        request = Request(local.url + IMAGE_PATH)
+        request.add_header("Range", "bytes=1000-")
+        rsp = urlopen(request)
+        self.assertEqual(rsp.getcode(), 206)
+        self.assertEqual(rsp.read(), IMAGE[1000:])
+        self.assertTrue(rsp.info().get("ETag"))
+        with self.assertRaises(Exception):
+            urlopen(local.url + "/../../etc/passwd")
+
+    def test_rebase_urls(self):
+        self.assertEqual(helpers.rebase_urls(MANIFEST, "http://mirror:8899/"), {
+            "projects": {"apm-server": {"packages": {"apm-server-8.13.0-docker-image.tar.gz": {
+                "url": "http://mirror:8899" + IMAGE_PATH, "type": "docker"}}}},
+        })
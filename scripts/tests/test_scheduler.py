@@ -0,0 +1,147 @@
+from __future__ import print_function
+
+import subprocess
+import unittest
+
+from concurrent.futures import Future
+
+from ..modules.scheduler import StartupError, StartupScheduler, dependency_graph, layers
+
+HEALTHCHECK = {"test": ["CMD", "true"]}
+
+
+class FakeDocker(object):
+    """
+    containers become running one tick after being started and healthy after their boot time.
+    also stands in for the executor, so that start() calls take start_delay seconds of the fake clock
+    rather than depending on thread scheduling. services in old have a healthy container to begin with.
+    """
+
+    def __init__(self, boot, fail=None, start_delay=0, old=(), fail_start=()):
+        self.boot = boot
+        self.fail = fail or {}
+        self.start_delay = start_delay
+        self.old = set(old)
+        self.fail_start = set(fail_start)
+        self.now = 0
+        self.started = {}
+        self.pending = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        for item in [item for item in self.pending if item[0] <= self.now]:
+            self.pending.remove(item)
+            self._call(*item[1:])
+
+    def submit(self, fn, *args):
+        future = Future()
+        if self.start_delay:
+            self.pending.append((self.now + self.start_delay, future, fn, args))
+        else:
+            self._call(future, fn, args)
+        return future
+
+    def _call(self, future, fn, args):
+        try:
+            future.set_result(fn(*args))
+        except Exception as err:
+            future.set_exception(err)
+
+    def start(self, name):
+        if name in self.fail_start:
+            raise subprocess.CalledProcessError(1, ["docker-compose", "up", name])
+        self.started[name] = self.now
+
+    def status(self):
+        ret = {}
+        for name in self.old - set(self.started):
+            ret[name] = dict(status="running", health="healthy", exit_code=0)
+        for name, start in self.started.items():
+            up = self.now - start
+            state = dict(status="running" if up >= 1 else "created", health="starting", exit_code=0)
+            if up >= self.boot.get(name, 1):
+                state["health"] = self.fail.get(name, "healthy")
+            ret[name] = state
+        return ret
+
+
+class SchedulerTest(unittest.TestCase):
+    maxDiff = None
+
+    services = {
+        "elasticsearch": {"healthcheck": HEALTHCHECK},
+        "kibana": {"healthcheck": HEALTHCHECK, "depends_on": {"elasticsearch": {"condition": "service_healthy"}}},
+        "apm-server": {"healthcheck": HEALTHCHECK, "depends_on": {
+            "elasticsearch": {"condition": "service_healthy"}, "kibana": {"condition": "service_healthy"}}},
+        "redis": {"healthcheck": HEALTHCHECK},
+        "wait-service": {"depends_on": {
+            "apm-server": {"condition": "service_healthy"}, "redis": {"condition": "service_healthy"}}},
+    }
+
+    def scheduler(self, docker, services=None):
+        return StartupScheduler(services or self.services, docker.start, docker.status,
+                                clock=docker.clock, sleep=docker.sleep, executor=docker)
+
+    def test_layers(self):
+        self.assertEqual(layers(dependency_graph(self.services)), [
+            ["elasticsearch", "redis"], ["kibana"], ["apm-server"], ["wait-service"],
+        ])
+
+    def test_cycle(self):
+        with self.assertRaises(StartupError):
+            StartupScheduler({"a": {"depends_on": ["b"]}, "b": {"depends_on": ["a"]}}, None, None)
+
+    def test_run(self):
+        docker = FakeDocker({"elasticsearch": 30, "kibana": 20, "apm-server": 5, "redis": 3})
+        scheduler = self.scheduler(docker)
+        timeline = scheduler.run()
+        # independent services start right away, the rest as soon as their dependencies are healthy
+        self.assertEqual(timeline["elasticsearch"]["start"], 0)
+        self.assertEqual(timeline["redis"]["start"], 0)
+        self.assertEqual(timeline["redis"]["ready"], 3)
+        self.assertEqual(timeline["kibana"]["start"], timeline["elasticsearch"]["ready"])
+        self.assertEqual(timeline["apm-server"]["start"], timeline["kibana"]["ready"])
+        self.assertEqual(scheduler.critical_path(), ["elasticsearch", "kibana", "apm-server", "wait-service"])
+        self.assertIn("critical path: elasticsearch -> kibana -> apm-server -> wait-service", scheduler.report())
+
+    def test_run_subset(self):
+        docker = FakeDocker({"apm-server": 5})
+        timeline = self.scheduler(docker).run(["apm-server"])
+        self.assertEqual(list(timeline), ["apm-server"])
+        self.assertEqual(timeline["apm-server"]["start"], 0)
+
+    def test_unhealthy(self):
+        docker = FakeDocker({"elasticsearch": 10}, fail={"elasticsearch": "unhealthy"})
+        with self.assertRaises(StartupError) as cm:
+            self.scheduler(docker).run()
+        self.assertEqual(str(cm.exception), "elasticsearch is unhealthy")
+
+    def test_recreate(self):
+        # the old containers are healthy, but the new ones take 5s to be created
+        docker = FakeDocker({"elasticsearch": 30, "kibana": 20, "apm-server": 5, "redis": 3},
+                            start_delay=5, old=self.services)
+        timeline = self.scheduler(docker).run()
+        self.assertEqual(timeline["elasticsearch"]["ready"], 35)
+        # kibana waits for the new elasticsearch container, not the one it replaced
+        self.assertEqual(timeline["kibana"]["start"], 35)
+
+    def test_start_failed(self):
+        docker = FakeDocker({}, fail_start=["redis"])
+        with self.assertRaises(StartupError) as cm:
+            self.scheduler(docker).run()
+        self.assertTrue(str(cm.exception).startswith("redis failed to start: "), str(cm.exception))
+
+    def test_status_failed(self):
+        docker = FakeDocker({})
+
+        def status():
+            raise subprocess.CalledProcessError(1, ["docker-compose", "ps", "-q"])
+
+        scheduler = StartupScheduler(self.services, docker.start, status, clock=docker.clock, sleep=docker.sleep,
+                                     executor=docker)
+        with self.assertRaises(StartupError) as cm:
+            scheduler.run()
+        self.assertTrue(str(cm.exception).startswith("failed to get the status of the containers: "))
@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..modules import timeline
+from ..modules.helpers import adaptive_healthcheck
+
+
+def event(service, action, seconds):
+    return {
+        "Type": "container",
+        "Action": action,
+        "Actor": {"ID": service, "Attributes": {"com.docker.compose.service": service, "name": service}},
+        "time": 1600000000 + seconds,
+        "timeNano": (1600000000 + seconds) * 10 ** 9,
+    }
+
+
+class TimelineTest(unittest.TestCase):
+    maxDiff = None
+
+    events = [
+        event("kibana", "create", 1),
+        event("elasticsearch", "create", 0),
+        event("elasticsearch", "start", 1),
+        event("elasticsearch", "health_status: starting", 2),
+        event("elasticsearch", "health_status: healthy", 30),
+        event("kibana", "start", 31),
+        event("kibana", "health_status: healthy", 50),
+        event("redis", "create", 0),
+        event("redis", "start", 1),
+        event("redis", "exec_start: redis-cli ping", 2),
+    ]
+
+    def test_build_timeline(self):
+        got = timeline.build_timeline(self.events)
+        self.assertEqual(timeline.relative(got)[0], {
+            "elasticsearch": {"created": 0, "running": 1, "healthy": 30},
+            "kibana": {"created": 1, "running": 31, "healthy": 50},
+            "redis": {"created": 0, "running": 1},
+        })
+
+    def test_recreated(self):
+        got = timeline.build_timeline(self.events + [
+            event("redis", "die", 60),
+            event("redis", "create", 61),
+            event("redis", "start", 62),
+        ])
+        self.assertEqual(timeline.relative(got)[0]["redis"], {"created": 61, "running": 62})
+
+    def test_to_json(self):
+        got = json.loads(timeline.to_json(timeline.build_timeline(self.events)))
+        self.assertEqual(got["start"], 1600000000)
+        self.assertEqual(got["services"]["kibana"], {"created": 1, "running": 31, "healthy": 50})
+
+    def test_to_text(self):
+        got = timeline.to_text(timeline.build_timeline(self.events), width=10).splitlines()
+        self.assertEqual(got[0].split(), ["service", "created", "running", "healthy"])
+        self.assertEqual(got[1], "elasticsearch                    0.0s     1.0s    30.0s |======#    |")
+        self.assertEqual(got[2], "redis                            0.0s     1.0s        - |===========|")
+        self.assertEqual(got[3], "kibana                           1.0s    31.0s    50.0s |......====#|")
+
+    def test_project_name(self):
+        self.assertEqual(timeline.project_name("/src/APM Integration.Testing"), "apmintegrationtesting")
+
+
+class BootTimesTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.boot_times = timeline.BootTimes(os.path.join(tmp, "timelines", "boot_times.json"), keep=3)
+
+    def test_record(self):
+        self.assertEqual(self.boot_times.expected(), {})
+        for boot in (30, 40, 20, 35):
+            self.boot_times.record({
+                "elasticsearch": {"created": 0, "running": 1, "healthy": 1 + boot},
+                # never became healthy
+                "kibana": {"created": 0, "running": 1},
+                # no healthcheck
+                "wait-service": {"start": 0, "running": 2, "ready": 2},
+            })
+        # only the last 3 samples are kept
+        self.assertEqual(self.boot_times.load(), {"elasticsearch": [40, 20, 35]})
+        self.assertEqual(self.boot_times.expected(), {"elasticsearch": 35})
+
+    def test_adaptive_healthcheck(self):
+        redis = {"interval": "10s", "test": ["CMD", "redis-cli", "ping"]}
+        self.assertEqual(adaptive_healthcheck(redis, 2), {
+            "interval": "1s", "retries": 30, "start_period": "4s", "test": ["CMD", "redis-cli", "ping"],
+        })
+        es = {"interval": "10s", "retries": 12, "timeout": "5s", "start_period": "1m", "test": ["CMD", "true"]}
+        self.assertEqual(adaptive_healthcheck(es, 20), dict(es, interval="4s", retries=30, start_period="60s"))
+        # slow services keep their settings
+        self.assertIs(adaptive_healthcheck(es, 90), es)
+        self.assertEqual(adaptive_healthcheck({"disable": True}, 2), {"disable": True})